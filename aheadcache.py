@@ -0,0 +1,132 @@
+import json, os, re, threading, uuid
+
+REMOTE_RE = re.compile(r'^\s*\[remote\s+"([^"]+)"\s*\]', re.MULTILINE)
+
+class AheadCache(object):
+	"""
+		Cache of per-repo ahead/behind counts, persisted to a JSON file so
+			it survives restarts.
+
+		Counts are stored with a key of (first remote name, HEAD sha,
+		remote master sha, prefetched remote master sha). The key is read
+		straight from the files in .git, so checking an entry costs a few
+		small reads instead of a git process, and any commit, fetch or
+		remote change makes the old entry stale without having to
+		invalidate it explicitly.
+	"""
+
+	def __init__(self, path=None):
+		self.path = path
+		self.lock = threading.Lock()
+		self.entries = {} # repo path -> [key, counts]
+		self.dirty = False
+
+		if path is not None:
+			try:
+				with open(path, 'r') as f:
+					self.entries = {k: [tuple(v[0]), tuple(v[1])]
+						for k, v in json.load(f).items()}
+			except (OSError, ValueError, TypeError, IndexError):
+				pass # Missing or corrupt, start empty
+
+	def key(self, repodir):
+		"""
+			Reads the key for the current refs of the repo at repodir,
+				or returns None if it doesn't look like a repository
+		"""
+		gitdir = repodir + '/.git'
+		head = read_ref(gitdir, 'HEAD')
+		if head is None and not os.path.isfile(gitdir + '/HEAD'):
+			return None
+
+		try:
+			with open(gitdir + '/config', 'r') as f:
+				remote = REMOTE_RE.search(f.read())
+		except OSError:
+			return None
+
+		if remote is None:
+			return (None, head, None, None)
+		remote = remote.group(1)
+		return (remote, head,
+			read_ref(gitdir, 'refs/remotes/' + remote + '/master'),
+			read_ref(gitdir, 'refs/prefetch/remotes/' + remote + '/master'))
+
+	def get(self, repodir, key):
+		"""
+			Returns the cached (ahead, behind) for repodir if it was
+				stored with key, None otherwise
+		"""
+		if key is None:
+			return None
+		entry = self.entries.get(repodir)
+		if entry is not None and entry[0] == key:
+			return entry[1]
+		return None
+
+	def put(self, repodir, key, counts):
+		"""
+			Stores (ahead, behind) for repodir under key
+		"""
+		if key is None or counts is None:
+			return
+		with self.lock:
+			self.entries[repodir] = [key, tuple(counts)]
+			self.dirty = True
+
+	def invalidate(self, repodir):
+		with self.lock:
+			if self.entries.pop(repodir, None) is not None:
+				self.dirty = True
+
+	def save(self):
+		"""
+			Writes the cache to disk if it changed since the last save
+		"""
+		if self.path is None or not self.dirty:
+			return
+
+		with self.lock:
+			data = json.dumps(self.entries)
+			self.dirty = False
+
+		tmp = self.path + '.' + uuid.uuid4().hex + '.tmp'
+		try:
+			with open(tmp, 'w') as f:
+				f.write(data)
+			os.replace(tmp, self.path)
+		except OSError:
+			self.dirty = True
+			if os.path.exists(tmp):
+				os.remove(tmp)
+
+def read_ref(gitdir, ref):
+	"""
+		Resolves a ref (e.g. 'HEAD' or 'refs/heads/master') to a sha by
+			reading loose ref files and packed-refs, without running git
+		Returns None if the ref doesn't exist
+	"""
+	for i in range(5): # Follow symbolic refs a few levels deep
+		try:
+			with open(gitdir + '/' + ref, 'r') as f:
+				value = f.read().strip()
+		except OSError:
+			return read_packed_ref(gitdir, ref)
+
+		if not value.startswith('ref:'):
+			return value or None
+		ref = value[4:].strip()
+	return None
+
+def read_packed_ref(gitdir, ref):
+	try:
+		with open(gitdir + '/packed-refs', 'r') as f:
+			for line in f:
+				if line.startswith('#') or line.startswith('^'):
+					continue
+				parts = line.split()
+				if len(parts) == 2 and parts[1] == ref:
+					return parts[0]
+	except OSError:
+		pass
+	return None
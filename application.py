@@ -1,107 +1,678 @@
-from flask import Flask, request, jsonify
-import os, git, shutil
+from flask import Flask, Response, request, g, url_for, abort
+from flask import jsonify as flask_jsonify
+from werkzeug.wsgi import wrap_file
+from werkzeug.http import parse_etags
+from repocache import RepoCache
+from treeindex import TreeIndex
+from aheadcache import AheadCache, read_ref
+from jobs import JobQueue, JobProgress
+from locks import LockManager, LockTimeout
+from compression import Compressor
+from filecache import FileCache
+from metrics import Metrics, TransferMeter
+from profiling import Profiler
+import gitstatus
+import provisioning, prefetch, maintenance, gitbackend, gitdiff
+from gitcommit import commit_files, stage_changes, changes, HeadMoved, \
+	PathspecError, PathConflict
+from json import dumps
+import os, io, git, shutil, mimetypes, hashlib, hmac, uuid, time
+import concurrent.futures
 
 app = Flask(__name__)
 app.config.from_pyfile('config.cfg')
 
+CHUNK_SIZE = app.config.get('CHUNK_SIZE', 64 * 1024)
+
+# Endpoints of the server itself (metrics and admin) are kept under a name
+#	no user can have, see start_request()
+SERVER_PREFIX = '/.storage'
+
+profiler = Profiler()
+
+# State shared by worker processes is kept in files under STORAGE_ROOT, in
+#	names no user can have
+app_metrics = Metrics(app.config.get('METRICS_DIR',
+	app.config.get('STORAGE_ROOT') + '/.metrics'),
+	on_git=profiler.git_command)
+
+repo_cache = RepoCache(app.config.get('REPO_CACHE_SIZE', 256),
+	app.config.get('REPO_CACHE_TIMEOUT', 300), app_metrics.Repo)
+
+list_pool = concurrent.futures.ThreadPoolExecutor(
+	app.config.get('LIST_WORKERS', 8))
+
+ahead_cache = AheadCache(app.config.get('AHEAD_CACHE_FILE',
+	app.config.get('STORAGE_ROOT') + '/.ahead-cache.json'))
+
+git_backend = gitbackend.get(app.config.get('GIT_BACKEND', 'cli'), app.logger)
+
+tree_index = TreeIndex(app.config.get('TREE_CACHE_SIZE', 64))
+
+file_cache = FileCache(app.config.get('FILE_CACHE_SIZE', 32 * 1024 * 1024),
+	app_metrics.file_cache)
+
+diff_cache = gitdiff.DiffCache(app.config.get('DIFF_CACHE_SIZE',
+	32 * 1024 * 1024))
+
+tuned_repos = set() # Repos with status caches enabled
+
+job_queue = JobQueue(app.config.get('JOB_WORKERS', 4),
+	app.config.get('JOB_TTL', 3600), app.config.get('JOB_DIR',
+	app.config.get('STORAGE_ROOT') + '/.jobs'))
+
+repo_locks = LockManager(app.config.get('LOCK_TIMEOUT', 30),
+	app.config.get('LOCK_DIR', app.config.get('STORAGE_ROOT') + '/.locks'),
+	app_metrics.lock_waited)
+
+def prefetch_repo(path):
+	# Shared, so that a pull or push clearing the prefetched refs waits
+	#	for it
+	token = repo_locks.acquire(os.path.normpath(path))
+	try:
+		r = repo_cache.acquire(path)
+		try:
+			prefetch.prefetch(r)
+		finally:
+			repo_cache.release(r)
+	finally:
+		repo_locks.release(token)
+	maintainer.wrote(path)
+
+def maintain_repo(path, task, auto):
+	r = repo_cache.acquire(path)
+	try:
+		maintenance.maintain(r, task, auto)
+	finally:
+		repo_cache.release(r)
+
+maintainer = maintenance.Maintainer(maintain_repo,
+	app.config.get('MAINTENANCE_WRITES', 50),
+	app.config.get('MAINTENANCE_BUDGET', 0.25))
+
+prefetcher = prefetch.Prefetcher(prefetch_repo,
+	app.config.get('PREFETCH_WORKERS', 2),
+	app.config.get('PREFETCH_INTERVAL', 60),
+	app.config.get('PREFETCH_MAX_INTERVAL', 3600),
+	app.config.get('PREFETCH_IDLE', 86400))
+
+compressor = Compressor(app.config.get('COMPRESS_LEVELS', None),
+	app.config.get('COMPRESS_MIN_SIZE', 1024),
+	app.config.get('COMPRESS_CACHE_SIZE', 64 * 1024 * 1024),
+	app.config.get('COMPRESS_MAX_FILE_SIZE', 1024 * 1024))
+
+def get_repo(path):
+	"""
+		Gets a cached git.Repo handle for path, which is handed back
+			to the cache when the request ends
+		Raises git.NoSuchPathError or git.InvalidGitRepositoryError
+	"""
+	r = repo_cache.acquire(path)
+	if getattr(g, 'repos', None) is None:
+		g.repos = []
+	g.repos.append(r)
+	return r
+
+@app.teardown_request
+def release_repos(exc):
+	for r in getattr(g, 'repos', None) or []:
+		repo_cache.release(r)
+	g.repos = None
+
+def lock_repo(path, exclusive=False):
+	"""
+		Locks the repo at path until the request ends, shared for reads
+			or exclusive for changes
+		Raises LockTimeout, returned as 503 (Service Unavailable)
+	"""
+	with profiler.timed('lock'):
+		token = repo_locks.acquire(os.path.normpath(path), exclusive)
+	if getattr(g, 'locks', None) is None:
+		g.locks = []
+	g.locks.append(token)
+
+def stream_locked(response):
+	"""
+		Keeps the locks of the request until a streamed response has been
+			sent, or closed without being sent
+	"""
+	tokens = getattr(g, 'locks', None) or []
+	g.locks = None
+
+	def release():
+		while tokens:
+			repo_locks.release(tokens.pop())
+
+	def stream(body):
+		try:
+			for chunk in body:
+				yield chunk
+		finally:
+			release()
+
+	response.response = stream(response.response)
+	response.call_on_close(release)
+	return response
+
+@app.teardown_request
+def release_locks(exc):
+	for token in getattr(g, 'locks', None) or []:
+		repo_locks.release(token)
+	g.locks = None
+
+@app.before_request
+def start_request():
+	g.started = time.time()
+	app_metrics.request_started(request.endpoint)
+
+	repo = None
+	if request.view_args and 'repo' in request.view_args:
+		repo = request.view_args['user'] + '/' + request.view_args['repo']
+	profiler.start(request.endpoint, repo)
+
+	# Names starting with a dot are kept for the server: its files in
+	#	STORAGE_ROOT and its endpoints under SERVER_PREFIX
+	args = request.view_args or {}
+	if any(args.get(x, '').startswith('.') for x in ['user', 'repo']):
+		return jsonify({}), 404 # Not found
+	if repo is not None:
+		prefetcher.touch(app.config.get('STORAGE_ROOT') + '/' + repo)
+
+@app.after_request
+def record_status(response):
+	g.status = response.status_code
+	return response
+
+@app.teardown_request
+def finish_request(exc):
+	started = getattr(g, 'started', None)
+	if started is None:
+		return
+	elapsed = time.time() - started
+	status = getattr(g, 'status', 500)
+	app_metrics.request_finished(request.endpoint, request.method, status,
+		elapsed)
+
+	# Say where the time went for slow requests
+	breakdown = profiler.finish()
+	threshold = app.config.get('SLOW_REQUEST_THRESHOLD', 1.0)
+	if breakdown is not None and threshold is not None and elapsed >= threshold:
+		app.logger.warning('Slow request: %s %s %d in %.3fs: %s',
+			request.method, request.full_path.rstrip('?'), status, elapsed,
+			breakdown.format(elapsed))
+
+def jsonify(*args, **kwargs):
+	"""
+		flask.jsonify, timed as serialization for slow request logs
+	"""
+	with profiler.timed('serialize'):
+		return flask_jsonify(*args, **kwargs)
+
+@app.after_request
+def compress(response):
+	# Negotiated with Accept-Encoding, see Compressor
+	with profiler.timed('compress'):
+		return compressor.apply(response, request.accept_encodings)
+
+@app.errorhandler(LockTimeout)
+def lock_timeout(e):
+	return jsonify({}), 503 # Service unavailable
+
+@app.errorhandler(413)
+def too_large(e):
+	return jsonify({}), 413 # Request entity too large
+
+def query_flag(name):
+	"""
+		True if the query has flag name set, e.g. ?raw=1 or ?raw=true
+	"""
+	return request.args.get(name, '0') not in ['', '0', 'false']
+
+def wants_raw():
+	"""
+		True if the client asked for raw file contents instead of JSON,
+			either with ?raw=1 or by preferring application/octet-stream
+	"""
+	if query_flag('raw'):
+		return True
+	best = request.accept_mimetypes.best_match(
+		['application/json', 'application/octet-stream'])
+	return best == 'application/octet-stream'
+
+def send_raw(fullpath):
+	"""
+		Streams a file from disk without loading it into memory.
+			Whole files are handed to the server's wsgi.file_wrapper so
+			that sendfile can be used where supported. A single byte
+			range (Range: bytes=a-b) is answered with 206 Partial Content.
+	"""
+	f = open(fullpath, 'rb')
+	st = os.fstat(f.fileno())
+	size = st.st_size
+	mimetype = mimetypes.guess_type(fullpath)[0] or 'application/octet-stream'
+
+	etag = stat_etag(st)
+	if request.if_none_match.contains_weak(etag):
+		f.close()
+		return not_modified(etag)
+	headers = {'Accept-Ranges': 'bytes', 'ETag': '"' + etag + '"'}
+
+	# Multiple ranges are ignored and the whole file is sent instead
+	rng = request.range
+	if rng is not None and rng.units == 'bytes' and len(rng.ranges) == 1:
+		span = rng.range_for_length(size)
+		if span is None:
+			f.close()
+			headers['Content-Range'] = 'bytes */%d' % size
+			return Response(status=416, headers=headers) # Not satisfiable
+
+		start, stop = span
+		headers['Content-Range'] = 'bytes %d-%d/%d' % (start, stop - 1, size)
+		headers['Content-Length'] = str(stop - start)
+		return Response(read_range(f, start, stop), 206, headers,
+			mimetype=mimetype, direct_passthrough=True) # Partial content
+
+	headers['Content-Length'] = str(size)
+	return Response(wrap_file(request.environ, f, CHUNK_SIZE), 200, headers,
+		mimetype=mimetype, direct_passthrough=True)
+
+def stat_etag(st):
+	"""
+		ETag of a file from its inode, size and modification time, which
+			change whenever the file is written or replaced
+	"""
+	return '%x-%x-%x' % (st.st_ino, st.st_size, st.st_mtime_ns)
+
+def blob_etag(data):
+	"""
+		ETag of file contents: their git blob SHA, so a clean tracked
+			file has the same tag as its blob in the repository
+	"""
+	h = hashlib.sha1(b'blob ' + str(len(data)).encode('ascii') + b'\0')
+	h.update(data)
+	return h.hexdigest()
+
+def file_matches(fullpath, etags):
+	"""
+		Checks If-Match etags against the current version of a file,
+			accepting both the tag of raw downloads and of JSON reads.
+			Compressed responses carry the weak form of the same tags,
+			which are accepted too.
+	"""
+	if etags.star_tag or etags.contains_weak(stat_etag(os.stat(fullpath))):
+		return True
+	return etags.contains_weak(file_cache.read(fullpath, decode_file)[1])
+
+def decode_file(data):
+	"""
+		Returns (text, blob ETag) of file contents, where text is decoded
+			as open(fullpath, 'r') would, or None if that fails
+	"""
+	try:
+		text = io.TextIOWrapper(io.BytesIO(data)).read()
+	except UnicodeDecodeError:
+		text = None
+	return text, blob_etag(data)
+
+def work_tree_sha(fullpath):
+	"""
+		Blob sha of a file in the work tree, or of the target of a symlink
+	"""
+	if os.path.islink(fullpath):
+		return blob_etag(os.readlink(fullpath).encode('utf-8', 'surrogateescape'))
+	return file_cache.read(fullpath, decode_file)[1]
+
+def not_modified(etag):
+	return Response(status=304, headers={'ETag': '"' + etag + '"'})
+
+def conditional(data, etag=None):
+	"""
+		Returns data as JSON with a strong ETag, the hash of the JSON
+			unless given, or 304 (Not Modified) if the client sent the
+			same tag in If-None-Match
+	"""
+	response = jsonify(data)
+	if etag is None:
+		etag = hashlib.sha1(response.get_data()).hexdigest()
+	if request.if_none_match.contains_weak(etag):
+		return not_modified(etag)
+	response.set_etag(etag)
+	return response
+
+def read_range(f, start, stop):
+	"""
+		Yields the bytes [start, stop) of f in chunks, then closes f
+	"""
+	try:
+		f.seek(start)
+		remaining = stop - start
+		while remaining > 0:
+			chunk = f.read(min(CHUNK_SIZE, remaining))
+			if not chunk:
+				break
+			remaining -= len(chunk)
+			yield chunk
+	finally:
+		f.close()
+
+class ChecksumError(Exception):
+	pass
+
+def get_upload():
+	"""
+		Gets the new contents of a file from the request, either streamed
+			from the raw body (?raw=1 or Content-Type:
+			application/octet-stream) or from the 'data' field of a JSON
+			body. An optional 'X-Checksum: <algorithm>=<hex digest>' header
+			is verified against the written bytes.
+		Returns (iterable of byte chunks, checksum or None), or None if
+			the request is malformed
+	"""
+	# Reject bodies over MAX_CONTENT_LENGTH before reading them
+	limit = app.config.get('MAX_CONTENT_LENGTH', None)
+	if limit is not None and (request.content_length or 0) > limit:
+		abort(413) # Request entity too large
+
+	checksum = None
+	if 'X-Checksum' in request.headers:
+		algorithm, sep, digest = request.headers['X-Checksum'].partition('=')
+		if not sep or algorithm.lower() not in hashlib.algorithms_available:
+			return None
+		checksum = (algorithm.lower(), digest.strip().lower())
+
+	if query_flag('raw') or request.mimetype == 'application/octet-stream':
+		stream = request.stream
+		return iter(lambda: stream.read(CHUNK_SIZE), b''), checksum
+
+	json = request.get_json(force=True, silent=True)
+	if not isinstance(json, dict) or not isinstance(json.get('data'), str):
+		return None
+	return [json['data'].encode('utf-8')], checksum
+
+def write_atomic(fullpath, chunks, checksum=None, replace=True):
+	"""
+		Writes chunks to a temporary file in the same directory and then
+			moves it over fullpath, so readers see either the old or the
+			new contents and never a partial write.
+		checksum: (algorithm, hex digest) the contents must match,
+			raises ChecksumError otherwise
+		replace: if False, raises FileExistsError rather than overwrite
+	"""
+	dirname, basename = os.path.split(fullpath)
+	tmp = os.path.join(dirname, '.' + basename + '.' + uuid.uuid4().hex + '.tmp')
+	h = hashlib.new(checksum[0]) if checksum else None
+
+	try:
+		# Created with the default mode (subject to umask), like open()
+		with open(os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666),
+				'wb') as f:
+			for chunk in chunks:
+				f.write(chunk)
+				if h is not None:
+					h.update(chunk)
+
+		if h is not None and h.hexdigest() != checksum[1]:
+			raise ChecksumError(fullpath)
+
+		if replace:
+			if os.path.exists(fullpath):
+				shutil.copymode(fullpath, tmp)
+			os.replace(tmp, fullpath)
+		else:
+			# link() fails if another request created the file meanwhile
+			os.link(tmp, fullpath)
+			os.remove(tmp)
+	except:
+		if os.path.exists(tmp):
+			os.remove(tmp)
+		raise
+
+def file_path(basedir, path):
+	"""
+		Returns the full path of <path> inside the repository at basedir,
+			or None if it points outside of it (e.g. '../other')
+	"""
+	path = os.path.normpath(path)
+	if os.path.isabs(path) or path == '..' or path.startswith('../'):
+		return None
+	return basedir + '/' + path
+
+def file_op(basedir, path, method, get_data, if_match=None):
+	"""
+		Performs a single file() operation, shared by file() and batch()
+		get_data: called for PUT and POST to get the contents to write,
+			returns (chunks, checksum) or None if no data was passed
+		if_match: ETags a PUT or DELETE is conditional on
+		Returns (JSON data, status code). Data includes the 'etag' of the
+			file after GET, PUT and POST.
+	"""
+	fullpath = file_path(basedir, path)
+	if fullpath is None:
+		return {}, 403 # Forbidden
+
+	exists = os.path.exists(fullpath)
+	isdir = os.path.isdir(fullpath)
+
+	if isdir:
+		return {}, 403 # Forbidden
+
+	# Only change the version of the file the client last saw
+	if method in ['PUT', 'DELETE'] and exists and if_match is not None:
+		try:
+			if not file_matches(fullpath, if_match):
+				return {}, 412 # Precondition failed
+		except Exception as e:
+			return {}, 500 # Internal error
+
+	if method == 'GET':
+		if exists:
+			try:
+				with profiler.timed('fs'):
+					text, etag = file_cache.read(fullpath, decode_file)
+				if text is None:
+					return {}, 500 # Internal error; not text
+				return {'data': text, 'etag': etag}, 200
+			except Exception as e:
+				return {}, 500 # Internal error
+		else:
+			return {}, 404 # Not found
+
+	elif method == 'PUT':
+		if exists:
+			# Confirm data was received
+			upload = get_data()
+			if upload is None:
+				return {}, 400 # Bad request
+
+			# Overwrite file
+			try:
+				with profiler.timed('fs'):
+					write_atomic(fullpath, *upload)
+				tree_index.invalidate(basedir, path)
+				file_cache.invalidate(fullpath)
+			except ChecksumError:
+				return {}, 400 # Bad request
+			except Exception as e:
+				return {}, 500 # Internal error
+
+			return {'etag': stat_etag(os.stat(fullpath))}, 200 # OK
+		else:
+			return {}, 404 # Not Found
+	elif method == 'POST':
+		if exists:
+			return {}, 409 # Conflict
+
+		# Confirm data was received
+		upload = get_data()
+		if upload is None:
+			return {}, 400 # Bad request
+
+		# Write data to file
+		try:
+			# Make directories if necessary
+			with profiler.timed('fs'):
+				os.makedirs(os.path.dirname(fullpath), exist_ok=True)
+				write_atomic(fullpath, *upload, replace=False)
+			tree_index.invalidate(basedir, path)
+			file_cache.invalidate(fullpath)
+		except ChecksumError:
+			return {}, 400 # Bad request
+		except FileExistsError:
+			return {}, 409 # Conflict
+		except Exception as e:
+			return {}, 500 # Internal error
+		return {'etag': stat_etag(os.stat(fullpath))}, 201 # Created
+
+	elif method == 'DELETE':
+		if exists:
+			try:
+				with profiler.timed('fs'):
+					os.remove(fullpath)
+				tree_index.invalidate(basedir, path)
+				file_cache.invalidate(fullpath)
+			except Exception as e:
+				return {}, 500 # Internal error
+			return {}, 200 # OK
+		else:
+			return {}, 404 # Not found
+
+	return {}, 405 # Method not allowed
+
 @app.route('/<user>/<repo>/file/<path:path>',
 		methods=['GET', 'PUT', 'POST', 'DELETE'])
 def file(user, repo, path):
 	"""
 		Provides methods for retrieving, creating, editing and
 		deleting files in a repository
+		All responses with file contents, and those of successful
+			writes, carry a strong ETag of the file. PUT and DELETE with
+			If-Match only apply if the file still has one of the tags.
 		GET: Gets the contents of the file in <path>
+			Query: raw=1 (or Accept: application/octet-stream) streams
+				the file as bytes instead of JSON; Range is supported
 			Returns:
 					200 (OK) + JSON {data: file contents}
+					200 (OK) + raw file contents
+					206 (Partial Content) + requested byte range
+					304 (Not Modified; ETag matches If-None-Match)
 					404 (Not Found)
+					416 (Range Not Satisfiable)
 					500 (Internal Server Error; Can't read file)
 		POST: Creates the file at <path> and writes the passed data to it
-			Data: JSON with 'data' containing the new file contents
+			Data: JSON with 'data' containing the new file contents, or
+				the raw contents with ?raw=1 or Content-Type:
+				application/octet-stream. Header 'X-Checksum:
+				<algorithm>=<hex digest>' optionally verifies the contents
 			Returns:
 					201 (Created)
-					400 (Bad Request; No JSON passed)
+					400 (Bad Request; No JSON passed or checksum mismatch)
 					409 (Conflict; File already exists)
+					413 (Request Entity Too Large; over MAX_CONTENT_LENGTH)
 					500 (Internal Server Error; Can't write file)
 		PUT: Updates the contents of a file
-			Data: JSON with 'data' containing the new file contents
+			Data: As for POST
 			Returns: 
 					200 (OK)
-					400 (Bad Request; No JSON passed)
+					400 (Bad Request; No JSON passed or checksum mismatch)
 					404 (Not Found)
+					412 (Precondition Failed; If-Match doesn't match)
+					413 (Request Entity Too Large; over MAX_CONTENT_LENGTH)
 					500 (Internal Server Error; Can't write file)
 		DELETE: Deletes a file
 			Returns:
 					200 (OK)
 					404 (Not Found)
+					412 (Precondition Failed; If-Match doesn't match)
 					500 (Internal Server Error; Can't delete)
 	"""
 	root = app.config.get('STORAGE_ROOT')
-	fullpath = root + '/' + user + '/' + repo + '/' + path
-
-	exists = os.path.exists(fullpath)
-	isdir = os.path.isdir(fullpath)
+	basedir = root + '/' + user + '/' + repo
 
-	if isdir:
-		return jsonify({}), 403 # Forbidden
+	lock_repo(basedir, request.method != 'GET')
 
-	if request.method == 'GET':
-		if exists:
+	# Stream raw contents if requested
+	if request.method == 'GET' and wants_raw():
+		fullpath = file_path(basedir, path)
+		if fullpath is not None and os.path.isfile(fullpath):
 			try:
-				with open(fullpath, 'r') as f:
-					return jsonify({'data': f.read()})
+				return send_raw(fullpath)
 			except Exception as e:
 				return jsonify({}), 500 # Internal error
-		else:
-			return jsonify({}), 404 # Not found
 
-	elif request.method == 'PUT':
-		if exists:
-			# Confirm json was received
-			json = request.get_json(force=True, silent=True)
-			if json is None or 'data' not in json:
-				return jsonify({}), 400 # Bad request
+	if_match = request.if_match if 'If-Match' in request.headers else None
+	data, status = file_op(basedir, path, request.method, get_upload, if_match)
 
-			# Overwrite file
-			try:
-				with open(fullpath, 'w') as f:
-					f.write(json['data'])
-			except Exception as e:
-				return jsonify({}), 500 # Internal error
+	# Send the version as a header rather than in the data
+	etag = data.pop('etag', None)
+	if etag is None:
+		return jsonify(data), status
+	if request.method == 'GET':
+		return conditional(data, etag)
 
-			return jsonify({}), 200 # OK
-		else:
-			return jsonify({}), 404 # Not Found
-	elif request.method == 'POST':
-		if exists:
-			return jsonify({}), 409 # Conflict
+	response = jsonify(data)
+	response.set_etag(etag)
+	return response, status
 
-		# Confirm json was received
-		json = request.get_json(force=True, silent=True)
-		if json is None or 'data' not in json:
+BATCH_OPS = {'read': 'GET', 'create': 'POST', 'update': 'PUT', 'delete': 'DELETE'}
+
+@app.route('/<user>/<repo>/batch', methods=['POST'])
+def batch(user, repo):
+	"""
+		Performs many file operations in one request, with the same
+			semantics and status codes as the file endpoint
+		POST: Run the operations in order
+			Data: JSON list of operations, e.g.
+					[
+						{'op': 'read', 'path': 'README.md'},
+						{'op': 'create', 'path': 'a.txt', 'data': 'foo'},
+						{'op': 'update', 'path': 'b.txt', 'data': 'bar',
+							'if_match': '"etag"'},
+						{'op': 'delete', 'path': 'c.txt'}
+					]
+			Returns:
+				200 (OK) + newline delimited JSON, one line per operation
+					streamed as it completes, e.g.
+					{'index': 0, 'path': 'README.md', 'status': 200,
+						'data': 'file contents', 'etag': 'abc123'}
+				400 (Bad Request; invalid or no JSON)
+				404 (Not Found)
+	"""
+	root = app.config.get('STORAGE_ROOT')
+	basedir = root + '/' + user + '/' + repo
+
+	if not os.path.isdir(basedir):
+		return jsonify({}), 404 # Not Found
+
+	# Confirm a list of valid operations was received
+	ops = request.get_json(force=True, silent=True)
+	if not isinstance(ops, type([])): # list() is the view below
+		return jsonify({}), 400 # Bad request
+	for op in ops:
+		if not isinstance(op, dict) or op.get('op') not in BATCH_OPS \
+				or not isinstance(op.get('path'), str) \
+				or not isinstance(op.get('if_match', ''), str):
 			return jsonify({}), 400 # Bad request
 
-		# Make directories if necessary
-		os.makedirs(os.path.dirname(fullpath), exist_ok=True)
+	# Lock until all operations have been streamed
+	lock_repo(basedir, any(x['op'] != 'read' for x in ops))
 
-		# Write data to file
-		try:
-			with open(fullpath, 'w') as f:
-				f.write(json['data'])
-		except Exception as e:
-			return jsonify({}), 500 # Internal error
-		return jsonify({}), 201 # Created
+	def run():
+		for i, op in enumerate(ops):
+			def get_data():
+				if not isinstance(op.get('data'), str):
+					return None
+				return [op['data'].encode('utf-8')], None
 
-	elif request.method == 'DELETE':
-		if exists:
-			try:
-				os.remove(fullpath)
-			except Exception as e:
-				return jsonify({}), 500 # Internal error
-			return jsonify({}), 200 # OK
-		else:
-			return jsonify({}), 404 # Not found
+			if_match = None
+			if 'if_match' in op:
+				if_match = parse_etags(op['if_match'])
 
-	return jsonify({}), 405 # Method not allowed
+			data, status = file_op(basedir, op['path'], BATCH_OPS[op['op']],
+				get_data, if_match)
+			data.update({'index': i, 'path': op['path'], 'status': status})
+			yield dumps(data) + '\n'
+
+	return stream_locked(Response(run(), mimetype='application/x-ndjson'))
 
 @app.route('/<user>/<repo>/tree', defaults={'subdir': ''})
 @app.route('/<user>/<repo>/tree/<path:subdir>')
@@ -111,39 +682,102 @@ def tree(user, repo, subdir):
 			with directories as dictionaries and
 			files as 'true'
 		GET: Get directory tree
+			Query:
+				depth: Only descend this many levels, deeper directories
+					are returned empty
+				format: 'flat' returns a list of entries instead,
+					e.g. {'entries': [{'path': 'dir/a.txt', 'type': 'file'}],
+						'next': 'dir/a.txt'}
+					'ndjson' streams the same entries one per line while
+					the tree is walked, ending with {'next': ...} if limited
+				limit: Maximum number of entries (flat and ndjson only),
+					'next' is null once all entries have been returned
+				cursor: Return entries after this 'next' value
+				stat: Add 'size' and 'mtime' to each entry
 			Returns:
 					200 (OK) + JSON
+					304 (Not Modified; ETag matches If-None-Match)
+					400 (Bad Request; invalid query)
 					404 (Not Found; directory does not exist)
 	"""
 	root = app.config.get('STORAGE_ROOT')
 	basedir = root + '/' + user + '/' + repo
 
 	if subdir != '':
-		basedir = basedir + '/' + subdir
+		subdir = os.path.normpath(subdir)
 
-	if not os.path.exists(basedir):
-		return jsonify({}), 404 # Not found
-
-	# Walk the directory and return JSON of tree
-	tree = {}
-	for path, dir, files in os.walk(basedir):
-		localdir = path[len(basedir) + 1:]
-		localpath = []
-
-		if localdir != '':
-			localpath = localdir.split('/')
+	lock_repo(basedir)
 
-		# Ignore .git directory unless specified as the subdirectory
-		if '.git' not in localpath:
-			wd = tree
-			for i in localpath:
-				wd[i] = wd.get(i, {})
-				wd = wd[i]
+	if not os.path.exists(basedir + '/' + subdir):
+		return jsonify({}), 404 # Not found
 
-			for f in files:
-				wd[f] = True
+	# Parse listing options
+	try:
+		depth = positive(request.args.get('depth', None))
+		limit = positive(request.args.get('limit', None))
+	except ValueError:
+		return jsonify({}), 400 # Bad request
+	cursor = request.args.get('cursor', None)
+	stat = query_flag('stat')
+	fmt = request.args.get('format', 'json')
+
+	if fmt == 'json' and limit is None and cursor is None:
+		# Get the tree from the index, .git is ignored unless specified
+		#	as the subdirectory
+		with profiler.timed('fs'):
+			tree = tree_index.tree(basedir, subdir, depth)
+		return conditional(tree)
+
+	entries = tree_entries(basedir, subdir, depth, cursor, limit, stat)
+	if fmt == 'ndjson':
+		return stream_locked(Response((dumps(x) + '\n' for x in entries),
+			mimetype='application/x-ndjson'))
+	elif fmt in ['json', 'flat']:
+		with profiler.timed('fs'):
+			entries = [x for x in entries]
+		more = None
+		if entries and 'next' in entries[-1]:
+			more = entries.pop()['next']
+		return conditional({'entries': entries, 'next': more})
+
+	return jsonify({}), 400 # Bad request
+
+def positive(value):
+	"""
+		Parses a query value as an integer greater than zero, or None
+			if it wasn't passed
+	"""
+	if value is None:
+		return None
+	value = int(value)
+	if value < 1:
+		raise ValueError(value)
+	return value
+
+def tree_entries(basedir, subdir, depth, cursor, limit, stat):
+	"""
+		Yields flat tree entries as dictionaries, followed by
+			{'next': cursor} if there are more than limit entries
+	"""
+	top = basedir + '/' + subdir if subdir else basedir
+	count = 0
+	for path, isdir in tree_index.walk(basedir, subdir, depth, cursor):
+		if limit is not None and count == limit:
+			yield {'next': last}
+			return
+
+		entry = {'path': path, 'type': 'dir' if isdir else 'file'}
+		if stat:
+			try:
+				st = os.stat(top + '/' + path)
+				entry['size'] = st.st_size
+				entry['mtime'] = st.st_mtime
+			except OSError:
+				pass # Removed while walking
 
-	return jsonify(tree)
+		count += 1
+		last = path
+		yield entry
 
 @app.route('/<user>')
 def list(user):
@@ -152,7 +786,10 @@ def list(user):
 			for this user, with the number of commits 
 			ahead of the remote repo
 		GET: Returns the list of repos as a dictionary: 
-				{reponame: 'ahead/behind'}
+				{reponame: ahead}
+			Query: behind=1 also returns the commits the remote is ahead:
+				{reponame: {'ahead': ahead, 'behind': behind}}
+			Counts are null for repos that took longer than LIST_TIMEOUT
 			Returns:
 				200 (OK) + JSON
 				404 (Not Found)
@@ -163,33 +800,91 @@ def list(user):
 
 	if not os.path.exists(basedir):
 		return jsonify({}), 404
-	
+
+	behind = query_flag('behind')
+
+	# Use cached counts where the refs haven't changed, count the rest
+	#	in parallel and give up on slow repos after the timeout
+	counts = {}
+	futures = {}
+	count = profiler.bind(ahead_behind)
+	for d in os.listdir(basedir):
+		with profiler.timed('fs'):
+			key = ahead_cache.key(basedir + '/' + d)
+		counts[d] = ahead_cache.get(basedir + '/' + d, key)
+		if counts[d] is None:
+			futures[list_pool.submit(count, basedir + '/' + d, key)] = d
+	done, pending = concurrent.futures.wait(futures,
+		timeout=app.config.get('LIST_TIMEOUT', 5))
+
+	for f in done:
+		counts[futures[f]] = f.result()
+	with profiler.timed('fs'):
+		ahead_cache.save()
+
 	repos = {}
-	dirs = os.listdir(basedir)
-	for d in dirs:
-		r = None
-		try:
-			r = git.Repo(basedir + '/' + d)
-			repos[d] = 0
-			if (len(r.remotes) > 0):
-				remote = r.remotes[0]
-
-				if r.head.is_valid(): # Commit exists
-					try:
-						remote.refs
-					except AssertionError:
-						# Remotes without references mean that the 
-						#	remote has no initial commit
-						repos[d] = 1
-					else:
-						repos[d] = len(
-							[1 for x in r.iter_commits(remote.name+'/master..')]
-						)
+	for f in pending:
+		f.cancel()
+		repos[futures[f]] = None
+	for d in counts:
+		if counts[d] is None:
+			continue # Not a repository, or timed out
+		if behind:
+			repos[d] = {'ahead': counts[d][0], 'behind': counts[d][1]}
+		else:
+			repos[d] = counts[d][0]
 
-		except (git.NoSuchPathError, git.InvalidGitRepositoryError):
-			pass
 	return jsonify(repos), 200
 
+def ahead_behind(path, key):
+	"""
+		Counts the commits ahead and behind for the repo at path and
+			caches them under key
+		Returns (ahead, behind), or None if path isn't a repository
+	"""
+	try:
+		r = repo_cache.acquire(path)
+	except (git.NoSuchPathError, git.InvalidGitRepositoryError):
+		return None
+
+	try:
+		counts = count_ahead_behind(r)
+	finally:
+		repo_cache.release(r)
+
+	ahead_cache.put(path, key, counts)
+	return counts
+
+def update_ahead(r, path):
+	"""
+		Refreshes the cached counts of a repo after its refs changed
+	"""
+	key = ahead_cache.key(path)
+	ahead_cache.put(path, key, count_ahead_behind(r))
+	ahead_cache.save()
+
+def count_ahead_behind(r):
+	"""
+		Counts the commits on HEAD that aren't on master of the first
+			remote (ahead), and the other way around (behind). master
+			as last prefetched is used if it was fetched since.
+		Returns (ahead, behind)
+	"""
+	if len(r.remotes) == 0 or git_backend.head(r) is None:
+		return 0, 0
+	remote = r.remotes[0]
+	master = 'refs/remotes/' + remote.name + '/master'
+	if read_ref(r.git_dir, prefetch.PREFETCH_REFS + remote.name +
+			'/master') is not None:
+		master = prefetch.PREFETCH_REFS + remote.name + '/master'
+
+	counts = git_backend.ahead_behind(r, 'HEAD', master)
+	if counts is None:
+		# Remotes without references mean that the 
+		#	remote has no initial commit
+		return 1, 0
+	return counts
+
 @app.route('/<user>/<repo>', 
 	methods=['GET', 'PUT', 'POST', 'DELETE'])
 def repository(user, repo):
@@ -206,9 +901,17 @@ def repository(user, repo):
 					404 (Not Found)
 		POST: Initializes a new local repository
 			Data: JSON object with remote URLs {remote_name: 'remote_url'}
+			Query: options for provisioning the repository by its
+					first pull:
+				depth=1 to only fetch that many commits of history,
+				filter=blob:none to make it a partial clone that fetches
+					the objects left out (blob:none, blob:limit=<size>
+					or tree:<depth>) from the remotes when needed,
+				sparse=dir to only check out the files in dir (and at
+					the top level), repeated for more directories
 			Returns: 
 					201 (Created)
-					400 (Bad request, no JSON)
+					400 (Bad request, no JSON or invalid query)
 					409 (Conflict; already exists)
 		PUT: Updates a repository's remote URLs
 			Data: JSON object with remote URLs e.g. {origin: 'https://'}
@@ -225,18 +928,18 @@ def repository(user, repo):
 	root = app.config.get('STORAGE_ROOT')
 	repodir = root + '/' + user + '/' + repo
 
+	lock_repo(repodir, request.method != 'GET')
+
 	if request.method == 'GET':
 		r = None
 
 		# Check if repo exists
 		try:
-			r = git.Repo(repodir)
+			r = get_repo(repodir)
 		except (git.NoSuchPathError, git.InvalidGitRepositoryError):
 			return jsonify({}), 404 # Not Found
 
-		commit = None
-		if r.head.is_valid():
-			commit = r.head.commit.hexsha
+		commit = git_backend.head(r)
 		remotes = {x.name: x.url for x in r.remotes}
 
 		# Return list of remotes
@@ -247,7 +950,7 @@ def repository(user, repo):
 	elif request.method == 'POST':
 		# Check if repo already exists
 		try:
-			git.Repo(repodir)
+			get_repo(repodir)
 		except (git.NoSuchPathError, git.InvalidGitRepositoryError):
 			pass
 		else:
@@ -259,10 +962,30 @@ def repository(user, repo):
 		if json is None:
 			return jsonify({}), 400 # Bad request
 
+		# Provisioning options
+		depth = request.args.get('depth', None)
+		filter = request.args.get('filter', None)
+		sparse = request.args.getlist('sparse') or None
+		if depth is not None and (not depth.isdigit() or int(depth) < 1):
+			return jsonify({}), 400 # Bad request
+		if filter is not None and \
+				provisioning.FILTER_RE.match(filter) is None:
+			return jsonify({}), 400 # Bad request
+		for path in sparse or []:
+			if file_path(repodir, path) is None or path.startswith('-') or \
+					'.git' in os.path.normpath(path).split('/'):
+				return jsonify({}), 400 # Bad request
+
 		# Init repo and add remotes
-		r = git.Repo.init(repodir)
-		for rem in json:
-			r.create_remote(rem, json[rem])
+		repo_cache.invalidate(repodir)
+		tree_index.invalidate(repodir)
+		file_cache.invalidate(repodir)
+		ahead_cache.invalidate(repodir)
+		tuned_repos.discard(repodir)
+		maintainer.forget(repodir)
+		r = app_metrics.Repo.init(repodir)
+		provisioning.configure(r, depth and int(depth), filter, sparse)
+		provisioning.add_remotes(r, json)
 
 		return jsonify({}), 201 # Created
 
@@ -271,7 +994,7 @@ def repository(user, repo):
 
 		# Get repo if it exists
 		try:
-			r = git.Repo(repodir)
+			r = get_repo(repodir)
 		except (git.NoSuchPathError, git.InvalidGitRepositoryError):
 			return jsonify({}), 404 # Not Found
 
@@ -283,10 +1006,11 @@ def repository(user, repo):
 		# Delete existing remotes
 		for remo in r.remotes:
 			r.delete_remote(remo.name)
+			prefetch.clear(r, remo.name)
 
 		# Replace remotes with passed data
-		for rem in json:
-			r.create_remote(rem, json[rem])
+		provisioning.add_remotes(r, json)
+		update_ahead(r, repodir)
 
 		return jsonify({}), 200 # OK
 
@@ -295,10 +1019,16 @@ def repository(user, repo):
 
 		# Check if repo exists
 		try:
-			r = git.Repo(repodir)
+			r = get_repo(repodir)
 		except (git.NoSuchPathError, git.InvalidGitRepositoryError):
 			return jsonify({}), 404 # Not Found
 
+		repo_cache.invalidate(repodir)
+		tree_index.invalidate(repodir)
+		file_cache.invalidate(repodir)
+		ahead_cache.invalidate(repodir)
+		tuned_repos.discard(repodir)
+		maintainer.forget(repodir)
 		try:
 			shutil.rmtree(repodir)
 		except:
@@ -323,6 +1053,7 @@ def status(user, repo):
 					Addition, Modification, Deletion and Renames have 
 					an A and B file, for renames A -> B, etc. Untracked
 					files are just a list of filenames.
+				304 (Not Modified; ETag matches If-None-Match)
 				403 (Forbidden) No baseline commit to diff with
 				404 (Not Found)
 	"""
@@ -330,41 +1061,141 @@ def status(user, repo):
 	root = app.config.get('STORAGE_ROOT')
 	basedir = root + '/' + user + '/' + repo
 
+	lock_repo(basedir)
+
 	r = None
 	try:
-		r = git.Repo(basedir)
+		r = get_repo(basedir)
 	except (git.NoSuchPathError, git.InvalidGitRepositoryError):
 		return jsonify({}), 404 # Not Found
 
-	if not r.head.is_valid(): # No commit. Get untracked files only
-		return jsonify({'U': r.untracked_files})
+	# Enable git's status caches the first time a repo is seen
+	if basedir not in tuned_repos:
+		try:
+			gitstatus.tune(r, app.config.get('STATUS_FSMONITOR', False))
+			tuned_repos.add(basedir)
+		except (OSError, git.GitCommandError):
+			pass # Config or index locked by another request, try next time
+
+	# Get the changes between the last commit and the working directory
+	#	grouped by change type (Add, Modify, Delete, Rename, Untracked)
+	changes = git_backend.status(r)
+
+	if git_backend.head(r) is None: # No commit. Get untracked files only
+		return conditional({'U': changes['U']})
+
+	return conditional(changes)
+
+@app.route('/<user>/<repo>/diff', defaults={'path': None})
+@app.route('/<user>/<repo>/diff/<path:path>')
+def diff(user, repo, path):
+	"""
+		Gets what changed in the files of a repository as a unified diff,
+			in git's patch format, streamed file by file.
+
+		GET: Diff the working directory (staged or not) against HEAD, or
+			the commits from and to if given, for the whole repository or
+			the file or directory path. Untracked files are left out.
+			Query: from=<commit>, to=<commit>, context=<lines around
+				each change, 3 by default>
+			Files larger than DIFF_MAX_FILE_SIZE and binary files are
+				listed without their contents. Diffs are cut short after
+				DIFF_MAX_SIZE bytes, with a last line '# Diff truncated'.
+			Returns:
+				200 (OK) + text/x-diff
+				304 (Not Modified; ETag matches If-None-Match)
+				400 (Bad Request; invalid query)
+				404 (Not Found; repo, path or commit doesn't exist)
+	"""
+	root = app.config.get('STORAGE_ROOT')
+	basedir = root + '/' + user + '/' + repo
+
+	paths = []
+	if path is not None:
+		if file_path(basedir, path) is None:
+			return jsonify({}), 404 # Not found
+		paths = [':(literal)' + os.path.normpath(path)]
+
+	try:
+		context = int(request.args.get('context', 3))
+	except ValueError:
+		return jsonify({}), 400 # Bad request
+	revs = [request.args.get('from', None), request.args.get('to', None)]
+	if context < 0 or any(x is not None and (x == '' or x.startswith('-'))
+			for x in revs):
+		return jsonify({}), 400 # Bad request
 
-	# Get the diff of the last commit and the working directory
-	diffs = r.head.commit.diff(None)
+	lock_repo(basedir)
 
-	# Iterate diffs and add them to a dictionary grouped by change type (Add, Modify, Delete, Rename, Untracked)
-	changes = {}
-	for ct in diffs.change_type:
-		changes[ct] = []
-		for diff in diffs.iter_change_type(ct):
-			c = {}
-			if diff.a_blob:
-				c['A'] = diff.a_blob.path
-			if diff.b_blob:
-				c['B'] = diff.b_blob.path
-			changes[ct].append(c)
+	try:
+		r = get_repo(basedir)
+	except (git.NoSuchPathError, git.InvalidGitRepositoryError):
+		return jsonify({}), 404 # Not found
 
-	changes['U'] = r.untracked_files
+	# Diff against an empty tree before the first commit
+	if revs[0] is None and git_backend.head(r) is None:
+		revs[0] = gitdiff.EMPTY_TREE
+	for i, rev in enumerate(revs):
+		if rev is not None and rev != gitdiff.EMPTY_TREE:
+			try:
+				revs[i] = r.git.rev_parse('--verify', rev + '^{commit}')
+			except git.GitCommandError:
+				return jsonify({}), 404 # Not found
+	base = revs[0] or r.head.commit.hexsha
+	target = revs[1]
+
+	max_size = app.config.get('DIFF_MAX_FILE_SIZE', 1024 * 1024)
+	with profiler.timed('fs'):
+		changes = gitdiff.list_changes(r, base, target, paths, work_tree_sha,
+			max_size)
+
+	# An unchanged path still has to exist on one side or the other
+	if path is not None and not changes:
+		name = os.path.normpath(path)
+		if not (target is None and os.path.lexists(basedir + '/' + name)) and \
+				not any(r.git.ls_tree(x, '--', name)
+					for x in [base, target] if x is not None):
+			return jsonify({}), 404 # Not found
 
-	return jsonify(changes)
+	# The patches follow from the contents of both sides of each change
+	headers = {}
+	if all(gitdiff.cache_key(x, context) or gitdiff.too_large(x, max_size)
+			for x in changes):
+		etag = hashlib.sha1(dumps([changes, context, max_size])
+			.encode('utf-8')).hexdigest()
+		if request.if_none_match.contains_weak(etag):
+			return not_modified(etag)
+		headers['ETag'] = '"' + etag + '"'
+
+	limit = app.config.get('DIFF_MAX_SIZE', 16 * 1024 * 1024)
+
+	def run():
+		# The request's repo is released before the response is streamed
+		r = repo_cache.acquire(basedir)
+		try:
+			sent = 0
+			for data in gitdiff.patches(r, base, target, changes, paths,
+					context, max_size, diff_cache):
+				if sent + len(data) > limit:
+					yield b'# Diff truncated\n'
+					break
+				sent += len(data)
+				yield data
+		finally:
+			repo_cache.release(r)
+
+	return stream_locked(Response(run(), headers=headers,
+		mimetype='text/x-diff'))
 
 @app.route('/<user>/<repo>/push/<remote>', methods=['POST'])
 def push(user, repo, remote):
 	"""
 		Performs a git push to the specified remote
 		POST: Push the local changes to the remote server
+			Query: async=1 queues the push and returns a job to poll
 			Returns:
 				200 (OK)
+				202 (Accepted) + JSON {job: job id}, see job()
 				403 (Forbidden; remote doesn't exist)
 				404 (Not Found)
 				409 (Conflict; conflict while pushing)
@@ -372,37 +1203,60 @@ def push(user, repo, remote):
 	root = app.config.get('STORAGE_ROOT')
 	basedir = root + '/' + user + '/' + repo
 
+	if query_flag('async'):
+		return queue_job('push', user, repo, remote, push_repo)
+
+	data, status = push_repo(basedir, remote)
+	return jsonify(data), status
+
+def push_repo(basedir, remote, progress=None):
+	"""
+		Pushes HEAD of the repo at basedir to remote
+		Returns (JSON data, status code) as for push()
+		Raises LockTimeout
+	"""
+	# Exclusive, so that no prefetch brings back the pre-push master
+	#	after the prefetched refs are cleared
+	with profiler.timed('lock'):
+		token = repo_locks.acquire(os.path.normpath(basedir), True)
 	r = None
 	try:
-		r = git.Repo(basedir)
+		r = repo_cache.acquire(basedir)
 	except (git.NoSuchPathError, git.InvalidGitRepositoryError):
-		return jsonify({}), 404 # Not Found
+		repo_locks.release(token)
+		return {}, 404 # Not Found
 
-	# Get specified remote
-	rem = r.remote(remote)
+	try:
+		# Confirm remote exists
+		rem = find_remote(r, remote)
+		if rem is None:
+			return {}, 403 # Forbidden
 
-	# Confirm remote exists
-	if rem.exists():
 		# Perform the push command
-		result = rem.push(r.head.reference)
+		meter = TransferMeter(progress)
+		with app_metrics.timed('push'):
+			result = rem.push(r.head.reference, progress=meter)
+		app_metrics.transferred('push', meter.size)
 		for info in result:
 			if info.flags & info.ERROR or info.flags & info.REJECTED:
-				return jsonify({}), 409 # Conflict
-
-		return jsonify({}), 200 # OK
-
+				return {}, 409 # Conflict
+		prefetch.clear(r, rem.name) # Older than the ref just pushed
+		update_ahead(r, basedir)
 
-
-	# Invalid remote
-	return jsonify({}), 403 # Forbidden
+		return {}, 200 # OK
+	finally:
+		repo_cache.release(r)
+		repo_locks.release(token)
 
 @app.route('/<user>/<repo>/pull/<remote>', methods=['POST'])
 def pull(user, repo, remote):
 	"""
 		Performs a git pull from remote
 		POST: Pull the remote changes to the local repo
+			Query: async=1 queues the pull and returns a job to poll
 			Returns:
-				200 (OK)
+				200 (OK) + JSON {notes: fetch notes}
+				202 (Accepted) + JSON {job: job id}, see job()
 				403 (Forbidden; remote doesn't exist)
 				404 (Not Found)
 				409 (Conflict; can't pull due to an error or rejected commit)
@@ -410,35 +1264,149 @@ def pull(user, repo, remote):
 	root = app.config.get('STORAGE_ROOT')
 	basedir = root + '/' + user + '/' + repo
 
+	if query_flag('async'):
+		return queue_job('pull', user, repo, remote, pull_repo)
+
+	data, status = pull_repo(basedir, remote)
+	return jsonify(data), status
+
+def fetched_bytes(r, result):
+	"""
+		Returns the bytes on disk of the objects fetched into r, as
+			listed in result, that the refs it had before didn't have
+	"""
+	new, old = [], []
+	for info in result:
+		if info.flags & (info.ERROR | info.REJECTED | info.HEAD_UPTODATE):
+			continue
+		new.append(info.ref.object.hexsha)
+		if info.old_commit is not None:
+			old.append(info.old_commit.hexsha)
+	if not new:
+		return 0
+	if r.head.is_valid():
+		old.append(r.head.commit.hexsha)
+	try:
+		return int(r.git.rev_list('--objects', '--disk-usage', *(new +
+			['--not'] + old)))
+	except (git.GitCommandError, ValueError):
+		return 0 # git older than 2.31
+
+def pull_repo(basedir, remote, progress=None):
+	"""
+		Fetches remote and merges it into HEAD of the repo at basedir
+		Returns (JSON data, status code) as for pull()
+		Raises LockTimeout
+	"""
+	with profiler.timed('lock'):
+		token = repo_locks.acquire(os.path.normpath(basedir), True)
 	r = None
 	try:
-		r = git.Repo(basedir)
+		r = repo_cache.acquire(basedir)
 	except (git.NoSuchPathError, git.InvalidGitRepositoryError):
-		return jsonify({}), 404 # Not Found
+		repo_locks.release(token)
+		return {}, 404 # Not Found
 
-	# Get remote
-	rem = r.remote(remote)
+	try:
+		# Confirm remote exists
+		rem = find_remote(r, remote)
+		if rem is None:
+			return {}, 403 # Forbidden
 
-	# Confirm remote exists
-	if rem.exists():
 		# Perform the pull command
-		result = rem.fetch()
+		meter = TransferMeter(progress)
+		with app_metrics.timed('fetch'):
+			result = rem.fetch(progress=meter, **provisioning.fetch_options(r))
+
+		# Small fetches are unpacked into loose objects, and then git
+		#	doesn't report their size, so measure what they added instead
+		if meter.size == 0:
+			meter.size = fetched_bytes(r, result)
+		app_metrics.transferred('pull', meter.size)
 
 		# Check resulting info for errors or rejects
 		for info in result:
 			if info.flags & info.ERROR or info.flags & info.REJECTED:
-				return jsonify({}), 409 # Conflict
+				return {}, 409 # Conflict
+		prefetch.clear(r, rem.name) # No newer than what was just fetched
 
-		# Pull the fetched changes into the local HEAD
+		# Merge the fetched changes into the local HEAD, without fetching
+		#	again like 'git pull' would
 		try:
-			rem.pull(rem.refs[0].remote_head)
+			r.git.merge('--no-edit', rem.refs[0].name)
 		except:
-			return jsonify({}), 409
+			return {}, 409
+		finally:
+			file_cache.invalidate(basedir)
+			maintainer.wrote(basedir)
+		update_ahead(r, basedir)
+
+		return {'notes': [x.note for x in result]}, 200 # OK
+	finally:
+		repo_cache.release(r)
+		repo_locks.release(token)
+
+def find_remote(r, name):
+	"""
+		Returns the remote of r called name, or None if it doesn't exist
+	"""
+	try:
+		rem = r.remote(name)
+	except ValueError: # Raised for unknown remotes by newer GitPython
+		return None
+	return rem if rem.exists() else None
+
+def queue_job(kind, user, repo, remote, fn):
+	"""
+		Queues fn(basedir, remote, progress) to run after any other jobs
+			of the repo, once the repo and remote are known to exist
+		Returns 202 (Accepted) with the job id, or the 403/404 fn would
+	"""
+	root = app.config.get('STORAGE_ROOT')
+	basedir = root + '/' + user + '/' + repo
+
+	try:
+		r = get_repo(basedir)
+	except (git.NoSuchPathError, git.InvalidGitRepositoryError):
+		return jsonify({}), 404 # Not Found
+	if find_remote(r, remote) is None:
+		return jsonify({}), 403 # Forbidden
+
+	def run(job):
+		try:
+			data, status = fn(basedir, remote, JobProgress(job))
+		except LockTimeout:
+			data, status = {}, 503 # Service unavailable
+		return {'status': status, 'data': data}
+
+	job = job_queue.submit(kind, basedir, run)
+	location = url_for('job', user=user, repo=repo, job_id=job.id)
+	return jsonify({'job': job.id}), 202, {'Location': location} # Accepted
+
+@app.route('/<user>/<repo>/jobs/<job_id>')
+def job(user, repo, job_id):
+	"""
+		Gets the state of a push or pull queued with async=1
+		GET: Get the job
+			Returns:
+				200 (OK) + JSON e.g.
+					{
+						'id': 'abc123', 'type': 'push',
+						'state': 'queued', 'running', 'done' or 'failed',
+						'progress': {'stage': 'writing', 'current': 5,
+							'total': 10, 'message': ''},
+						'result': {'status': 200, 'data': {}}
+					}
+				404 (Not Found)
+	"""
+	root = app.config.get('STORAGE_ROOT')
+	basedir = root + '/' + user + '/' + repo
+
+	j = job_queue.get(job_id)
+	if j is None or j.key != basedir:
+		return jsonify({}), 404 # Not Found
 
-		return jsonify({'notes': [x.note for x in result]}), 200 # OK
-	
-	# Invalid remote
-	return jsonify({}), 403 # Forbidden
+	return jsonify(j.to_dict())
 
 @app.route('/<user>/<repo>/commit', methods=['POST'])
 def commit(user, repo):
@@ -455,42 +1423,236 @@ def commit(user, repo):
 							'R': ['foo.txt']
 							'msg': 'Added hello, removed foo'
 						}
+				A and R can also name directories or globs (git
+					pathspecs, e.g. 'gen/' or '*.pb.go'), which stage
+					every new, modified or deleted file they match.
+					'all': true stages every change in the work tree.
+				Instead of (or as well as) adding files written before,
+					their new contents can be sent as 'files', with null
+					to delete a file. They are committed and written to
+					the work tree in one step, and only if HEAD is still
+					at 'parent', if given. A and R are optional then.
+					e.g. {
+							'files': {'dir/hello.txt': 'hi', 'foo.txt': null},
+							'parent': 'abc123',
+							'msg': 'Added hello, removed foo'
+						}
 			Returns:
-				200 (OK)
+				200 (OK) + JSON {'commit': new HEAD SHA, 'staged': files
+					the commit added, modified and deleted, e.g.
+					{'A': ['dir/hello.txt'], 'M': [], 'D': ['foo.txt']}}
 				400 (Bad Request; invalid or no JSON)
-				404 (Not Found)
+				403 (Forbidden; a file is outside the work tree or a directory)
+				404 (Not Found; or a path in A or R matches no file)
+				409 (Conflict; HEAD isn't at parent) + JSON {'head': HEAD SHA},
+					or a file is below a file that stays or above another
 	"""
 	root = app.config.get('STORAGE_ROOT')
 	basedir = root + '/' + user + '/' + repo
 
+	lock_repo(basedir, True)
+
 	r = None
 	try:
-		r = git.Repo(basedir)
+		r = get_repo(basedir)
 	except (git.NoSuchPathError, git.InvalidGitRepositoryError):
 		return jsonify({}), 404 # Not Found
 
 	# Get json
 	j = request.get_json(force=True, silent=True)
-	if j is None or 'A' not in j or 'R' not in j or 'msg' not in j:
+	if j is None or 'msg' not in j:
+		return jsonify({}), 400 # Bad request
+	if 'files' in j or j.get('all'):
+		j.setdefault('A', [])
+		j.setdefault('R', [])
+	if 'A' not in j or 'R' not in j or \
+			not isinstance(j['A'], type([])) or not isinstance(j['R'], type([])):
 		return jsonify({}), 400 # Bad request
+	for path in j['A'] + j['R']:
+		if not isinstance(path, str):
+			return jsonify({}), 400 # Bad request
+		if not path.startswith(':') and (file_path(basedir, path) is None or
+				'.git' in os.path.normpath(path).split('/')):
+			return jsonify({}), 403 # Forbidden
 
-	if len(j['A']) > 0:
-		try:
-			r.index.add(j['A'])
-		except FileNotFoundError:
-			return jsonify({}), 404 # Not Found
-	if len(j['R']) > 0:
+	# Contents to commit directly
+	files = {}
+	if not isinstance(j.get('files', {}), dict):
+		return jsonify({}), 400 # Bad request
+	for path, data in j.get('files', {}).items():
+		if data is not None and not isinstance(data, str):
+			return jsonify({}), 400 # Bad request
+		path = os.path.normpath(path)
+		if file_path(basedir, path) is None or '.git' in path.split('/'):
+			return jsonify({}), 403 # Forbidden
+		files[path] = None if data is None else data.encode('utf-8')
+
+	# Check before anything is staged, so that a refused commit leaves
+	#	the index alone
+	head = git_backend.head(r)
+	if j.get('parent') is not None and j['parent'] != head:
+		return jsonify({'head': head}), 409 # Conflict
+
+	try:
+		stage_changes(r, j['A'], j['R'], bool(j.get('all')))
+	except PathspecError:
+		return jsonify({}), 404 # Not Found
+
+	actor = git.Actor(j.get('name') or '', j.get('email') or '')
+	if files:
 		try:
-			r.index.remove(j['R'])
+			commit = commit_files(r, files, j['msg'], actor, j.get('parent'))
+		except HeadMoved as e:
+			return jsonify({'head': e.head}), 409 # Conflict
 		except FileNotFoundError:
 			return jsonify({}), 404 # Not Found
+		except IsADirectoryError:
+			return jsonify({}), 403 # Forbidden
+		except PathConflict:
+			return jsonify({}), 409 # Conflict
+		finally:
+			for path in files:
+				tree_index.invalidate(basedir, path)
+				file_cache.invalidate(basedir + '/' + path)
+	else:
+		commit = r.index.commit(j['msg'], 
+			author=actor,
+			committer=actor)
+	maintainer.wrote(basedir)
+	update_ahead(r, basedir)
+
+	return jsonify({'commit': commit.hexsha,
+		'staged': changes(r, commit)}), 200 # OK
+
+@app.route(SERVER_PREFIX + '/metrics')
+def metrics():
+	"""
+		GET: Request and git metrics in the Prometheus text format: request
+			counts, latencies and in-flight requests per route (the name
+			of the view, e.g. file or status), git subprocess counts and
+			durations per command, bytes transferred by push and pull,
+			repository lock waits and timeouts and file cache hits,
+			misses and evictions.
+			Returns:
+				200 (OK) + metrics
+	"""
+	return Response(app_metrics.render(),
+		mimetype='text/plain; version=0.0.4') # OK
+
+def is_admin():
+	"""
+		Checks the X-Admin-Token header against ADMIN_TOKEN. Admin
+			endpoints are disabled while ADMIN_TOKEN is not set.
+	"""
+	token = app.config.get('ADMIN_TOKEN', None)
+	given = request.headers.get('X-Admin-Token', '')
+	return token is not None and \
+		hmac.compare_digest(given.encode('utf-8'), token.encode('utf-8'))
+
+@app.route(SERVER_PREFIX + '/admin/profile', methods=['POST'])
+def profile():
+	"""
+		POST: Samples the stacks of the threads handling requests in the
+			worker process serving this request, and returns how often
+			each stack was seen in the collapsed format of flamegraph.pl
+			('route;file:function;... count' per line, leaf last)
+			Header: X-Admin-Token: ADMIN_TOKEN
+			Query: seconds=10 to sample for (at most 300),
+				interval=0.01 seconds between samples,
+				route=status to only sample requests to that view,
+				repo=user/repo to only sample requests for that repo
+			Returns:
+				200 (OK) + stacks
+				400 (Bad Request; invalid query)
+				403 (Forbidden; no or wrong admin token)
+	"""
+	if not is_admin():
+		return jsonify({}), 403 # Forbidden
+
+	try:
+		seconds = float(request.args.get('seconds', 10))
+		interval = float(request.args.get('interval', 0.01))
+	except ValueError:
+		return jsonify({}), 400 # Bad request
+	if not 0 < seconds <= 300 or not 0 < interval <= seconds:
+		return jsonify({}), 400 # Bad request
+
+	stacks = profiler.sample(seconds, interval, request.args.get('route'),
+		request.args.get('repo'))
+	return Response(''.join('%s %d\n' % x for x in sorted(stacks.items())),
+		mimetype='text/plain') # OK
+
+@app.route(SERVER_PREFIX + '/admin/maintenance', methods=['GET', 'POST'])
+def admin_maintenance():
+	"""
+		Inspects and queues the background maintenance of repositories
+			(packing loose objects, repacking, commit-graph and
+			multi-pack-index) done by the worker process serving this
+			request
+		Header: X-Admin-Token: ADMIN_TOKEN
+		GET: Get the maintenance state of every repository written to
+			Query: repo=user/repo for that repository only, together with
+				statistics of its object store
+			Returns:
+				200 (OK) + JSON {'user/repo': state} e.g.
+					{'dcrn/test': {
+						'state': 'idle', 'queued' or 'running',
+						'writes': 12, # since it was last maintained
+						'last': {'started': 1428000000.0, 'auto': true,
+							'tasks': {'loose-objects': 0.2,
+								'commit-graph': 'error: ...'}}
+					}}
+					or for a repo {'state': ..., 'objects': {'count': 120,
+						'packs': 3, 'commit-graph': true, ...}}
+				403 (Forbidden; no or wrong admin token)
+				404 (Not Found)
+		POST: Queues maintenance of a repository
+			Query: repo=user/repo,
+				task=commit-graph to only run that task (repeatable) out
+					of loose-objects, incremental-repack, commit-graph and
+					pack-refs,
+				auto=1 to only run tasks git's thresholds say are needed
+			Returns:
+				202 (Accepted) + JSON state of the repository
+				400 (Bad Request; no repo or unknown task)
+				403 (Forbidden; no or wrong admin token)
+				404 (Not Found)
+	"""
+	if not is_admin():
+		return jsonify({}), 403 # Forbidden
+
+	root = app.config.get('STORAGE_ROOT')
+	repo = request.args.get('repo')
+	if repo is None:
+		if request.method == 'POST':
+			return jsonify({}), 400 # Bad request
+		return jsonify({os.path.relpath(k, root): v
+			for k, v in maintainer.status().items()})
+
+	repodir = file_path(root, repo)
+	if repodir is None or len(repo.split('/')) != 2:
+		return jsonify({}), 404 # Not Found
+	lock_repo(repodir)
+	try:
+		r = get_repo(repodir)
+	except (git.NoSuchPathError, git.InvalidGitRepositoryError):
+		return jsonify({}), 404 # Not Found
 
-	actor = git.Actor(j['name'] or '', j['email'] or '')
-	commit = r.index.commit(j['msg'], 
-		author=actor,
-		committer=actor)
+	if request.method == 'POST':
+		tasks = request.args.getlist('task')
+		if any(x not in maintenance.TASKS for x in tasks):
+			return jsonify({}), 400 # Bad request
+		auto = query_flag('auto')
+		return jsonify(maintainer.queue(repodir, tasks, auto)), 202 # Accepted
 
-	return jsonify({'commit': commit.hexsha}), 200 # OK
+	state = maintainer.status(repodir) or \
+		{'state': 'idle', 'writes': 0, 'last': None}
+	state['objects'] = maintenance.objects(r)
+	return jsonify(state)
 
 if __name__ == '__main__':
-	app.run(host='0.0.0.0', port=app.config.get('PORT', 8080))
+	if app.config.get('SERVER', 'development') == 'production':
+		import server
+		server.run(app)
+	else:
+		app.run(host='0.0.0.0', port=app.config.get('PORT', 8080))
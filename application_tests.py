@@ -1,4 +1,4 @@
-import application, json, unittest, time, random, string
+import application, gzip, json, unittest, time, random, string, git, os, shutil, tempfile, threading
 
 class StorageTestCase(unittest.TestCase):
 	def setUp(self):
@@ -10,6 +10,37 @@ class StorageTestCase(unittest.TestCase):
 		self.repository = 'test-repo'
 		self.access_token = 'c5a78551cb5c6a19d04b04bbd5fbee66ffe8e3c3'
 
+	def make_remote(self, files):
+		"""
+			Creates a local bare repository to use as a remote, with an
+				initial commit of files ({path: contents}) on master
+			Returns (remote URL, working copy used to push more commits)
+		"""
+		path = tempfile.mkdtemp()
+		self.addCleanup(shutil.rmtree, path, True)
+
+		git.Repo.init(path + '/remote.git', bare=True)
+		work = git.Repo.init(path + '/work')
+		work.create_remote('origin', 'file://' + path + '/remote.git')
+		self.commit_remote(work, files)
+
+		return 'file://' + path + '/remote.git', work
+
+	def commit_remote(self, work, files):
+		"""
+			Commits files ({path: contents}) in the working copy of a
+				remote made by make_remote and pushes them
+		"""
+		for f in files:
+			os.makedirs(os.path.dirname(work.working_dir + '/' + f), exist_ok=True)
+			with open(work.working_dir + '/' + f, 'w') as fh:
+				fh.write(files[f])
+		work.index.add([x for x in files])
+		actor = git.Actor('Unit Test', 'UnitTest@gmail.com')
+		work.index.commit('Unittest ' + time.strftime("%c"),
+			author=actor, committer=actor)
+		work.remotes.origin.push('HEAD:refs/heads/master')
+
 	def test_git_init_delete(self):
 		test_url = self.username + '/' + self.repository
 		test_remote = 'https://' + self.username + ':' + self.access_token + '@github.com/' + self.username + '/' + self.repository + '.git'
@@ -127,6 +158,81 @@ class StorageTestCase(unittest.TestCase):
 		re = self.app.delete(test_url_repo)
 		assert re.status_code == 200 # OK
 
+	def test_status_local(self):
+		test_file_a = 'subdir/hello world.txt'
+		test_file_b = 'README.md'
+		test_url_repo = self.username + '/' + self.repository
+		test_url_status = test_url_repo + '/status'
+		test_remote_url, work = self.make_remote({test_file_b: 'hello\n'})
+		empty = {'R': [], 'U': [], 'M': [], 'A': [], 'D': []}
+
+		# Delete if repo exists from failed tests
+		re = self.app.delete(test_url_repo)
+		assert re.status_code in [200, 404]
+
+		# Init local repo with a local remote
+		re = self.app.post(test_url_repo,
+			data=json.dumps({'origin': test_remote_url}))
+		assert re.status_code == 201 # Created
+
+		# Untracked files only before the first commit
+		re = self.app.post(test_url_repo + '/file/x.txt', data='{"data": "x"}')
+		re = self.app.get(test_url_status)
+		assert re.status_code == 200 # OK
+		assert json.loads(str(re.data, 'utf-8')) == {'U': ['x.txt']}
+		re = self.app.delete(test_url_repo + '/file/x.txt')
+
+		re = self.app.post(test_url_repo + '/pull/origin')
+		assert re.status_code == 200 # OK
+		re = self.app.get(test_url_status)
+		assert json.loads(str(re.data, 'utf-8')) == empty
+
+		# Caches are enabled for served repos
+		root = application.app.config.get('STORAGE_ROOT')
+		reader = git.Repo(root + '/' + test_url_repo).config_reader()
+		assert reader.get_value('core', 'untrackedCache') == True
+
+		# Untracked, modified and deleted files
+		re = self.app.post(test_url_repo + '/file/' + test_file_a,
+			data='{"data": "foo"}')
+		re = self.app.put(test_url_repo + '/file/' + test_file_b,
+			data='{"data": "foo"}')
+		re = self.app.get(test_url_status)
+		assert json.loads(str(re.data, 'utf-8')) == dict(empty,
+			U=[test_file_a], M=[{'A': test_file_b, 'B': test_file_b}])
+
+		re = self.app.delete(test_url_repo + '/file/' + test_file_b)
+		re = self.app.get(test_url_status)
+		assert json.loads(str(re.data, 'utf-8')) == dict(empty,
+			U=[test_file_a], D=[{'A': test_file_b}])
+
+		# The index can still be read for commits after status, even if
+		#	a split index was enabled before
+		r = git.Repo(application.app.config.get('STORAGE_ROOT') + '/' +
+			test_url_repo)
+		r.git.update_index('--split-index')
+		r.config_writer().set_value('core', 'splitIndex', 'true').release()
+		application.tuned_repos.clear()
+		re = self.app.get(test_url_status)
+		assert re.status_code == 200 # OK
+		re = self.app.post(test_url_repo + '/commit', data=json.dumps({
+				'A': [test_file_a], 'R': [], 'msg': 'Unittest',
+				'name': 'Unit Test', 'email': 'UnitTest@gmail.com'
+			}))
+		assert re.status_code == 200 # OK
+
+		# Staged renames and additions
+		changes = application.gitstatus.parse(
+			'2 R. N... 100644 100644 100644 abc abc R100 new name\0old\0'
+			'1 A. N... 000000 100644 100644 000 abc added\0'
+			'1 AD N... 000000 100644 000000 000 abc gone\0')
+		assert changes == dict(empty, R=[{'A': 'old', 'B': 'new name'}],
+			A=[{'B': 'added'}])
+
+		# Delete test repo
+		re = self.app.delete(test_url_repo)
+		assert re.status_code == 200 # OK
+
 	def test_git_commit(self):
 		test_file_a = 'subdir/hello.txt'
 		test_file_b = 'README.md'
@@ -348,6 +454,72 @@ class StorageTestCase(unittest.TestCase):
 		re = self.app.delete(test_url_repo)
 		assert re.status_code == 200 # OK
 		
+	def wait_job(self, url):
+		"""
+			Polls a job until it finishes, returns its final JSON
+		"""
+		for i in range(100):
+			re = self.app.get(url)
+			assert re.status_code == 200 # OK
+			j = json.loads(str(re.data, 'utf-8'))
+			if j['state'] in ['done', 'failed']:
+				return j
+			time.sleep(0.1)
+		assert False, 'Job did not finish'
+
+	def test_async_push_pull(self):
+		test_file = 'hello.txt'
+		test_url_repo = self.username + '/' + self.repository
+		test_remote_url, work = self.make_remote({'README.md': 'hello\n'})
+
+		# Delete if repo exists from failed tests
+		re = self.app.delete(test_url_repo)
+		assert re.status_code in [200, 404]
+
+		# Non-existant repo and remote are reported straight away
+		re = self.app.post(test_url_repo + '/pull/origin?async=1')
+		assert re.status_code == 404 # Not Found
+		re = self.app.post(test_url_repo,
+			data=json.dumps({'origin': test_remote_url}))
+		assert re.status_code == 201 # Created
+		re = self.app.post(test_url_repo + '/pull/upstream?async=1')
+		assert re.status_code == 403 # Forbidden
+
+		# Queue a pull and wait for it
+		re = self.app.post(test_url_repo + '/pull/origin?async=1')
+		assert re.status_code == 202 # Accepted
+		j = self.wait_job(re.headers['Location'])
+		assert j['type'] == 'pull' and j['state'] == 'done'
+		assert j['result']['status'] == 200
+
+		# Commit and queue a push
+		re = self.app.post(test_url_repo + '/file/' + test_file,
+			data='{"data": "foo"}')
+		re = self.app.post(test_url_repo + '/commit', data=json.dumps({
+				'A': [test_file], 'R': [], 'msg': 'Unittest',
+				'name': 'Unit Test', 'email': 'UnitTest@gmail.com'
+			}))
+		assert re.status_code == 200 # OK
+		head = json.loads(str(re.data, 'utf-8'))['commit']
+
+		re = self.app.post(test_url_repo + '/push/origin?async=1')
+		assert re.status_code == 202 # Accepted
+		job = json.loads(str(re.data, 'utf-8'))['job']
+		j = self.wait_job(test_url_repo + '/jobs/' + job)
+		assert j['state'] == 'done' and j['result']['status'] == 200
+
+		# Remote received the commit
+		work.remotes.origin.fetch()
+		assert work.remotes.origin.refs[0].commit.hexsha == head
+
+		# Jobs belong to their repository
+		re = self.app.get(self.username + '/other/jobs/' + job)
+		assert re.status_code == 404 # Not Found
+
+		# Delete test repo
+		re = self.app.delete(test_url_repo)
+		assert re.status_code == 200 # OK
+
 	def test_file(self):
 		test_file = 'test.txt'
 		test_data_a = 'Testing 123'
@@ -371,6 +543,12 @@ class StorageTestCase(unittest.TestCase):
 		re = self.app.post(test_url_file)
 		assert re.status_code == 400
 
+		# Or with data that isn't a string
+		for body in ['{"data": 5}', '{"data": null}', '"text"', '[1]']:
+			re = self.app.post(test_url_file, data=body)
+			assert re.status_code == 400 # Bad request
+			assert json.loads(str(re.data, 'utf-8')) == {}
+
 		# Create new file
 		re = self.app.post(test_url_file, 
 			data=json.dumps({'data':test_data_a}))
@@ -403,6 +581,1237 @@ class StorageTestCase(unittest.TestCase):
 		re = self.app.delete(test_url_repo)
 		assert re.status_code == 200 # OK
 
+	def test_file_raw(self):
+		test_file = 'blob.bin'
+		test_data = bytes(range(256)) * 4
+		test_url_repo = self.username + '/' + self.repository
+		test_url_file = test_url_repo + '/file/' + test_file
+
+		# Delete if repo exists from failed tests
+		re = self.app.delete(test_url_repo)
+		assert re.status_code in [200, 404]
+
+		# Init local testing repo
+		re = self.app.post(test_url_repo, data='{}')
+		assert re.status_code == 201 # Created
+
+		# Write binary data directly, JSON can't carry it
+		root = application.app.config.get('STORAGE_ROOT')
+		with open(root + '/' + test_url_file.replace('/file/', '/'), 'wb') as f:
+			f.write(test_data)
+
+		# Download the whole file
+		re = self.app.get(test_url_file + '?raw=1')
+		assert re.status_code == 200 # OK
+		assert re.headers['Accept-Ranges'] == 'bytes'
+		assert re.data == test_data
+
+		# Same using the Accept header
+		re = self.app.get(test_url_file,
+			headers={'Accept': 'application/octet-stream'})
+		assert re.status_code == 200 # OK
+		assert re.data == test_data
+
+		# Download a byte range
+		re = self.app.get(test_url_file + '?raw=1',
+			headers={'Range': 'bytes=10-19'})
+		assert re.status_code == 206 # Partial Content
+		assert re.headers['Content-Range'] == 'bytes 10-19/1024'
+		assert re.data == test_data[10:20]
+
+		# Suffix range
+		re = self.app.get(test_url_file + '?raw=1',
+			headers={'Range': 'bytes=-4'})
+		assert re.status_code == 206 # Partial Content
+		assert re.data == test_data[-4:]
+
+		# Range past the end of the file
+		re = self.app.get(test_url_file + '?raw=1',
+			headers={'Range': 'bytes=2000-'})
+		assert re.status_code == 416 # Range Not Satisfiable
+		assert re.headers['Content-Range'] == 'bytes */1024'
+
+		# Delete test repo
+		re = self.app.delete(test_url_repo)
+		assert re.status_code == 200 # OK
+
+	def test_file_upload(self):
+		test_file = 'upload/blob.bin'
+		test_data_a = bytes(range(256)) * 64
+		test_data_b = b'foobar'
+		test_url_repo = self.username + '/' + self.repository
+		test_url_file = test_url_repo + '/file/' + test_file
+		octet = 'application/octet-stream'
+
+		# Delete if repo exists from failed tests
+		re = self.app.delete(test_url_repo)
+		assert re.status_code in [200, 404]
+
+		# Init local testing repo
+		re = self.app.post(test_url_repo, data='{}')
+		assert re.status_code == 201 # Created
+
+		# Create file from a raw body
+		re = self.app.post(test_url_file, data=test_data_a, content_type=octet)
+		assert re.status_code == 201 # Created
+		re = self.app.get(test_url_file + '?raw=1')
+		assert re.data == test_data_a
+
+		# Creating it again conflicts
+		re = self.app.post(test_url_file + '?raw=1', data=test_data_b)
+		assert re.status_code == 409 # Conflict
+
+		# Update with a wrong checksum leaves the file untouched
+		re = self.app.put(test_url_file + '?raw=1', data=test_data_b,
+			headers={'X-Checksum': 'sha256=' + '0' * 64})
+		assert re.status_code == 400 # Bad request
+		re = self.app.get(test_url_file + '?raw=1')
+		assert re.data == test_data_a
+
+		# Update with the right checksum
+		digest = application.hashlib.sha256(test_data_b).hexdigest()
+		re = self.app.put(test_url_file + '?raw=1', data=test_data_b,
+			headers={'X-Checksum': 'sha256=' + digest})
+		assert re.status_code == 200 # OK
+		re = self.app.get(test_url_file + '?raw=1')
+		assert re.data == test_data_b
+
+		# No temporary files are left behind
+		re = self.app.get(test_url_repo + '/tree/upload')
+		assert json.loads(str(re.data, 'utf-8')) == {'blob.bin': True}
+
+		# Delete test repo
+		re = self.app.delete(test_url_repo)
+		assert re.status_code == 200 # OK
+
+	def test_batch(self):
+		test_url_repo = self.username + '/' + self.repository
+		test_url_batch = test_url_repo + '/batch'
+
+		# Delete if repo exists from failed tests
+		re = self.app.delete(test_url_repo)
+		assert re.status_code in [200, 404]
+
+		# Batch on non-existant repo
+		re = self.app.post(test_url_batch, data='[]')
+		assert re.status_code == 404 # Not Found
+
+		# Init local testing repo
+		re = self.app.post(test_url_repo, data='{}')
+		assert re.status_code == 201 # Created
+
+		# Invalid operations
+		re = self.app.post(test_url_batch, data=json.dumps([{'op': 'x'}]))
+		assert re.status_code == 400 # Bad request
+
+		re = self.app.post(test_url_batch, data=json.dumps([
+				{'op': 'create', 'path': 'a.txt', 'data': 'foo'},
+				{'op': 'create', 'path': 'dir/b.txt', 'data': 'bar'},
+				{'op': 'create', 'path': 'a.txt', 'data': 'foo'},
+				{'op': 'update', 'path': 'a.txt', 'data': 'baz'},
+				{'op': 'update', 'path': 'c.txt', 'data': 'baz'},
+				{'op': 'create', 'path': 'd.txt'},
+				{'op': 'read', 'path': 'a.txt'},
+				{'op': 'read', 'path': '../other/a.txt'},
+				{'op': 'delete', 'path': 'dir/b.txt'},
+				{'op': 'read', 'path': 'dir/b.txt'}
+			]))
+		assert re.status_code == 200 # OK
+		results = [json.loads(x) for x in str(re.data, 'utf-8').splitlines()]
+		assert [x['index'] for x in results] == [x for x in range(10)]
+		assert [x['status'] for x in results] == [
+			201, 201, 409, 200, 404, 400, 200, 403, 200, 404]
+		assert results[6]['data'] == 'baz'
+
+		# Delete test repo
+		re = self.app.delete(test_url_repo)
+		assert re.status_code == 200 # OK
+
+	def test_list_ahead_behind(self):
+		test_url_list = '/' + self.username + '?behind=1'
+		test_url_repo = self.username + '/' + self.repository
+		test_remote_url, work = self.make_remote({'README.md': 'hello\n'})
+
+		# Delete if repo exists from failed tests
+		re = self.app.delete(test_url_repo)
+		assert re.status_code in [200, 404]
+
+		# Init local repo with a local remote and pull it
+		re = self.app.post(test_url_repo,
+			data=json.dumps({'origin': test_remote_url}))
+		assert re.status_code == 201 # Created
+
+		# No commits yet
+		re = self.app.get(test_url_list)
+		assert json.loads(str(re.data, 'utf-8'))[self.repository] == {
+			'ahead': 0, 'behind': 0}
+
+		re = self.app.post(test_url_repo + '/pull/origin')
+		assert re.status_code == 200 # OK
+
+		# Commit locally, one ahead
+		re = self.app.post(test_url_repo + '/file/a.txt', data='{"data": "a"}')
+		assert re.status_code == 201 # Created
+		re = self.app.post(test_url_repo + '/commit', data=json.dumps({
+				'A': ['a.txt'], 'R': [], 'msg': 'Unittest',
+				'name': 'Unit Test', 'email': 'UnitTest@gmail.com'
+			}))
+		assert re.status_code == 200 # OK
+
+		# Commit on the remote and fetch it, one behind
+		self.commit_remote(work, {'b.txt': 'b'})
+		root = application.app.config.get('STORAGE_ROOT')
+		git.Repo(root + '/' + test_url_repo).remotes.origin.fetch()
+
+		re = self.app.get(test_url_list)
+		assert re.status_code == 200 # OK
+		assert json.loads(str(re.data, 'utf-8'))[self.repository] == {
+			'ahead': 1, 'behind': 1}
+		re = self.app.get('/' + self.username)
+		assert json.loads(str(re.data, 'utf-8'))[self.repository] == 1
+
+		# Delete test repo
+		re = self.app.delete(test_url_repo)
+		assert re.status_code == 200 # OK
+
+	def test_ahead_cache(self):
+		test_url_list = '/' + self.username + '?behind=1'
+		test_url_repo = self.username + '/' + self.repository
+		test_remote_url, work = self.make_remote({'README.md': 'hello\n'})
+		repodir = application.app.config.get('STORAGE_ROOT') + '/' + test_url_repo
+
+		# Delete if repo exists from failed tests
+		re = self.app.delete(test_url_repo)
+		assert re.status_code in [200, 404]
+
+		# Init and pull local repo, pull updates the cached counts
+		re = self.app.post(test_url_repo,
+			data=json.dumps({'origin': test_remote_url}))
+		assert re.status_code == 201 # Created
+		re = self.app.post(test_url_repo + '/pull/origin')
+		assert re.status_code == 200 # OK
+		key = application.ahead_cache.key(repodir)
+		assert key[0] == 'origin' and key[1] == key[2]
+		assert application.ahead_cache.get(repodir, key) == (0, 0)
+
+		# Counts survive a restart
+		cache = application.AheadCache(application.ahead_cache.path)
+		assert cache.get(repodir, key) == (0, 0)
+
+		# Fetching outside of the API changes the key, so counts are redone
+		self.commit_remote(work, {'b.txt': 'b'})
+		git.Repo(repodir).remotes.origin.fetch()
+		assert application.ahead_cache.key(repodir) != key
+		re = self.app.get(test_url_list)
+		assert json.loads(str(re.data, 'utf-8'))[self.repository] == {
+			'ahead': 0, 'behind': 1}
+
+		# Delete test repo, which drops its counts
+		re = self.app.delete(test_url_repo)
+		assert re.status_code == 200 # OK
+		assert repodir not in application.ahead_cache.entries
+
+	def test_prefetch(self):
+		test_url_list = '/' + self.username + '?behind=1'
+		test_url_repo = self.username + '/' + self.repository
+		test_remote_url, work = self.make_remote({'README.md': 'hello\n'})
+		repodir = application.app.config.get('STORAGE_ROOT') + '/' + test_url_repo
+
+		# Delete if repo exists from failed tests
+		re = self.app.delete(test_url_repo)
+		assert re.status_code in [200, 404]
+		re = self.app.post(test_url_repo,
+			data=json.dumps({'origin': test_remote_url}))
+		assert re.status_code == 201 # Created
+		r = git.Repo(repodir)
+
+		# Nothing is fetched before the first pull, which may be shallow
+		application.prefetch_repo(repodir)
+		assert r.git.for_each_ref('refs/prefetch') == ''
+
+		re = self.app.post(test_url_repo + '/pull/origin')
+		assert re.status_code == 200 # OK
+		tracking = r.remotes.origin.refs[0].commit.hexsha
+
+		# Prefetches wait for changes to the repository
+		locks = application.repo_locks
+		timeout = locks.timeout
+		locks.timeout = 0.1
+		token = locks.acquire(repodir, True)
+		try:
+			with self.assertRaises(application.LockTimeout):
+				application.prefetch_repo(repodir)
+		finally:
+			locks.release(token)
+			locks.timeout = timeout
+
+		# Prefetching leaves the refs the user sees alone, but is counted
+		self.commit_remote(work, {'b.txt': 'b'})
+		application.prefetch_repo(repodir)
+		assert r.remotes.origin.refs[0].commit.hexsha == tracking
+		assert r.git.rev_parse('refs/prefetch/remotes/origin/master') == \
+			work.head.commit.hexsha
+		re = self.app.get(test_url_list)
+		assert json.loads(str(re.data, 'utf-8'))[self.repository] == {
+			'ahead': 0, 'behind': 1}
+
+		# Pulling merges what was fetched, the prefetched refs are dropped
+		re = self.app.post(test_url_repo + '/pull/origin')
+		assert re.status_code == 200 # OK
+		assert r.head.commit.hexsha == work.head.commit.hexsha
+		assert r.git.for_each_ref('refs/prefetch') == ''
+		re = self.app.get(test_url_list)
+		assert json.loads(str(re.data, 'utf-8'))[self.repository] == {
+			'ahead': 0, 'behind': 0}
+
+		re = self.app.delete(test_url_repo)
+		assert re.status_code == 200 # OK
+
+		# The scheduler prefetches used repos, at most 'workers' at a time,
+		#	and backs off after failures
+		path = tempfile.mkdtemp()
+		self.addCleanup(shutil.rmtree, path, True)
+		for x in 'abc':
+			os.makedirs(path + '/' + x + '/.git')
+		lock = threading.Lock()
+		running = []
+		seen = []
+
+		def fetch(p):
+			with lock:
+				running.append(p)
+				seen.append((p, len(running)))
+			time.sleep(0.05)
+			with lock:
+				running.remove(p)
+			if p.endswith('c'):
+				raise git.GitCommandError(['git', 'fetch'], 128)
+
+		p = application.prefetch.Prefetcher(fetch, 2, 0.01, 10)
+		for x in 'abc':
+			p.touch(path + '/' + x)
+		for i in range(100):
+			if len(seen) >= 3:
+				break
+			time.sleep(0.02)
+		assert set(x[0] for x in seen) >= set(path + '/' + x for x in 'abc')
+		assert max(x[1] for x in seen) <= 2
+		time.sleep(0.05)
+		a, c = p.repos[path + '/a'], p.repos[path + '/c']
+		assert a[2] == 0 and c[2] >= 1
+		assert p.next_interval([time.time(), 0, 0], time.time()) == 0.01
+		assert p.next_interval([time.time() - 5, 0, 0], time.time()) >= 5
+		assert p.next_interval([time.time(), 0, 3], time.time()) == 0.08
+
+	def test_git_backends(self):
+		test_url_repo = self.username + '/' + self.repository
+		test_remote_url, work = self.make_remote({'README.md': 'hello\n'})
+		self.commit_remote(work, {'a.txt': 'a'})
+		repodir = application.app.config.get('STORAGE_ROOT') + '/' + test_url_repo
+
+		# Delete if repo exists from failed tests
+		re = self.app.delete(test_url_repo)
+		assert re.status_code in [200, 404]
+		re = self.app.post(test_url_repo + '?depth=1',
+			data=json.dumps({'origin': test_remote_url}))
+		assert re.status_code == 201 # Created
+		r = git.Repo(repodir)
+		backends = [application.gitbackend.get(x)
+			for x in ['cli', 'python', 'pygit2']]
+		for b in backends:
+			assert b.head(r) is None
+			assert b.status(r)['U'] == []
+
+		# Shallow, with diverged history on both sides
+		re = self.app.post(test_url_repo + '/pull/origin')
+		assert re.status_code == 200 # OK
+		re = self.app.post(test_url_repo + '/commit', data=json.dumps({
+			'msg': 'Local', 'files': {'b.txt': 'b'}}))
+		assert re.status_code == 200 # OK
+		self.commit_remote(work, {'a.txt': 'a2'})
+		self.commit_remote(work, {'a.txt': 'a3'})
+		r.remotes.origin.fetch()
+		for b in backends:
+			assert b.head(r) == r.head.commit.hexsha
+			assert b.ahead_behind(r, 'HEAD', 'refs/remotes/origin/master') == \
+				(1, 2)
+			assert b.ahead_behind(r, 'HEAD', 'origin/master') == (1, 2)
+			assert b.ahead_behind(r, 'HEAD', 'origin/nothing') is None
+
+		with self.assertRaises(ValueError):
+			application.gitbackend.get('nothing')
+
+		# Counts match git's when commits are dated before their parents,
+		#	with part of the history in a commit-graph or none of it
+		path = tempfile.mkdtemp()
+		self.addCleanup(shutil.rmtree, path, True)
+		r = git.Repo.init(path)
+		rnd = random.Random(6)
+		shas = []
+		for i in range(60):
+			parents = rnd.sample(shas[-10:], min(len(shas), rnd.choice([1, 1, 2])))
+			when = 1500000000 + i * 60 + rnd.choice([0, 0, -86400, 86400])
+			with r.git.custom_environment(GIT_AUTHOR_NAME='a',
+					GIT_AUTHOR_EMAIL='a@b', GIT_COMMITTER_NAME='a',
+					GIT_COMMITTER_EMAIL='a@b', GIT_COMMITTER_DATE='%d +0000' % when):
+				shas.append(r.git.commit_tree(
+					sum([['-p', x] for x in parents], []) +
+					['-m', str(i), '4b825dc642cb6eb9a060e54bf8d69288fbee4904']))
+		pairs = [rnd.sample(shas, 2) for i in range(100)]
+		cli, python = backends[0], backends[1]
+		for graph in [None, shas[30]]:
+			if graph is not None:
+				with tempfile.TemporaryFile() as f:
+					f.write(graph.encode('ascii'))
+					f.seek(0)
+					r.git.commit_graph('write', '--stdin-commits', istream=f)
+			for a, b in pairs:
+				assert python.ahead_behind(r, a, b) == cli.ahead_behind(r, a, b)
+
+		re = self.app.delete(test_url_repo)
+		assert re.status_code == 200 # OK
+
+	def test_diff(self):
+		test_url_repo = self.username + '/' + self.repository
+		repodir = application.app.config.get('STORAGE_ROOT') + '/' + test_url_repo
+
+		# Delete if repo exists from failed tests
+		re = self.app.delete(test_url_repo)
+		assert re.status_code in [200, 404]
+		re = self.app.post(test_url_repo, data='{}')
+		assert re.status_code == 201 # Created
+
+		# Everything staged is new before the first commit
+		r = git.Repo(repodir)
+		with open(repodir + '/old.txt', 'w') as f:
+			f.write('old\n')
+		r.index.add(['old.txt'])
+		re = self.app.get(test_url_repo + '/diff')
+		assert re.status_code == 200 # OK
+		assert re.data.decode('utf-8') == 'diff --git a/old.txt b/old.txt\n' \
+			'new file mode 100644\n' \
+			'index 0000000000000000000000000000000000000000..' + \
+			r.git.hash_object('old.txt') + '\n--- /dev/null\n+++ b/old.txt\n' \
+			'@@ -0,0 +1 @@\n+old\n'
+
+		re = self.app.post(test_url_repo + '/commit', data=json.dumps({
+			'msg': 'First', 'files': {'a.txt': 'one\ntwo\n', 'dir/b.txt': 'b\n'}}))
+		assert re.status_code == 200 # OK
+		first = json.loads(re.data.decode('utf-8'))['commit']
+		re = self.app.get(test_url_repo + '/diff?from=' + first + '&to=' + first)
+		assert re.status_code == 200 # OK
+		assert re.data == b''
+
+		# The same patch as git's for the working directory
+		with open(repodir + '/a.txt', 'w') as f:
+			f.write('one\nthree\n')
+		with open(repodir + '/new.bin', 'wb') as f:
+			f.write(b'\0\1\2')
+		r.index.add(['new.bin'])
+		os.remove(repodir + '/old.txt')
+		re = self.app.get(test_url_repo + '/diff')
+		assert re.status_code == 200 # OK
+		assert re.mimetype == 'text/x-diff'
+		expected = r.git.diff('--full-index', 'HEAD') + '\n'
+		assert re.data.decode('utf-8') == expected
+		assert b'Binary files /dev/null and b/new.bin differ' in re.data
+
+		# Repeated diffs come from the cache, or not at all
+		hits = application.diff_cache.hits
+		etag = re.headers['ETag']
+		re = self.app.get(test_url_repo + '/diff')
+		assert re.data.decode('utf-8') == expected
+		assert application.diff_cache.hits == hits + 3
+		re = self.app.get(test_url_repo + '/diff',
+			headers={'If-None-Match': etag})
+		assert re.status_code == 304 # Not modified
+
+		# Limited to a path, with more context, or between commits
+		re = self.app.get(test_url_repo + '/diff/a.txt?context=0')
+		assert re.data.decode('utf-8') == \
+			r.git.diff('--full-index', '-U0', 'HEAD', '--', 'a.txt') + '\n'
+		re = self.app.get(test_url_repo + '/diff/dir')
+		assert re.status_code == 200 # OK
+		assert re.data == b''
+		re = self.app.get(test_url_repo + '/diff/dir?from=' + first + '&to=' +
+			first)
+		assert re.status_code == 200 # OK
+		re = self.app.get(test_url_repo + '/diff/nothing.txt')
+		assert re.status_code == 404 # Not found
+		re = self.app.get(test_url_repo + '/diff/a.txt/x?from=' + first +
+			'&to=' + first)
+		assert re.status_code == 404 # Not found
+		re = self.app.post(test_url_repo + '/commit', data=json.dumps({
+			'msg': 'Second', 'files': {'dir/b.txt': 'c\n'}}))
+		second = json.loads(re.data.decode('utf-8'))['commit']
+		re = self.app.get(test_url_repo + '/diff?from=' + first + '&to=' + second)
+		assert re.data.decode('utf-8') == \
+			r.git.diff('--full-index', first, second) + '\n'
+
+		# Files over the size limit are left out
+		max_size = application.app.config.get('DIFF_MAX_FILE_SIZE')
+		application.app.config['DIFF_MAX_FILE_SIZE'] = 4
+		try:
+			re = self.app.get(test_url_repo + '/diff/a.txt')
+		finally:
+			application.app.config['DIFF_MAX_FILE_SIZE'] = max_size
+		assert b'File a/a.txt and b/a.txt are too large to diff (10 bytes)' \
+			in re.data
+		assert b'@@' not in re.data
+
+		re = self.app.get(test_url_repo + '/diff?context=x')
+		assert re.status_code == 400 # Bad request
+		re = self.app.get(test_url_repo + '/diff?from=--output=x')
+		assert re.status_code == 400 # Bad request
+		re = self.app.get(test_url_repo + '/diff?from=nothing')
+		assert re.status_code == 404 # Not found
+
+		re = self.app.delete(test_url_repo)
+		assert re.status_code == 200 # OK
+
+	def test_repo_locks(self):
+		test_url_repo = self.username + '/' + self.repository
+		repodir = application.app.config.get('STORAGE_ROOT') + '/' + test_url_repo
+		locks = application.repo_locks
+
+		# Delete if repo exists from failed tests
+		re = self.app.delete(test_url_repo)
+		assert re.status_code in [200, 404]
+		re = self.app.post(test_url_repo, data='{}')
+		assert re.status_code == 201 # Created
+
+		# Reads share the lock, changes time out behind them
+		timeout = locks.timeout
+		locks.timeout = 0.1
+		try:
+			token = locks.acquire(repodir)
+			re = self.app.get(test_url_repo + '/status')
+			assert re.status_code == 200 # OK
+			re = self.app.post(test_url_repo + '/file/a.txt', data='{"data": ""}')
+			assert re.status_code == 503 # Service unavailable
+			locks.release(token)
+
+			# Readers queue behind a waiting writer
+			token = locks.acquire(repodir)
+			order = []
+			def writer():
+				t = locks.acquire(repodir, True)
+				order.append('writer')
+				locks.release(t)
+			locks.timeout = 5
+			t = threading.Thread(target=writer)
+			t.start()
+			while not locks.locks[repodir].queue:
+				time.sleep(0.01)
+			locks.timeout = 0.1
+			self.assertRaises(application.LockTimeout, locks.acquire, repodir)
+			locks.release(token)
+			t.join()
+			assert order == ['writer']
+		finally:
+			locks.timeout = timeout
+
+		assert locks.stats['exclusive']['timeouts'] >= 1
+		assert repodir not in locks.locks
+
+		# Delete test repo
+		re = self.app.delete(test_url_repo)
+		assert re.status_code == 200 # OK
+
+	def test_shared_state(self):
+		path = tempfile.mkdtemp()
+		self.addCleanup(shutil.rmtree, path, True)
+
+		# Jobs can be looked up by other processes using the same directory
+		queue = application.JobQueue(1, 60, path + '/jobs')
+		job = queue.submit('push', 'repo', lambda job: {'status': 200})
+		other = application.JobQueue(1, 60, path + '/jobs')
+		for i in range(100):
+			if other.get(job.id).state == 'done':
+				break
+			time.sleep(0.01)
+		assert other.get(job.id).to_dict() == job.to_dict()
+		assert other.get(job.id).key == 'repo'
+		assert other.get('../' + job.id) is None
+
+		# File locks exclude holders using another lock manager
+		a = application.LockManager(0.1, path + '/locks')
+		b = application.LockManager(0.1, path + '/locks')
+		token = a.acquire('repo')
+		b.release(b.acquire('repo'))
+		self.assertRaises(application.LockTimeout, b.acquire, 'repo', True)
+		a.release(token)
+		b.release(b.acquire('repo', True))
+
+		# Oversized bodies are rejected before being read
+		limit = application.app.config.get('MAX_CONTENT_LENGTH')
+		application.app.config['MAX_CONTENT_LENGTH'] = 4
+		try:
+			re = self.app.post(self.username + '/' + self.repository +
+				'/file/big.txt?raw=1', data=b'12345')
+			assert re.status_code == 413 # Request entity too large
+		finally:
+			application.app.config['MAX_CONTENT_LENGTH'] = limit
+
+	def test_etags(self):
+		test_data = 'etag test\n'
+		test_url_repo = self.username + '/' + self.repository
+		test_url_file = test_url_repo + '/file/etag.txt'
+
+		# Delete if repo exists from failed tests
+		re = self.app.delete(test_url_repo)
+		assert re.status_code in [200, 404]
+
+		re = self.app.post(test_url_repo, data='{}')
+		assert re.status_code == 201 # Created
+		re = self.app.post(test_url_file, data=json.dumps({'data': test_data}))
+		assert re.status_code == 201 # Created
+
+		# JSON reads are tagged with the git blob id
+		re = self.app.get(test_url_file)
+		assert re.status_code == 200 # OK
+		etag = re.headers['ETag']
+		r = git.Repo(application.app.config.get('STORAGE_ROOT') + '/' +
+			test_url_repo)
+		blob = r.git.hash_object(r.working_tree_dir + '/etag.txt')
+		assert etag == '"' + blob + '"'
+
+		# Unchanged resources aren't sent again
+		re = self.app.get(test_url_file, headers={'If-None-Match': etag})
+		assert re.status_code == 304 # Not modified
+		re = self.app.get(test_url_file + '?raw=1')
+		re = self.app.get(test_url_file + '?raw=1',
+			headers={'If-None-Match': re.headers['ETag']})
+		assert re.status_code == 304 # Not modified
+		for url in [test_url_repo + '/status', test_url_repo + '/tree']:
+			re = self.app.get(url)
+			assert re.status_code == 200 # OK
+			re = self.app.get(url, headers={'If-None-Match': re.headers['ETag']})
+			assert re.status_code == 304 # Not modified
+
+		# Updates only apply to the version the client has seen
+		re = self.app.put(test_url_file, data=json.dumps({'data': 'a'}),
+			headers={'If-Match': '"0000"'})
+		assert re.status_code == 412 # Precondition failed
+		re = self.app.put(test_url_file, data=json.dumps({'data': 'b'}),
+			headers={'If-Match': etag})
+		assert re.status_code == 200 # OK
+		re = self.app.put(test_url_file, data=json.dumps({'data': 'c'}),
+			headers={'If-Match': etag})
+		assert re.status_code == 412 # Precondition failed
+
+		# The tag changes with the contents
+		re = self.app.get(test_url_file)
+		assert json.loads(str(re.data, 'utf-8'))['data'] == 'b'
+		assert re.headers['ETag'] != etag
+
+		re = self.app.delete(test_url_repo)
+		assert re.status_code == 200 # OK
+
+	def test_compression(self):
+		test_data = 'compress me\n' * 1000
+		test_url_repo = self.username + '/' + self.repository
+		test_url_file = test_url_repo + '/file/big.txt'
+		gz = {'Accept-Encoding': 'gzip'}
+
+		# Delete if repo exists from failed tests
+		re = self.app.delete(test_url_repo)
+		assert re.status_code in [200, 404]
+
+		re = self.app.post(test_url_repo, data='{}')
+		assert re.status_code == 201 # Created
+		re = self.app.post(test_url_file, data=json.dumps({'data': test_data}))
+		assert re.status_code == 201 # Created
+
+		# Not compressed unless asked for
+		re = self.app.get(test_url_file)
+		assert 'Content-Encoding' not in re.headers
+		assert 'Accept-Encoding' in re.headers['Vary']
+
+		# JSON is compressed and tagged weakly, then served from the cache
+		hits = application.compressor.hits
+		for i in range(2):
+			re = self.app.get(test_url_file, headers=gz)
+			assert re.status_code == 200 # OK
+			assert re.headers['Content-Encoding'] == 'gzip'
+			assert len(re.data) < len(test_data) / 10
+			j = json.loads(str(gzip.decompress(re.data), 'utf-8'))
+			assert j['data'] == test_data
+		assert application.compressor.hits == hits + 1
+		etag = re.headers['ETag']
+		assert etag.startswith('W/')
+
+		# Weak tags still work for conditional requests
+		re = self.app.get(test_url_file, headers={'If-None-Match': etag,
+			'Accept-Encoding': 'gzip'})
+		assert re.status_code == 304 # Not modified
+
+		# Streamed raw downloads are compressed too
+		re = self.app.get(test_url_file + '?raw=1', headers=gz)
+		assert re.headers['Content-Encoding'] == 'gzip'
+		assert 'Accept-Ranges' not in re.headers
+		assert gzip.decompress(re.data) == test_data.encode('utf-8')
+
+		# Except large files, which keep their length and byte ranges
+		max_file_size = application.compressor.max_file_size
+		application.compressor.max_file_size = len(test_data) - 1
+		try:
+			re = self.app.get(test_url_file + '?raw=1', headers=gz)
+		finally:
+			application.compressor.max_file_size = max_file_size
+		assert 'Content-Encoding' not in re.headers
+		assert re.headers['Content-Length'] == str(len(test_data))
+		assert re.headers['Accept-Ranges'] == 'bytes'
+		assert re.data == test_data.encode('utf-8')
+
+		# Small responses and clients refusing gzip get the original
+		re = self.app.get(test_url_repo + '/status', headers=gz)
+		assert 'Content-Encoding' not in re.headers
+		re = self.app.get(test_url_file,
+			headers={'Accept-Encoding': 'gzip;q=0, identity'})
+		assert 'Content-Encoding' not in re.headers
+
+		re = self.app.put(test_url_file, data=json.dumps({'data': 'x'}),
+			headers={'If-Match': etag})
+		assert re.status_code == 200 # OK
+
+		re = self.app.delete(test_url_repo)
+		assert re.status_code == 200 # OK
+
+	def test_file_cache(self):
+		test_url_repo = self.username + '/' + self.repository
+		test_url_file = test_url_repo + '/file/cached.txt'
+		root = application.app.config.get('STORAGE_ROOT')
+
+		# Delete if repo exists from failed tests
+		re = self.app.delete(test_url_repo)
+		assert re.status_code in [200, 404]
+
+		re = self.app.post(test_url_repo, data='{}')
+		assert re.status_code == 201 # Created
+		re = self.app.post(test_url_file, data=json.dumps({'data': 'one'}))
+		assert re.status_code == 201 # Created
+		time.sleep(0.1) # Recently modified files aren't cached
+
+		# Repeated reads are served from memory
+		hits = application.file_cache.hits
+		for i in range(3):
+			re = self.app.get(test_url_file)
+			assert json.loads(str(re.data, 'utf-8'))['data'] == 'one'
+		assert application.file_cache.hits == hits + 2
+
+		# Writes through the API are seen immediately
+		re = self.app.put(test_url_file, data=json.dumps({'data': 'two'}))
+		assert re.status_code == 200 # OK
+		re = self.app.get(test_url_file)
+		assert json.loads(str(re.data, 'utf-8'))['data'] == 'two'
+
+		# So are writes by anything else
+		with open(root + '/' + test_url_repo + '/cached.txt', 'w') as f:
+			f.write('three')
+		re = self.app.get(test_url_file)
+		assert json.loads(str(re.data, 'utf-8'))['data'] == 'three'
+
+		re = self.app.delete(test_url_repo)
+		assert re.status_code == 200 # OK
+
+		# Least recently used files are evicted beyond the byte budget
+		path = tempfile.mkdtemp()
+		self.addCleanup(shutil.rmtree, path, True)
+		for i in range(20):
+			with open(path + '/%d.txt' % i, 'w') as f:
+				f.write('x' * 10)
+		time.sleep(0.1)
+		cache = application.FileCache(160)
+		for i in range(20):
+			assert cache.read(path + '/%d.txt' % i, len) == 10
+		assert cache.used == 160 and cache.evictions == 4
+		assert cache.read(path + '/19.txt', len) == 10
+		assert cache.read(path + '/0.txt', len) == 10
+		assert cache.hits == 1 and cache.misses == 21
+		cache.invalidate(path)
+		assert cache.used == 0 and not cache.entries
+
+	def test_metrics(self):
+		test_url_repo = self.username + '/' + self.repository
+		test_remote_url, work = self.make_remote({'README.md': 'x' * 4096})
+
+		# Delete if repo exists from failed tests
+		re = self.app.delete(test_url_repo)
+		assert re.status_code in [200, 404]
+
+		def metrics():
+			re = self.app.get('/.storage/metrics')
+			assert re.status_code == 200 # OK
+			assert re.mimetype == 'text/plain'
+			values = {}
+			for line in str(re.data, 'utf-8').splitlines():
+				if not line.startswith('#'):
+					name, value = line.rsplit(' ', 1)
+					values[name] = float(value)
+			return values
+
+		# Metrics saved by earlier runs may be added in, so count changes
+		pulled = 'git_transfer_bytes_total{operation="pull"}'
+		before = metrics()
+
+		re = self.app.post(test_url_repo,
+			data=json.dumps({'origin': test_remote_url}))
+		assert re.status_code == 201 # Created
+		re = self.app.post(test_url_repo + '/pull/origin')
+		assert re.status_code == 200 # OK
+		re = self.app.get(test_url_repo + '/status')
+		assert re.status_code == 200 # OK
+
+		# Small fetches are unpacked into loose objects as usual, and still
+		#	measured (below)
+		r = git.Repo(application.app.config.get('STORAGE_ROOT') + '/' +
+			test_url_repo)
+		assert application.maintenance.objects(r)['packs'] == 0
+
+		values = metrics()
+		assert values['http_requests_in_flight{route="metrics"}'] >= 1
+		for name in ['http_requests_total{route="pull",method="POST",'
+					'status="200"}',
+				'http_request_duration_seconds_count{route="status"}',
+				'git_commands_total{command="status",result="ok"}',
+				'git_command_duration_seconds_count{command="fetch"}', pulled,
+				'repo_lock_wait_seconds_count{mode="exclusive"}',
+				'repo_lock_wait_seconds_count{mode="shared"}']:
+			assert values[name] > before.get(name, 0), name
+
+		re = self.app.delete(test_url_repo)
+		assert re.status_code == 200 # OK
+
+		# Values saved by other processes are added up, except for gauges
+		#	of processes that have exited
+		path = tempfile.mkdtemp()
+		self.addCleanup(shutil.rmtree, path, True)
+		m = application.Metrics(path)
+		m.request_started('file')
+		m.request_finished('file', 'GET', 200, 0.2)
+		m.request_started('file')
+		other = {'http_requests_total': {
+				'route="file",method="GET",status="200"': 2},
+			'http_requests_in_flight': {'route="file"': 5}}
+		with open(path + '/1000000000.json', 'w') as f:
+			json.dump({'pid': 1000000000, 'values': other}, f)
+		text = m.render()
+		assert 'http_requests_total{route="file",method="GET",status="200"} 3' \
+			in text.splitlines()
+		assert 'http_requests_in_flight{route="file"} 1' in text.splitlines()
+		assert 'http_request_duration_seconds_bucket{route="file",le="0.1"} 0' \
+			in text.splitlines()
+		assert 'http_request_duration_seconds_bucket{route="file",le="0.25"} 1' \
+			in text.splitlines()
+
+		# Lock timeouts and file cache events are counted
+		m = application.Metrics()
+		locks = application.LockManager(0.1, None, m.lock_waited)
+		token = locks.acquire('x', True)
+		self.assertRaises(application.LockTimeout, locks.acquire, 'x')
+		locks.release(token)
+		cache = application.FileCache(16, m.file_cache)
+		for i in range(17):
+			with open('%s/%d' % (path, i), 'wb') as f:
+				f.write(b'x')
+			os.utime('%s/%d' % (path, i), (0, 0))
+			cache.read('%s/%d' % (path, i), bytes)
+		cache.read(path + '/16', bytes)
+		lines = m.render().splitlines()
+		assert 'repo_lock_wait_seconds_count{mode="exclusive"} 1' in lines
+		assert 'repo_lock_timeouts_total{mode="shared"} 1' in lines
+		assert 'file_cache_hits_total 1' in lines
+		assert 'file_cache_misses_total 17' in lines
+		assert 'file_cache_evictions_total 1' in lines
+
+	def test_profiling(self):
+		test_url_repo = self.username + '/' + self.repository
+
+		# Delete if repo exists from failed tests
+		re = self.app.delete(test_url_repo)
+		assert re.status_code in [200, 404]
+		re = self.app.post(test_url_repo, data='{}')
+		assert re.status_code == 201 # Created
+
+		# Slow requests are logged with where the time went
+		threshold = application.app.config.get('SLOW_REQUEST_THRESHOLD')
+		application.app.config['SLOW_REQUEST_THRESHOLD'] = 0
+		try:
+			with self.assertLogs(application.app.logger, 'WARNING') as logs:
+				re = self.app.get(test_url_repo + '/status')
+				assert re.status_code == 200 # OK
+		finally:
+			application.app.config['SLOW_REQUEST_THRESHOLD'] = threshold
+		assert 'GET /' + test_url_repo + '/status 200' in logs.output[0]
+		assert '(status ' in logs.output[0] and 'serialize' in logs.output[0]
+
+		re = self.app.delete(test_url_repo)
+		assert re.status_code == 200 # OK
+
+		# Stacks are only sampled for requests, filtered by route
+		done = threading.Event()
+		def busy():
+			while not done.is_set():
+				time.sleep(0.001)
+		def handle(route):
+			application.profiler.start(route, test_url_repo)
+			busy()
+			application.profiler.finish()
+		threads = [threading.Thread(target=handle, args=(x,))
+			for x in ['status', 'tree']]
+		for t in threads:
+			t.start()
+		try:
+			stacks = application.profiler.sample(0.1, 0.005, 'status')
+		finally:
+			done.set()
+			for t in threads:
+				t.join()
+		assert stacks
+		assert all(x.startswith('status;') for x in stacks)
+		assert any(x.endswith('application_tests.py:busy') for x in stacks)
+
+		# The server's endpoints leave every user and repository name free,
+		#	and names starting with a dot are kept for them
+		for url in ['admin/maintenance', 'admin/profile', 'metrics/x']:
+			re = self.app.post(url, data='{}')
+			assert re.status_code == 201 # Created
+			re = self.app.delete(url)
+			assert re.status_code == 200 # OK
+		re = self.app.get('/metrics')
+		assert re.mimetype == 'application/json' # The user's repositories
+		for url in ['.storage', '.storage/x', 'x/.git', 'dcrn/.x/tree']:
+			re = self.app.post(url, data='{}')
+			assert re.status_code in [404, 405]
+			re = self.app.get(url)
+			assert re.status_code == 404 # Not found
+
+		# The admin endpoint needs the token
+		token = application.app.config.get('ADMIN_TOKEN')
+		re = self.app.post('/.storage/admin/profile?seconds=0.01')
+		assert re.status_code == 403 # Forbidden
+		application.app.config['ADMIN_TOKEN'] = 'secret'
+		try:
+			headers = {'X-Admin-Token': 'secret'}
+			re = self.app.post('/.storage/admin/profile?seconds=0.01',
+				headers=headers)
+			assert re.status_code == 200 # OK
+			assert re.mimetype == 'text/plain'
+			re = self.app.post('/.storage/admin/profile?seconds=-1',
+				headers=headers)
+			assert re.status_code == 400 # Bad request
+			re = self.app.post('/.storage/admin/profile?seconds=0.01',
+				headers={'X-Admin-Token': 'wrong'})
+			assert re.status_code == 403 # Forbidden
+		finally:
+			application.app.config['ADMIN_TOKEN'] = token
+
+	def test_maintenance(self):
+		test_url_repo = self.username + '/' + self.repository
+		test_url_admin = '/.storage/admin/maintenance?repo=' + test_url_repo
+		headers = {'X-Admin-Token': 'secret'}
+		maintainer = application.maintainer
+
+		# Delete if repo exists from failed tests
+		re = self.app.delete(test_url_repo)
+		assert re.status_code in [200, 404]
+		re = self.app.post(test_url_repo, data='{}')
+		assert re.status_code == 201 # Created
+
+		def wait():
+			for i in range(200):
+				state = maintainer.status(application.app.config.get(
+					'STORAGE_ROOT') + '/' + test_url_repo)
+				if state and state['state'] == 'idle' and state['last']:
+					return state
+				time.sleep(0.05)
+			assert False
+
+		token = application.app.config.get('ADMIN_TOKEN')
+		writes, budget = maintainer.writes, maintainer.budget
+		application.app.config['ADMIN_TOKEN'] = 'secret'
+		maintainer.writes, maintainer.budget = 3, 1
+		try:
+			# Writes queue maintenance once git's thresholds are met
+			for i in range(3):
+				re = self.app.post(test_url_repo + '/commit', data=json.dumps({
+					'msg': 'Commit %d' % i, 'files': {'%d.txt' % i: str(i)}}))
+				assert re.status_code == 200 # OK
+			state = wait()
+			assert state['writes'] == 0 and state['last']['auto']
+			assert sorted(state['last']['tasks']) == \
+				sorted(application.maintenance.TASKS)
+			re = self.app.get(test_url_admin, headers=headers)
+			assert re.status_code == 200 # OK
+			j = json.loads(str(re.data, 'utf-8'))
+			assert j['objects']['count'] > 0 and j['objects']['packs'] == 0
+			re = self.app.get('/.storage/admin/maintenance', headers=headers)
+			assert test_url_repo in json.loads(str(re.data, 'utf-8'))
+
+			# Or on demand, regardless of thresholds
+			maintainer.forget(application.app.config.get('STORAGE_ROOT') +
+				'/' + test_url_repo)
+			re = self.app.post(test_url_admin, headers=headers)
+			assert re.status_code == 202 # Accepted
+			state = wait()
+			assert not state['last']['auto']
+			assert all(isinstance(x, float)
+				for x in state['last']['tasks'].values())
+			re = self.app.get(test_url_admin, headers=headers)
+			j = json.loads(str(re.data, 'utf-8'))
+			assert j['objects']['packs'] >= 1
+			assert j['objects']['commit-graph']
+			assert j['objects']['multi-pack-index']
+			# Counted by this process, rather than by runs saved in
+			#	METRICS_DIR
+			assert application.app_metrics.values['git_commands_total'].get(
+				'command="maintenance",result="ok"', 0) > 0
+
+			for url, status in [(test_url_admin + '&task=gc', 400),
+					('/.storage/admin/maintenance', 400),
+					('/.storage/admin/maintenance?repo=nobody/nothing', 404),
+					('/.storage/admin/maintenance?repo=../x', 404)]:
+				re = self.app.post(url, headers=headers)
+				assert re.status_code == status
+			re = self.app.get(test_url_admin)
+			assert re.status_code == 403 # Forbidden
+		finally:
+			application.app.config['ADMIN_TOKEN'] = token
+			maintainer.writes, maintainer.budget = writes, budget
+
+		re = self.app.delete(test_url_repo)
+		assert re.status_code == 200 # OK
+
+	def test_commit_files(self):
+		test_url_repo = self.username + '/' + self.repository
+		test_url_commit = test_url_repo + '/commit'
+		author = {'name': 'Unit Test', 'email': 'UnitTest@gmail.com'}
+
+		# Delete if repo exists from failed tests
+		re = self.app.delete(test_url_repo)
+		assert re.status_code in [200, 404]
+		re = self.app.post(test_url_repo, data='{}')
+		assert re.status_code == 201 # Created
+		r = git.Repo(application.app.config.get('STORAGE_ROOT') + '/' +
+			test_url_repo)
+
+		# Files are committed and written in one request, even the first
+		re = self.app.post(test_url_commit, data=json.dumps(dict(author,
+			msg='First', files={'README.md': 'hello\n', 'a/b.txt': 'b'})))
+		assert re.status_code == 200 # OK
+		first = json.loads(str(re.data, 'utf-8'))['commit']
+		assert r.head.commit.hexsha == first
+		assert r.git.show('HEAD:a/b.txt') == 'b'
+		with open(r.working_tree_dir + '/a/b.txt') as f:
+			assert f.read() == 'b'
+		re = self.app.get(test_url_repo + '/file/a/b.txt')
+		assert json.loads(str(re.data, 'utf-8'))['data'] == 'b'
+
+		# Changes based on an old HEAD are refused
+		re = self.app.post(test_url_commit, data=json.dumps(dict(author,
+			msg='Second', parent=first, files={'a/b.txt': 'c', 'README.md': None})))
+		assert re.status_code == 200 # OK
+		second = json.loads(str(re.data, 'utf-8'))['commit']
+		re = self.app.post(test_url_commit, data=json.dumps(dict(author,
+			msg='Stale', parent=first, files={'a/b.txt': 'd'})))
+		assert re.status_code == 409 # Conflict
+		assert json.loads(str(re.data, 'utf-8'))['head'] == second
+		assert r.git.show('HEAD:a/b.txt') == 'c'
+		with open(r.working_tree_dir + '/z.txt', 'w') as f:
+			f.write('z')
+		re = self.app.post(test_url_commit, data=json.dumps(dict(author,
+			msg='Stale', parent=first, A=['z.txt'], R=[])))
+		assert re.status_code == 409 # Conflict
+		assert r.git.status('--porcelain') == '?? z.txt' # Not staged
+		os.remove(r.working_tree_dir + '/z.txt')
+		assert not os.path.exists(r.working_tree_dir + '/README.md')
+		assert r.head.commit.parents[0].hexsha == first
+
+		# The work tree matches the commit
+		re = self.app.get(test_url_repo + '/status')
+		assert json.loads(str(re.data, 'utf-8')) == \
+			{'A': [], 'D': [], 'M': [], 'R': [], 'U': []}
+
+		# Files outside the work tree, directories and missing files
+		for files, status in [({'.git/config': 'x'}, 403), ({'../x': 'x'}, 403),
+				({'a': 'x'}, 403), ({'missing.txt': None}, 404),
+				({'a/b.txt/c': 'x'}, 409), ({'d': 'x', 'd/e': 'x'}, 409)]:
+			re = self.app.post(test_url_commit, data=json.dumps(dict(author,
+				msg='Bad', files=files)))
+			assert re.status_code == status
+		assert r.head.commit.hexsha == second
+		assert not r.is_dirty(untracked_files=True)
+
+		# Files replace directories and directories files
+		os.remove(r.working_tree_dir + '/a/b.txt')
+		for files in [{'a/b.txt/c': 'c'}, {'a/b.txt': 'b', 'a/b.txt/c': None},
+				{'a': 'a', 'a/b.txt': None}, {'a': None, 'a/b/c': 'c'}]:
+			re = self.app.post(test_url_commit, data=json.dumps(dict(author,
+				msg='Replace', files=files)))
+			assert re.status_code == 200 # OK
+			r.git.fsck('--strict')
+			assert not r.is_dirty(untracked_files=True)
+			for path, data in files.items():
+				if data is not None:
+					assert r.git.show('HEAD:' + path) == data
+					with open(r.working_tree_dir + '/' + path) as f:
+						assert f.read() == data
+		assert r.git.ls_files().split() == ['a/b/c']
+
+		# Symlinks written over become files, executables stay executable
+		os.symlink('a/b/c', r.working_tree_dir + '/link')
+		with open(r.working_tree_dir + '/run.sh', 'w') as f:
+			f.write('true\n')
+		os.chmod(r.working_tree_dir + '/run.sh', 0o755)
+		re = self.app.post(test_url_commit, data=json.dumps(dict(author,
+			msg='Modes', A=['link', 'run.sh'], R=[])))
+		assert re.status_code == 200 # OK
+		re = self.app.post(test_url_commit, data=json.dumps(dict(author,
+			msg='Overwrite', files={'link': 'text', 'run.sh': 'false\n'})))
+		assert re.status_code == 200 # OK
+		assert r.git.ls_tree('HEAD', 'link', 'run.sh').split('\n') == [
+			'100644 blob ' + r.git.rev_parse('HEAD:link') + '\tlink',
+			'100755 blob ' + r.git.rev_parse('HEAD:run.sh') + '\trun.sh']
+		assert not os.path.islink(r.working_tree_dir + '/link')
+		assert os.access(r.working_tree_dir + '/run.sh', os.X_OK)
+		assert not r.is_dirty(untracked_files=True)
+
+		re = self.app.delete(test_url_repo)
+		assert re.status_code == 200 # OK
+
+	def test_commit_staging(self):
+		test_url_repo = self.username + '/' + self.repository
+		test_url_commit = test_url_repo + '/commit'
+		author = {'name': 'Unit Test', 'email': 'UnitTest@gmail.com'}
+
+		# Delete if repo exists from failed tests
+		re = self.app.delete(test_url_repo)
+		assert re.status_code in [200, 404]
+		re = self.app.post(test_url_repo, data='{}')
+		assert re.status_code == 201 # Created
+		r = git.Repo(application.app.config.get('STORAGE_ROOT') + '/' +
+			test_url_repo)
+		root = r.working_tree_dir
+
+		# A directory stages everything in it
+		os.makedirs(root + '/gen/sub')
+		for i in range(50):
+			with open(root + '/gen/sub/f%d.py' % i, 'w') as f:
+				f.write(str(i))
+		with open(root + '/gen/notes.txt', 'w') as f:
+			f.write('notes')
+		with open(root + '/README.md', 'w') as f:
+			f.write('hello')
+		re = self.app.post(test_url_commit, data=json.dumps(dict(author,
+			msg='Generated', A=['gen', 'README.md'], R=[])))
+		assert re.status_code == 200 # OK
+		j = json.loads(str(re.data, 'utf-8'))
+		assert len(j['staged']['A']) == 52
+		assert 'gen/sub/f7.py' in j['staged']['A']
+		assert j['staged']['M'] == [] and j['staged']['D'] == []
+
+		# Globs stage new, modified and deleted files they match only
+		os.remove(root + '/gen/sub/f0.py')
+		with open(root + '/gen/sub/f1.py', 'w') as f:
+			f.write('changed')
+		with open(root + '/gen/sub/new.py', 'w') as f:
+			f.write('new')
+		with open(root + '/gen/notes.txt', 'w') as f:
+			f.write('changed')
+		re = self.app.post(test_url_commit, data=json.dumps(dict(author,
+			msg='Regenerated', A=['gen/*.py'], R=[])))
+		assert re.status_code == 200 # OK
+		j = json.loads(str(re.data, 'utf-8'))
+		assert j['staged'] == {'A': ['gen/sub/new.py'],
+			'M': ['gen/sub/f1.py'], 'D': ['gen/sub/f0.py']}
+
+		# Everything, and removing a directory from the index
+		re = self.app.post(test_url_commit, data=json.dumps(dict(author,
+			msg='All', all=True)))
+		assert re.status_code == 200 # OK
+		j = json.loads(str(re.data, 'utf-8'))
+		assert j['staged'] == {'A': [], 'M': ['gen/notes.txt'], 'D': []}
+		re = self.app.post(test_url_commit, data=json.dumps(dict(author,
+			msg='Untrack', A=[], R=['gen/sub'])))
+		assert re.status_code == 200 # OK
+		j = json.loads(str(re.data, 'utf-8'))
+		assert len(j['staged']['D']) == 50
+		assert os.path.exists(root + '/gen/sub/f1.py')
+
+		# Paths matching nothing, outside the work tree or in .git
+		for A, R, status in [(['missing.txt'], [], 404), (['*.nope'], [], 404),
+				([], ['gen/sub/f1.py'], 404), (['../x'], [], 403),
+				([], ['.git/config'], 403), ('gen', [], 400)]:
+			re = self.app.post(test_url_commit, data=json.dumps(dict(author,
+				msg='Bad', A=A, R=R)))
+			assert re.status_code == status
+
+		re = self.app.delete(test_url_repo)
+		assert re.status_code == 200 # OK
+
+	def test_provisioning(self):
+		test_url_repo = self.username + '/' + self.repository
+		test_remote_url, work = self.make_remote({'README.md': 'hello\n',
+			'src/a.txt': 'a', 'docs/b.txt': 'b'})
+		self.commit_remote(work, {'src/a.txt': 'a2'})
+		self.commit_remote(work, {'src/a.txt': 'a3'})
+		git.Repo(test_remote_url[len('file://'):]).git.config(
+			'uploadpack.allowFilter', 'true')
+
+		# Delete if repo exists from failed tests
+		re = self.app.delete(test_url_repo)
+		assert re.status_code in [200, 404]
+
+		remotes = json.dumps({'origin': test_remote_url})
+		for query in ['depth=0', 'depth=x', 'filter=blob', 'filter=--all',
+				'sparse=../x', 'sparse=.git']:
+			re = self.app.post(test_url_repo + '?' + query, data=remotes)
+			assert re.status_code == 400 # Bad Request
+
+		# Only the last commit, the blobs and the sparse directory checked
+		#	out are fetched
+		re = self.app.post(test_url_repo +
+			'?depth=1&filter=blob:none&sparse=src', data=remotes)
+		assert re.status_code == 201 # Created
+		re = self.app.post(test_url_repo + '/pull/origin')
+		assert re.status_code == 200 # OK
+		r = git.Repo(application.app.config.get('STORAGE_ROOT') + '/' +
+			test_url_repo)
+		root = r.working_tree_dir
+		assert r.git.rev_list('--count', 'HEAD') == '1'
+		assert os.path.exists(root + '/README.md')
+		with open(root + '/src/a.txt') as f:
+			assert f.read() == 'a3'
+		assert not os.path.exists(root + '/docs')
+		missing = r.git.rev_list('--objects', '--missing=print', 'HEAD')
+		assert len([x for x in missing.split('\n') if x.startswith('?')]) == 1
+
+		# Later pulls fetch every new commit, and missing objects are
+		#	fetched when needed
+		self.commit_remote(work, {'src/a.txt': 'a4', 'docs/b.txt': 'b2'})
+		re = self.app.post(test_url_repo + '/pull/origin')
+		assert re.status_code == 200 # OK
+		assert r.git.rev_list('--count', 'HEAD') == '2'
+		assert not os.path.exists(root + '/docs')
+		assert r.git.show('HEAD~1:docs/b.txt') == 'b'
+
+		# Commit and push, also after replacing the remotes
+		re = self.app.put(test_url_repo, data=remotes)
+		assert re.status_code == 200 # OK
+		assert r.git.config('remote.origin.promisor') == 'true'
+		re = self.app.post(test_url_repo + '/commit', data=json.dumps({
+			'msg': 'Local', 'files': {'src/c.txt': 'c'}}))
+		assert re.status_code == 200 # OK
+		re = self.app.post(test_url_repo + '/push/origin')
+		assert re.status_code == 200 # OK
+		work.remotes.origin.pull('master')
+		with open(work.working_dir + '/src/c.txt') as f:
+			assert f.read() == 'c'
+
+		re = self.app.delete(test_url_repo)
+		assert re.status_code == 200 # OK
+
 	def test_list(self):
 		test_url_list = '/' + self.username
 		test_url_repo = self.username + '/' + self.repository
@@ -479,6 +1888,125 @@ class StorageTestCase(unittest.TestCase):
 		re = self.app.delete(test_url_repo)
 		assert re.status_code == 200 # OK
 
+	def test_repo_cache(self):
+		test_url_repo = self.username + '/' + self.repository
+		cache = application.repo_cache
+
+		# Delete if repo exists from failed tests
+		re = self.app.delete(test_url_repo)
+		assert re.status_code in [200, 404]
+
+		# Init local testing repo
+		re = self.app.post(test_url_repo, data='{}')
+		assert re.status_code == 201 # Created
+
+		# Second request reuses the handle of the first
+		re = self.app.get(test_url_repo)
+		assert re.status_code == 200 # OK
+		hits = cache.hits
+		re = self.app.get(test_url_repo)
+		assert re.status_code == 200 # OK
+		assert cache.hits == hits + 1
+
+		# Deleting invalidates the cached handle
+		re = self.app.delete(test_url_repo)
+		assert re.status_code == 200 # OK
+		re = self.app.get(test_url_repo)
+		assert re.status_code == 404 # Not Found
+
+		# Least recently used handles are evicted beyond the limit
+		small = application.RepoCache(size=1, timeout=0)
+		root = application.app.config.get('STORAGE_ROOT') + '/' + self.username
+		for name in ['cache-a', 'cache-b']:
+			application.git.Repo.init(root + '/' + name)
+			small.release(small.acquire(root + '/' + name))
+			application.shutil.rmtree(root + '/' + name)
+		assert small.count == 1
+		assert [x for x in small.idle] == [root + '/cache-b']
+		small.clear()
+
+	def test_tree_index(self):
+		test_url_repo = self.username + '/' + self.repository
+		test_url_tree = test_url_repo + '/tree'
+		root = application.app.config.get('STORAGE_ROOT') + '/' + test_url_repo
+
+		# Delete if repo exists from failed tests
+		re = self.app.delete(test_url_repo)
+		assert re.status_code in [200, 404]
+
+		# Init local testing repo
+		re = self.app.post(test_url_repo, data='{}')
+		assert re.status_code == 201 # Created
+
+		# Files written through the API show up immediately
+		re = self.app.post(test_url_repo + '/file/a/b.txt', data='{"data": ""}')
+		assert re.status_code == 201 # Created
+		re = self.app.get(test_url_tree)
+		assert json.loads(str(re.data, 'utf-8')) == {'a': {'b.txt': True}}
+
+		# Files written directly to disk are found through the mtime check
+		time.sleep(0.1)
+		open(root + '/a/c.txt', 'w').close()
+		re = self.app.get(test_url_tree + '/a')
+		assert json.loads(str(re.data, 'utf-8')) == {'b.txt': True, 'c.txt': True}
+
+		# .git is listed only when asked for
+		re = self.app.get(test_url_tree + '/.git')
+		assert re.status_code == 200 # OK
+		assert 'HEAD' in json.loads(str(re.data, 'utf-8'))
+
+		# Delete test repo
+		re = self.app.delete(test_url_repo)
+		assert re.status_code == 200 # OK
+
+	def test_tree_paged(self):
+		test_url_repo = self.username + '/' + self.repository
+		test_url_tree = test_url_repo + '/tree'
+		test_files = ['a.txt', 'b/c.txt', 'b/d/e.txt', 'f.txt']
+
+		# Delete if repo exists from failed tests
+		re = self.app.delete(test_url_repo)
+		assert re.status_code in [200, 404]
+
+		# Init local testing repo with files
+		re = self.app.post(test_url_repo, data='{}')
+		assert re.status_code == 201 # Created
+		for f in test_files:
+			re = self.app.post(test_url_repo + '/file/' + f, data='{"data": "x"}')
+			assert re.status_code == 201 # Created
+
+		# Depth limited nested tree
+		re = self.app.get(test_url_tree + '?depth=2')
+		assert json.loads(str(re.data, 'utf-8')) == {
+			'a.txt': True, 'f.txt': True, 'b': {'c.txt': True, 'd': {}}}
+		re = self.app.get(test_url_tree + '?depth=0')
+		assert re.status_code == 400 # Bad request
+
+		# Page through the flat listing
+		paths = []
+		cursor = ''
+		while cursor is not None:
+			re = self.app.get(test_url_tree + '?limit=2&cursor=' + cursor)
+			assert re.status_code == 200 # OK
+			j = json.loads(str(re.data, 'utf-8'))
+			assert len(j['entries']) <= 2
+			paths.extend(x['path'] for x in j['entries'])
+			cursor = j['next']
+		assert paths == ['a.txt', 'b', 'b/c.txt', 'b/d', 'b/d/e.txt', 'f.txt']
+
+		# Streamed listing with sizes
+		re = self.app.get(test_url_tree + '/b?format=ndjson&stat=1&limit=2')
+		assert re.mimetype == 'application/x-ndjson'
+		lines = [json.loads(x) for x in str(re.data, 'utf-8').splitlines()]
+		assert lines[0] == {'path': 'c.txt', 'type': 'file', 'size': 1,
+			'mtime': lines[0]['mtime']}
+		assert lines[1]['path'] == 'd' and lines[1]['type'] == 'dir'
+		assert lines[2] == {'next': 'd'}
+
+		# Delete test repo
+		re = self.app.delete(test_url_repo)
+		assert re.status_code == 200 # OK
+
 
 if __name__ == '__main__':
 	unittest.main()
@@ -0,0 +1,524 @@
+"""
+	Offline benchmark of the storage API.
+
+	Generates synthetic repositories with local bare repositories as their
+		remotes, then measures throughput and latency percentiles of every
+		endpoint with concurrent clients. The server is either this app
+		in-process (the default, storing repositories in a temporary
+		directory) or a running server on the same machine (--url).
+
+	Results are written as JSON, which --compare checks for regressions:
+		python benchmark.py --output old.json
+		python benchmark.py --output new.json
+		python benchmark.py --compare old.json new.json
+"""
+import argparse, collections, http.client, json, os, random, shutil, \
+	subprocess, sys, tempfile, threading, time, urllib.parse
+
+# Requests are made as this user, one repository per --repos
+USER = 'bench'
+
+# Words the generated text files are made of
+WORDS = ['def', 'return', 'self', 'import', 'class', 'if', 'else', 'for',
+	'in', 'value', 'data', 'path', 'request', 'response', 'None', 'True',
+	'config', 'repo', 'file', 'tree', 'status', '=', '(', ')', ':', '+']
+
+class InProcessClient(object):
+	"""
+		Calls the app through Flask's test client
+	"""
+
+	def __init__(self, app):
+		self.client = app.test_client()
+
+	def request(self, method, path, body=None, headers=None):
+		"""
+			Returns (status code, response body)
+		"""
+		response = self.client.open(path, method=method, data=body,
+			headers=headers or {})
+		try:
+			return response.status_code, response.get_data()
+		finally:
+			response.close()
+
+class HTTPClient(object):
+	"""
+		Calls a running server over a keep-alive HTTP connection
+	"""
+
+	def __init__(self, url):
+		url = urllib.parse.urlparse(url)
+		self.host = url.hostname
+		self.port = url.port or 80
+		self.prefix = url.path.rstrip('/')
+		self.conn = None
+
+	def request(self, method, path, body=None, headers=None):
+		for attempt in range(2):
+			if self.conn is None:
+				self.conn = http.client.HTTPConnection(self.host, self.port)
+			try:
+				self.conn.request(method, self.prefix + path, body,
+					headers or {})
+				response = self.conn.getresponse()
+				return response.status, response.read()
+			except (http.client.HTTPException, OSError):
+				# Closed by the server, e.g. a restarted worker
+				self.conn.close()
+				self.conn = None
+				if attempt:
+					raise
+
+class Repo(object):
+	"""
+		A generated repository: its bare remotes, a working copy used to
+			push commits for the server to pull, and the files it has
+	"""
+
+	def __init__(self, name, path):
+		self.name = name
+		self.url = '/' + USER + '/' + name
+		self.origin = path + '/origin.git'
+		self.mirror = path + '/mirror.git'
+		self.feeder = path + '/feeder'
+		self.files = []
+		self.modified = []
+		self.lock = threading.Lock()
+		self.count = 0 # Commits pushed by the feeder
+
+def git(*args, **kwargs):
+	"""
+		Runs git, raising an exception if it fails
+	"""
+	cwd = kwargs.get('cwd', None)
+	proc = subprocess.Popen(['git'] + [x for x in args], cwd=cwd,
+		stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+	out, err = proc.communicate(kwargs.get('input', None))
+	if proc.returncode != 0:
+		raise RuntimeError('git %s failed: %s' % (' '.join(args),
+			err.decode('utf-8', 'replace')))
+	return out
+
+def text(rng, size):
+	"""
+		Returns about size bytes of source-like text
+	"""
+	lines = []
+	length = 0
+	while length < size:
+		line = ' '.join(rng.choice(WORDS) for i in range(rng.randint(2, 12)))
+		lines.append(line)
+		length += len(line) + 1
+	return ('\n'.join(lines) + '\n').encode('utf-8')
+
+def file_path(i, depth):
+	# Up to 8 directories on each level
+	parts = ['dir%d' % ((i // 8 ** k) % 8) for k in range(depth)]
+	return '/'.join(parts + ['file%d.txt' % i])
+
+def generate(repo, args, rng):
+	"""
+		Creates the origin remote of repo with args.history commits of
+			args.files files, using git fast-import
+	"""
+	git('init', '-q', '--bare', repo.origin)
+	repo.files = [file_path(i, args.depth) for i in range(args.files)]
+	blocks = [text(rng, args.file_size) for i in range(16)]
+
+	stream = []
+	now = int(time.time()) - args.history
+	changes = max(1, args.files // 100)
+	for c in range(args.history):
+		if c == 0:
+			paths = repo.files
+		else:
+			paths = rng.sample(repo.files, min(changes, len(repo.files)))
+		msg = ('Commit %d\n' % c).encode('utf-8')
+		stream.append(b'commit refs/heads/master\n')
+		stream.append(('mark :%d\n' % (c + 1)).encode('utf-8'))
+		stream.append(('committer Bench <bench@example.com> %d +0000\n' %
+			(now + c)).encode('utf-8'))
+		stream.append(('data %d\n' % len(msg)).encode('utf-8') + msg)
+		if c > 0:
+			stream.append(('from :%d\n' % c).encode('utf-8'))
+		for path in paths:
+			data = ('%s %d\n' % (path, c)).encode('utf-8') + rng.choice(blocks)
+			stream.append(('M 100644 inline %s\n' % path).encode('utf-8'))
+			stream.append(('data %d\n' % len(data)).encode('utf-8') + data)
+		stream.append(b'\n')
+	git('fast-import', '--quiet', cwd=repo.origin, input=b''.join(stream))
+
+	git('clone', '-q', '--bare', repo.origin, repo.mirror)
+	git('clone', '-q', repo.origin, repo.feeder)
+
+def provision(client, repo, args, rng):
+	"""
+		Creates repo on the server, pulls it and adds untracked and
+			modified files
+	"""
+	client.request('DELETE', repo.url)
+	check(client.request('POST', repo.url, json.dumps({
+		'origin': 'file://' + repo.origin,
+		'mirror': 'file://' + repo.mirror})), 201)
+	check(client.request('POST', repo.url + '/pull/origin'), 200)
+
+	for i in range(args.untracked):
+		check(client.request('POST', repo.url + '/file/untracked/u%d.txt' % i,
+			json.dumps({'data': 'untracked %d\n' % i})), 201)
+	repo.modified = rng.sample(repo.files, min(args.modified, len(repo.files)))
+	for path in repo.modified:
+		check(client.request('PUT', repo.url + '/file/' + path,
+			json.dumps({'data': 'modified\n'})), 200)
+
+def check(result, status):
+	if result[0] != status:
+		raise RuntimeError('Expected %d, got %d: %r' % (status, result[0],
+			result[1][:200]))
+
+def feed(repo, name):
+	"""
+		Pushes a new commit to the origin of repo for the server to pull
+	"""
+	with repo.lock:
+		repo.count += 1
+		path = 'feed/%s-%d.txt' % (name, repo.count)
+		os.makedirs(os.path.dirname(repo.feeder + '/' + path), exist_ok=True)
+		with open(repo.feeder + '/' + path, 'w') as f:
+			f.write('feed %d\n' % repo.count)
+		git('add', path, cwd=repo.feeder)
+		git('-c', 'user.name=Bench', '-c', 'user.email=bench@example.com',
+			'commit', '-q', '-m', 'Feed %d' % repo.count, cwd=repo.feeder)
+		git('push', '-q', 'origin', 'HEAD:refs/heads/master', cwd=repo.feeder)
+
+def new_commit(client, repo, name):
+	"""
+		Adds a file through the API
+		Returns the (method, path, body) committing it
+	"""
+	path = 'bench/%s.txt' % name
+	check(client.request('POST', repo.url + '/file/' + path,
+		json.dumps({'data': name + '\n'})), 201)
+	return 'POST', repo.url + '/commit', json.dumps({
+		'A': [path], 'R': [], 'msg': 'Bench ' + name,
+		'name': 'Bench', 'email': 'bench@example.com'})
+
+# Scenarios: name -> function(client, repo, i, name) that does any
+#	preparation and returns the (method, path, body) to time.
+#	Scenarios that change repositories come last, and are listed in
+#	WRITES.
+def s_file(client, repo, i, name):
+	return 'GET', repo.url + '/file/' + pick(repo.files, i), None
+
+def s_file_raw(client, repo, i, name):
+	return 'GET', repo.url + '/file/' + pick(repo.files, i) + '?raw=1', None
+
+def s_batch(client, repo, i, name):
+	ops = [{'op': 'read', 'path': pick(repo.files, i + x)} for x in range(10)]
+	return 'POST', repo.url + '/batch', json.dumps(ops)
+
+def s_tree(client, repo, i, name):
+	return 'GET', repo.url + '/tree', None
+
+def s_tree_flat(client, repo, i, name):
+	return 'GET', repo.url + '/tree?format=flat&limit=1000', None
+
+def s_list(client, repo, i, name):
+	return 'GET', '/' + USER, None
+
+def s_repository(client, repo, i, name):
+	return 'GET', repo.url, None
+
+def s_status(client, repo, i, name):
+	return 'GET', repo.url + '/status', None
+
+def s_diff(client, repo, i, name):
+	return 'GET', repo.url + '/diff', None
+
+def s_metrics(client, repo, i, name):
+	return 'GET', '/.storage/metrics', None
+
+def s_file_put(client, repo, i, name):
+	return 'PUT', repo.url + '/file/' + pick(repo.modified or repo.files, i), \
+		json.dumps({'data': 'put %s\n' % name})
+
+def s_pull(client, repo, i, name):
+	feed(repo, name)
+	return 'POST', repo.url + '/pull/origin', None
+
+def s_commit(client, repo, i, name):
+	return new_commit(client, repo, name)
+
+def s_commit_files(client, repo, i, name):
+	return 'POST', repo.url + '/commit', json.dumps({
+		'files': {'bench/%s.txt' % name: name + '\n'}, 'msg': 'Bench ' + name,
+		'name': 'Bench', 'email': 'bench@example.com'})
+
+def s_commit_dir(client, repo, i, name):
+	ops = [{'op': 'create', 'path': 'gen/%s/%d.txt' % (name, x), 'data': str(x)}
+		for x in range(100)]
+	check(client.request('POST', repo.url + '/batch', json.dumps(ops)), 200)
+	return 'POST', repo.url + '/commit', json.dumps({
+		'A': ['gen/' + name], 'R': [], 'msg': 'Bench ' + name,
+		'name': 'Bench', 'email': 'bench@example.com'})
+
+def s_push(client, repo, i, name):
+	check(client.request(*new_commit(client, repo, name)), 200)
+	return 'POST', repo.url + '/push/mirror', None
+
+def s_job(client, repo, i, name):
+	status, body = client.request('POST', repo.url + '/pull/origin?async=1')
+	check((status, body), 202)
+	return 'GET', repo.url + '/jobs/' + json.loads(body.decode('utf-8'))['job'], \
+		None
+
+SCENARIOS = collections.OrderedDict([
+	('file', s_file),
+	('file_raw', s_file_raw),
+	('batch', s_batch),
+	('tree', s_tree),
+	('tree_flat', s_tree_flat),
+	('list', s_list),
+	('repository', s_repository),
+	('status', s_status),
+	('diff', s_diff),
+	('metrics', s_metrics),
+	('file_put', s_file_put),
+	('pull', s_pull),
+	('commit', s_commit),
+	('commit_files', s_commit_files),
+	('commit_dir', s_commit_dir),
+	('push', s_push),
+	('job', s_job)
+])
+
+# Each client thread changes a repository of its own while there are as
+#	many as threads, as concurrent pushes of the same branch conflict
+WRITES = ['file_put', 'pull', 'commit', 'commit_files', 'commit_dir', 'push',
+	'job']
+
+def pick(items, i):
+	# Spreads consecutive requests over the items
+	return items[(i * 7919) % len(items)]
+
+def run(scenario, clients, repos, requests, warmup):
+	"""
+		Makes requests + warmup requests with one thread per client,
+			timing all but the warm-up ones
+		Returns the statistics of the scenario
+	"""
+	fn = SCENARIOS[scenario]
+	latencies = []
+	errors = [0]
+	lock = threading.Lock()
+	total = requests + warmup
+	start = [None]
+	ready = threading.Barrier(len(clients))
+
+	def work(t, client):
+		times = []
+		failed = 0
+		ready.wait()
+		if t == 0:
+			start[0] = time.time()
+		for i in range(t, total, len(clients)):
+			repo = repos[(t if scenario in WRITES else i) % len(repos)]
+			name = '%s-%d-%d' % (scenario, os.getpid(), i)
+			method, path, body = fn(client, repo, i, name)
+			begin = time.time()
+			status, data = client.request(method, path, body)
+			if i >= warmup:
+				times.append(time.time() - begin)
+				if status >= 400:
+					failed += 1
+		with lock:
+			latencies.extend(times)
+			errors[0] += failed
+
+	threads = [threading.Thread(target=work, args=(t, x))
+		for t, x in enumerate(clients)]
+	for x in threads:
+		x.start()
+	for x in threads:
+		x.join()
+	elapsed = time.time() - start[0]
+
+	latencies.sort()
+	return {
+		'requests': len(latencies),
+		'errors': errors[0],
+		'throughput': len(latencies) / elapsed if elapsed > 0 else None,
+		'mean': sum(latencies) / len(latencies) if latencies else None,
+		'p50': percentile(latencies, 50),
+		'p90': percentile(latencies, 90),
+		'p99': percentile(latencies, 99),
+		'max': latencies[-1] if latencies else None
+	}
+
+def percentile(values, p):
+	"""
+		Nearest-rank percentile of sorted values
+	"""
+	if not values:
+		return None
+	return values[max(0, -(-len(values) * p // 100) - 1)]
+
+def version():
+	# The commit of the tree being benchmarked, if it is a git checkout
+	try:
+		return git('describe', '--always', '--dirty',
+			cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+	except (RuntimeError, OSError):
+		return None
+
+def benchmark(args):
+	work = tempfile.mkdtemp(prefix='benchmark-')
+	try:
+		if args.url is None:
+			import application
+			root = work + '/storage'
+			os.makedirs(root)
+			application.app.config['STORAGE_ROOT'] = root
+			application.ahead_cache = application.AheadCache(
+				root + '/.ahead-cache.json')
+			if args.backend is not None:
+				application.git_backend = application.gitbackend.get(
+					args.backend)
+			make_client = lambda: InProcessClient(application.app)
+		else:
+			make_client = lambda: HTTPClient(args.url)
+
+		rng = random.Random(args.seed)
+		client = make_client()
+		repos = []
+		log('Generating %d repositories' % args.repos)
+		for k in range(args.repos):
+			repo = Repo('repo%d' % k, work + '/repo%d' % k)
+			generate(repo, args, rng)
+			provision(client, repo, args, rng)
+			repos.append(repo)
+
+		clients = [make_client() for i in range(args.concurrency)]
+		results = collections.OrderedDict()
+		for scenario in args.scenarios:
+			results[scenario] = run(scenario, clients, repos, args.requests,
+				args.warmup)
+			log(format_result(scenario, results[scenario]))
+
+		for repo in repos:
+			client.request('DELETE', repo.url)
+	finally:
+		shutil.rmtree(work, True)
+
+	return {
+		'version': version(),
+		'python': sys.version.split()[0],
+		'server': args.url or 'in-process',
+		'backend': args.backend,
+		'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+		'parameters': {x: getattr(args, x) for x in ['repos', 'files', 'depth',
+			'history', 'untracked', 'modified', 'file_size', 'concurrency',
+			'requests', 'warmup', 'seed']},
+		'results': results
+	}
+
+def format_result(name, r):
+	ms = lambda x: '-' if x is None else '%.1fms' % (x * 1000)
+	return '%-12s %8.1f req/s  p50 %9s  p90 %9s  p99 %9s  errors %d' % (
+		name, r['throughput'] or 0, ms(r['p50']), ms(r['p90']), ms(r['p99']),
+		r['errors'])
+
+def compare(old, new, tolerance):
+	"""
+		Prints how each scenario changed between two result files
+		Returns the names of scenarios that got slower by more than
+			tolerance (a fraction), in p99 latency or throughput
+	"""
+	if old['parameters'] != new['parameters'] or old['server'] != new['server']:
+		log('Warning: the results were made with different parameters')
+
+	regressions = []
+	for name in new['results']:
+		if name not in old['results']:
+			continue
+		a, b = old['results'][name], new['results'][name]
+		if not a['p99'] or not b['p99'] or not a['throughput']:
+			continue
+		p50 = b['p50'] / a['p50'] - 1
+		p99 = b['p99'] / a['p99'] - 1
+		throughput = b['throughput'] / a['throughput'] - 1
+		slower = p99 > tolerance or throughput < -tolerance
+		if slower:
+			regressions.append(name)
+		print('%-12s p50 %+6.1f%%  p99 %+6.1f%%  throughput %+6.1f%%%s' % (
+			name, p50 * 100, p99 * 100, throughput * 100,
+			'  REGRESSION' if slower else ''))
+	return regressions
+
+def log(message):
+	sys.stderr.write(message + '\n')
+	sys.stderr.flush()
+
+def main():
+	parser = argparse.ArgumentParser(description='Benchmarks the storage API '
+		'with generated repositories and local bare remotes')
+	parser.add_argument('--url', help='benchmark the server at this URL '
+		'instead of the app in-process; it must run on this machine')
+	parser.add_argument('--backend', choices=['cli', 'python', 'pygit2'],
+		help='GIT_BACKEND of the app in-process, instead of config.cfg\'s')
+	parser.add_argument('--repos', type=int, default=8)
+	parser.add_argument('--files', type=int, default=1000,
+		help='files per repository')
+	parser.add_argument('--depth', type=int, default=3,
+		help='directory levels the files are spread over')
+	parser.add_argument('--history', type=int, default=100,
+		help='commits per repository')
+	parser.add_argument('--untracked', type=int, default=20,
+		help='untracked files per repository')
+	parser.add_argument('--modified', type=int, default=10,
+		help='modified tracked files per repository')
+	parser.add_argument('--file-size', type=int, default=2048,
+		help='approximate bytes per file')
+	parser.add_argument('--concurrency', type=int, default=8)
+	parser.add_argument('--requests', type=int, default=200,
+		help='timed requests per scenario')
+	parser.add_argument('--warmup', type=int, default=10,
+		help='untimed requests per scenario')
+	parser.add_argument('--seed', type=int, default=0)
+	parser.add_argument('--scenarios', default=','.join(SCENARIOS),
+		help='comma separated scenarios to run, of: ' + ', '.join(SCENARIOS))
+	parser.add_argument('--output', help='write results here instead of '
+		'to stdout')
+	parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'),
+		help='compare two result files instead of benchmarking; exits with '
+			'status 1 if NEW regressed')
+	parser.add_argument('--tolerance', type=float, default=0.1,
+		help='fraction p99 latency may grow or throughput shrink before '
+			'--compare reports a regression')
+	args = parser.parse_args()
+
+	if args.compare:
+		with open(args.compare[0]) as f:
+			old = json.load(f)
+		with open(args.compare[1]) as f:
+			new = json.load(f)
+		regressions = compare(old, new, args.tolerance)
+		if regressions:
+			log('Regressed: ' + ', '.join(regressions))
+			sys.exit(1)
+		return
+
+	args.scenarios = [x for x in args.scenarios.split(',') if x]
+	for x in args.scenarios:
+		if x not in SCENARIOS:
+			parser.error('unknown scenario: ' + x)
+
+	results = json.dumps(benchmark(args), indent=2)
+	if args.output:
+		with open(args.output, 'w') as f:
+			f.write(results + '\n')
+	else:
+		print(results)
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,206 @@
+import collections, threading, zlib
+
+try:
+	import zstandard
+except ImportError:
+	zstandard = None
+
+try:
+	import brotli
+except ImportError:
+	brotli = None
+
+# Default levels: fast enough to keep up with streaming a response
+LEVELS = {'zstd': 3, 'br': 4, 'gzip': 6}
+
+# Content types that are already compressed
+INCOMPRESSIBLE = ['image/', 'audio/', 'video/', 'font/woff',
+	'application/zip', 'application/gzip', 'application/x-gzip',
+	'application/x-bzip2', 'application/x-xz', 'application/x-7z-compressed',
+	'application/x-rar-compressed', 'application/zstd', 'application/pdf']
+
+class Encoder(object):
+	"""
+		Incremental compressor for one Content-Encoding. flush() returns
+			everything compressed so far so that a streamed response
+			doesn't stall, finish() ends the stream.
+	"""
+
+	def __init__(self, encoding, level):
+		self.encoding = encoding
+		if encoding == 'gzip':
+			self.c = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+		elif encoding == 'zstd':
+			self.c = zstandard.ZstdCompressor(level=level).compressobj()
+		elif encoding == 'br':
+			self.c = brotli.Compressor(quality=level)
+		else:
+			raise ValueError(encoding)
+
+	def compress(self, data):
+		if self.encoding == 'br':
+			# brotli calls it process(), brotlicffi compress()
+			return getattr(self.c, 'process', self.c.compress)(data)
+		return self.c.compress(data)
+
+	def flush(self):
+		if self.encoding == 'gzip':
+			return self.c.flush(zlib.Z_SYNC_FLUSH)
+		if self.encoding == 'zstd':
+			return self.c.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+		return self.c.flush()
+
+	def finish(self):
+		if self.encoding == 'br':
+			return self.c.finish()
+		return self.c.flush()
+
+class Compressor(object):
+	"""
+		Compresses responses with the best encoding the client accepts.
+
+		Only 200 responses of at least min_size bytes and of a compressible
+			content type are compressed, streamed ones chunk by chunk.
+			Their ETag is made weak, as the compressed bytes differ from
+			the tagged ones.
+
+		Files passed through as they are on disk (direct_passthrough) of
+			more than max_file_size bytes are sent uncompressed, keeping
+			their Content-Length, byte ranges and sendfile.
+
+		Compressed bodies of responses with a strong ETag are kept in an
+			LRU cache of up to cache_size bytes, keyed by the tag and
+			encoding, so unchanged contents are only compressed once.
+	"""
+
+	def __init__(self, levels=None, min_size=1024, cache_size=64 * 1024 * 1024,
+			max_file_size=1024 * 1024):
+		self.levels = dict(LEVELS)
+		self.levels.update(levels or {})
+		self.min_size = min_size
+		self.max_file_size = max_file_size
+		self.cache_size = cache_size
+		self.lock = threading.Lock()
+		self.cache = collections.OrderedDict() # (etag, encoding) -> bytes
+		self.used = 0 # Bytes in the cache
+		self.hits = 0
+		self.misses = 0
+
+		# In order of preference when the client has none
+		self.encodings = []
+		if zstandard is not None:
+			self.encodings.append('zstd')
+		if brotli is not None:
+			self.encodings.append('br')
+		self.encodings.append('gzip')
+
+	def apply(self, response, accept):
+		"""
+			Compresses response in place if it is worth it
+			accept: the request's Accept-Encoding, as parsed by werkzeug
+			Returns the response
+		"""
+		if response.status_code != 200 or not compressible(response.mimetype) \
+				or 'Content-Encoding' in response.headers:
+			return response
+
+		# Caches must not hand a compressed body to other clients
+		response.vary.add('Accept-Encoding')
+
+		encoding = accept.best_match(self.encodings)
+		if encoding is None:
+			return response
+
+		length = response.content_length
+		if not response.is_streamed:
+			length = len(response.get_data())
+		if length is not None and length < self.min_size:
+			return response
+		if response.direct_passthrough and (length is None or
+				length > self.max_file_size):
+			return response
+
+		etag, weak = response.get_etag()
+		key = None if etag is None or weak else (etag, encoding)
+
+		if response.is_streamed:
+			if hasattr(response.response, 'close'):
+				response.call_on_close(response.response.close)
+			response.response = self._stream(response.response, encoding, key)
+			response.direct_passthrough = True
+			del response.headers['Content-Length']
+		else:
+			data = self.get(key)
+			if data is None:
+				e = Encoder(encoding, self.levels[encoding])
+				data = e.compress(response.get_data()) + e.finish()
+				self.put(key, data)
+			response.set_data(data)
+
+		response.headers['Content-Encoding'] = encoding
+		response.headers.pop('Accept-Ranges', None) # Ranges are of the original
+		if etag is not None:
+			response.set_etag(etag, weak=True)
+		return response
+
+	def get(self, key):
+		"""
+			Returns the cached compressed body for key, or None
+		"""
+		if key is None:
+			return None
+		with self.lock:
+			data = self.cache.get(key)
+			if data is None:
+				self.misses += 1
+				return None
+			self.cache.move_to_end(key)
+			self.hits += 1
+			return data
+
+	def put(self, key, data):
+		if key is None or len(data) > self.cache_size / 8:
+			return
+		with self.lock:
+			old = self.cache.pop(key, None)
+			if old is not None:
+				self.used -= len(old)
+			self.cache[key] = data
+			self.used += len(data)
+
+			# Evict least recently used bodies
+			while self.used > self.cache_size:
+				self.used -= len(self.cache.popitem(last=False)[1])
+
+	def _stream(self, chunks, encoding, key):
+		data = self.get(key)
+		if data is not None:
+			yield data
+			return
+
+		e = Encoder(encoding, self.levels[encoding])
+		parts = [] # Kept for the cache while small enough
+		size = 0
+		for chunk in chunks:
+			if isinstance(chunk, str):
+				chunk = chunk.encode('utf-8')
+			out = e.compress(chunk) + e.flush()
+			if parts is not None:
+				parts.append(out)
+				size += len(out)
+				if key is None or size > self.cache_size / 8:
+					parts = None
+			yield out
+		out = e.finish()
+
+		if parts is not None:
+			parts.append(out)
+			self.put(key, b''.join(parts))
+		yield out
+
+def compressible(mimetype):
+	if mimetype is None:
+		return False
+	if mimetype.endswith('+xml') or mimetype.endswith('+json'):
+		return True
+	return not any(mimetype.startswith(x) for x in INCOMPRESSIBLE)
@@ -0,0 +1,86 @@
+import collections, os, threading, time
+from treeindex import RACY_NS
+
+class FileCache(object):
+	"""
+		In-memory cache of decoded file contents for file reads, keyed by
+			path and holding up to 'size' bytes of file data in LRU order.
+
+		Every read still stats the file, and an entry is only used while
+			the file has the same mtime, size and inode as when it was
+			read, so files changed by anything else are read again.
+			Files larger than size / 16 are not cached.
+
+		on_event(event) is called for every 'hit', 'miss' and 'eviction'.
+	"""
+
+	def __init__(self, size=32 * 1024 * 1024, on_event=None):
+		self.size = size
+		self.on_event = on_event or (lambda event: None)
+		self.lock = threading.Lock()
+		self.entries = collections.OrderedDict() # path -> (stamp, size, value)
+		self.used = 0 # Bytes of file data cached
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+
+	def read(self, path, decode):
+		"""
+			Returns decode(contents of path as bytes), reusing the cached
+				result while the file is unchanged.
+			Raises OSError like open(path, 'rb')
+		"""
+		path = os.path.normpath(path)
+		st = os.stat(path)
+		with self.lock:
+			entry = self.entries.get(path)
+			if entry is not None and entry[0] == stamp(st):
+				self.entries.move_to_end(path)
+				self.hits += 1
+				self.on_event('hit')
+				return entry[2]
+			self.misses += 1
+			self.on_event('miss')
+
+		with open(path, 'rb') as f:
+			st = os.fstat(f.fileno())
+			data = f.read()
+		value = decode(data)
+
+		with self.lock:
+			self._remove(path)
+			if len(data) <= self.size / 16 and \
+					time.time() * 1e9 - st.st_mtime_ns > RACY_NS:
+				self.entries[path] = (stamp(st), len(data), value)
+				self.used += len(data)
+
+				# Evict least recently used files
+				while self.used > self.size:
+					self._remove(next(iter(self.entries)))
+					self.evictions += 1
+					self.on_event('eviction')
+		return value
+
+	def invalidate(self, path):
+		"""
+			Drops path, or every file below it if it is a directory
+		"""
+		path = os.path.normpath(path)
+		with self.lock:
+			self._remove(path)
+			prefix = path + os.sep
+			for x in [x for x in self.entries if x.startswith(prefix)]:
+				self._remove(x)
+
+	def clear(self):
+		with self.lock:
+			self.entries.clear()
+			self.used = 0
+
+	def _remove(self, path):
+		entry = self.entries.pop(path, None)
+		if entry is not None:
+			self.used -= entry[1]
+
+def stamp(st):
+	return (st.st_mtime_ns, st.st_size, st.st_ino)
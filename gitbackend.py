@@ -0,0 +1,336 @@
+import heapq, os, re, struct, git, gitdb
+from gitdb.exc import BadObject
+import gitstatus
+from aheadcache import read_ref
+
+try:
+	import pygit2
+except ImportError:
+	pygit2 = None
+
+SHA_RE = re.compile(r'^[0-9a-f]{40}$')
+
+INFINITY = float('inf')
+
+class CLIBackend(object):
+	"""
+		Reads repositories for the endpoints by running git, as GitPython
+			does: a git process per status or ahead count.
+
+		Backends answer the same questions with the same results, and
+			other backends fall back to these methods for whatever they
+			don't do themselves. r is always a git.Repo.
+	"""
+
+	name = 'cli'
+
+	def head(self, r):
+		"""
+			Returns the sha HEAD points to, or None before the first commit
+		"""
+		return r.head.commit.hexsha if r.head.is_valid() else None
+
+	def ahead_behind(self, r, left, right):
+		"""
+			Counts the commits reachable from ref left but not from ref
+				right (ahead), and the other way around (behind)
+			Returns (ahead, behind), or None if a ref doesn't exist
+		"""
+		try:
+			counts = r.git.rev_list('--count', '--left-right',
+				left + '...' + right).split()
+		except git.GitCommandError:
+			return None
+		return int(counts[0]), int(counts[1])
+
+	def status(self, r):
+		"""
+			Returns the changes between HEAD and the work tree, see
+				gitstatus.status()
+		"""
+		return gitstatus.status(r)
+
+class PythonBackend(CLIBackend):
+	"""
+		Reads refs and walks commits in-process, with gitdb reading loose
+			and packed objects, so that HEAD and ahead counts don't start
+			a git process. Ahead counts need the generation numbers of a
+			commit-graph, as written by git maintenance, to know when to
+			stop walking; commit times can't be trusted to. Repositories
+			without one (or shallow ones, where git doesn't use it) are
+			left to git, as is anything gitdb can't read (e.g. objects a
+			partial clone hasn't fetched) and status, which needs git's
+			index, ignore and rename handling.
+	"""
+
+	name = 'python'
+
+	def head(self, r):
+		return read_ref(r.git_dir, 'HEAD')
+
+	def ahead_behind(self, r, left, right):
+		a, b = self._resolve(r, left), self._resolve(r, right)
+		if a is None or b is None:
+			return None
+		graph = self._graph(r) if not shallow(r) else None
+		if graph is None:
+			return CLIBackend.ahead_behind(self, r, left, right)
+		try:
+			return count_symmetric(self._odb(r), a, b, graph.generation)
+		except (BadObject, ValueError):
+			return CLIBackend.ahead_behind(self, r, left, right)
+
+	def _resolve(self, r, ref):
+		if SHA_RE.match(ref):
+			return ref
+		for name in [ref, 'refs/' + ref, 'refs/remotes/' + ref]:
+			sha = read_ref(r.git_dir, name)
+			if sha is not None:
+				return sha
+		return None
+
+	def _graph(self, r):
+		# Read again whenever git maintenance rewrites it
+		stamp = CommitGraph.stamp(r.git_dir)
+		graph = getattr(r, '_commit_graph', None)
+		if graph is None or graph.stamp != stamp:
+			graph = r._commit_graph = CommitGraph(r.git_dir, stamp)
+		return graph if graph.layers else None
+
+	def _odb(self, r):
+		# Kept with the pooled git.Repo, and rescanned for packs added
+		#	since (e.g. by a fetch or repack) when an object isn't found
+		odb = getattr(r, '_python_odb', None)
+		if odb is None:
+			odb = r._python_odb = RefreshingDB(
+				os.path.join(r.git_dir, 'objects'))
+		return odb
+
+class Pygit2Backend(CLIBackend):
+	"""
+		Reads refs and counts commits with libgit2, through pygit2.
+			Status is left to git, as pygit2 doesn't detect renames in
+			it.
+	"""
+
+	name = 'pygit2'
+
+	def head(self, r):
+		repo = self._repo(r)
+		return None if repo.head_is_unborn else str(repo.head.target)
+
+	def ahead_behind(self, r, left, right):
+		repo = self._repo(r)
+		try:
+			a = repo.revparse_single(left).id
+			b = repo.revparse_single(right).id
+		except (KeyError, ValueError):
+			return None
+		return repo.ahead_behind(a, b)
+
+	def _repo(self, r):
+		repo = getattr(r, '_pygit2', None)
+		if repo is None:
+			repo = r._pygit2 = pygit2.Repository(r.git_dir)
+		return repo
+
+BACKENDS = {x.name: x for x in [CLIBackend, PythonBackend, Pygit2Backend]}
+
+def get(name, logger=None):
+	"""
+		Returns the backend called name, or the CLI backend if pygit2 is
+			asked for but isn't installed
+		Raises ValueError for unknown backends
+	"""
+	if name not in BACKENDS:
+		raise ValueError('Unknown GIT_BACKEND ' + repr(name))
+	if name == 'pygit2' and pygit2 is None:
+		if logger is not None:
+			logger.warning('pygit2 is not installed, using the git CLI')
+		name = 'cli'
+	return BACKENDS[name]()
+
+class RefreshingDB(gitdb.GitDB):
+	def stream(self, sha):
+		try:
+			return gitdb.GitDB.stream(self, sha)
+		except BadObject:
+			self.update_cache(True)
+			return gitdb.GitDB.stream(self, sha)
+
+class CommitGraph(object):
+	"""
+		Generation numbers (topological levels: 1 for root commits, one
+			more than the highest of their parents otherwise) of the
+			commits in the commit-graph files of a repository, written
+			by git maintenance or 'git commit-graph write'. Files that
+			can't be read are left out.
+	"""
+
+	def __init__(self, git_dir, stamp=None):
+		self.stamp = stamp
+		self.layers = [] # [(fanout, oids, commit data)]
+		info = os.path.join(git_dir, 'objects', 'info')
+		paths = [os.path.join(info, 'commit-graph')]
+		try:
+			with open(os.path.join(info, 'commit-graphs',
+					'commit-graph-chain'), 'r') as f:
+				paths += [os.path.join(info, 'commit-graphs',
+					'graph-' + x.strip() + '.graph') for x in f if x.strip()]
+		except OSError:
+			pass
+		for path in paths:
+			try:
+				with open(path, 'rb') as f:
+					layer = read_graph(f.read())
+			except (OSError, ValueError, struct.error):
+				continue
+			if layer is not None:
+				self.layers.append(layer)
+
+	@staticmethod
+	def stamp(git_dir):
+		info = os.path.join(git_dir, 'objects', 'info')
+		stamps = []
+		for path in [info + '/commit-graph',
+				info + '/commit-graphs/commit-graph-chain']:
+			try:
+				st = os.stat(path)
+				stamps.append((st.st_mtime_ns, st.st_size, st.st_ino))
+			except OSError:
+				stamps.append(None)
+		return tuple(stamps)
+
+	def generation(self, binsha):
+		"""
+			Returns the generation number of a commit, or None if it isn't
+				in the commit-graph
+		"""
+		for fanout, oids, data in self.layers:
+			lo = fanout[binsha[0] - 1] if binsha[0] else 0
+			hi = fanout[binsha[0]]
+			while lo < hi:
+				mid = (lo + hi) // 2
+				oid = oids[mid * 20:mid * 20 + 20]
+				if oid == binsha:
+					return struct.unpack_from('>I', data, mid * 36 + 28)[0] >> 2
+				if oid < binsha:
+					lo = mid + 1
+				else:
+					hi = mid
+		return None
+
+def read_graph(data):
+	"""
+		Returns (fanout, oids, commit data) of a commit-graph file, or None
+			if it isn't a version git writes with SHA-1 object ids
+	"""
+	if data[:4] != b'CGPH' or data[4] != 1 or data[5] != 1:
+		return None
+	chunks = {}
+	for i in range(data[6] + 1):
+		name, offset = struct.unpack_from('>4sQ', data, 8 + i * 12)
+		chunks[name] = offset
+	offsets = sorted(chunks.values())
+
+	def chunk(name):
+		start = chunks[name]
+		return data[start:offsets[offsets.index(start) + 1]]
+
+	if not all(x in chunks for x in [b'OIDF', b'OIDL', b'CDAT']):
+		return None
+	fanout = struct.unpack('>256I', chunk(b'OIDF'))
+	oids, commits = chunk(b'OIDL'), chunk(b'CDAT')
+	if len(oids) != fanout[255] * 20 or len(commits) != fanout[255] * 36:
+		return None
+	return fanout, oids, commits
+
+def shallow(r):
+	"""
+		Returns the binary shas of the commits whose parents r doesn't have
+	"""
+	try:
+		with open(os.path.join(r.git_dir, 'shallow'), 'r') as f:
+			return set(bytes.fromhex(x.strip()) for x in f if x.strip())
+	except OSError:
+		return set()
+
+def read_commit(odb, binsha):
+	"""
+		Returns (committer time, [parent binary shas]) of a commit
+		Raises BadObject if it isn't there, ValueError if it isn't a commit
+	"""
+	stream = odb.stream(binsha)
+	if stream.type != b'commit':
+		raise ValueError('Not a commit')
+	data = stream.read()
+	header = data[:data.find(b'\n\n')] if b'\n\n' in data else data
+	parents = []
+	when = 0
+	for line in header.split(b'\n'):
+		if line.startswith(b'parent '):
+			parents.append(bytes.fromhex(line[7:].decode('ascii')))
+		elif line.startswith(b'committer '):
+			when = int(line.rsplit(b' ', 2)[1])
+	return when, parents
+
+def count_symmetric(odb, left, right, generation):
+	"""
+		Counts the commits reachable from left but not right, and the
+			other way around, like 'git rev-list --count --left-right
+			left...right'. Commits are walked from both sides, highest
+			generation number first, only until no commit left to walk
+			can lead to one seen from one side only, so the cost
+			depends on how far they diverged rather than on the length
+			of the history.
+
+		generation(binsha): generation number of a commit, or None if it
+			isn't known (commits made since the commit-graph was
+			written, which are never the parents of commits in it)
+		Returns (ahead, behind)
+	"""
+	LEFT, RIGHT, BOTH = 1, 2, 3
+	flags = {}
+	commits = {} # sha -> (time, parents, generation)
+	queue = [] # heap of (-generation, -time, sha, flags when queued)
+	pending = [0] # Entries in queue not yet known to be reachable from both
+	lowest = [INFINITY] # Generation of the lowest commit seen from one side
+
+	def mark(sha, flag):
+		# Adds flag to sha, queueing it again if that is news
+		old = flags.get(sha, 0)
+		if old | flag == old:
+			return
+		flags[sha] = old | flag
+		if sha not in commits:
+			when, parents = read_commit(odb, sha)
+			gen = generation(sha)
+			commits[sha] = (when, parents, INFINITY if gen is None else gen)
+		heapq.heappush(queue, (-commits[sha][2], -commits[sha][0], sha,
+			old | flag))
+		if old | flag != BOTH:
+			pending[0] += 1
+			lowest[0] = min(lowest[0], commits[sha][2])
+
+	def more():
+		# A commit can only lead to commits of lower generation, and
+		#	commits without one to any commit
+		if not queue:
+			return False
+		top = -queue[0][0]
+		return pending[0] > 0 or top == INFINITY or top > lowest[0]
+
+	mark(bytes.fromhex(left), LEFT)
+	mark(bytes.fromhex(right), RIGHT)
+	while more():
+		gen, when, sha, flag = heapq.heappop(queue)
+		if flag != BOTH:
+			pending[0] -= 1
+		if flags[sha] != flag:
+			continue # Queued again with more flags
+		for parent in commits[sha][1]:
+			mark(parent, flag)
+
+	ahead = sum(1 for x in flags.values() if x == LEFT)
+	behind = sum(1 for x in flags.values() if x == RIGHT)
+	return ahead, behind
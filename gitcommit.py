@@ -0,0 +1,242 @@
+import io, os, re, shutil, tempfile, uuid, git
+from gitdb import IStream
+
+# Pathspecs that may match more than the one path they name: globs and
+#	those with magic like ':(top)'
+GLOB_RE = re.compile(r'[*?[\\]|^:')
+
+class PathspecError(Exception):
+	"""
+		A path or pathspec to stage matches no file
+	"""
+
+	def __init__(self, path):
+		Exception.__init__(self, path)
+		self.path = path
+
+class PathConflict(Exception):
+	"""
+		A file to write is below a file that stays, or above another file
+			to write
+	"""
+
+	def __init__(self, path):
+		Exception.__init__(self, path)
+		self.path = path
+
+class HeadMoved(Exception):
+	"""
+		HEAD isn't at the commit the changes were based on
+	"""
+
+	def __init__(self, head):
+		Exception.__init__(self, head)
+		self.head = head
+
+def commit_files(r, files, message, actor, parent=None):
+	"""
+		Commits files ({path: contents as bytes, or None to delete it}) on
+			top of HEAD of r, together with whatever else is staged.
+
+		The contents are written as blobs straight into the object
+			database and put into the index from there, so they are
+			written and hashed once, not written to the work tree and
+			read back. The work tree files are written to temporary files
+			first and only moved into place once HEAD points to the new
+			commit, so a failed commit leaves the work tree as it was.
+
+		A file can replace a directory, or a directory a file, if
+			whatever is in the way is deleted in the same commit or
+			only in the work tree. Index entries in the way are dropped.
+
+		parent: hexsha HEAD must be at, raises HeadMoved otherwise
+		Returns the new git.Commit
+		Raises FileNotFoundError if a file to delete doesn't exist,
+			IsADirectoryError if a path is a directory with files that
+			stay, or PathConflict if a path is below a file that stays or
+			above another file to write
+	"""
+	head = r.head.commit.hexsha if r.head.is_valid() else None
+	if parent is not None and parent != head:
+		raise HeadMoved(head)
+
+	deleted = set(x for x in files if files[x] is None)
+	written = sorted(x for x in files if files[x] is not None)
+
+	index = r.index
+	staged = {} # path -> temporary file in .git
+	try:
+		for path in sorted(deleted):
+			fullpath = os.path.join(r.working_tree_dir, path)
+			if os.path.isdir(fullpath) and not os.path.islink(fullpath):
+				raise IsADirectoryError(path)
+			if (path, 0) not in index.entries and not os.path.lexists(fullpath):
+				raise FileNotFoundError(path)
+			index.entries.pop((path, 0), None)
+
+		for path in written:
+			fullpath = os.path.join(r.working_tree_dir, path)
+			key = (path, 0)
+			clear_path(r, index, path, deleted, written)
+
+			data = files[path]
+
+			istream = r.odb.store(IStream(git.Blob.type, len(data),
+				io.BytesIO(data)))
+			# Only the executable bit is kept: symlinks and submodules
+			#	written over become regular files
+			mode = git.Blob.file_mode
+			if key in index.entries and \
+					index.entries[key].mode == git.Blob.executable_mode:
+				mode = git.Blob.executable_mode
+			index.entries[key] = git.IndexEntry.from_base(
+				git.BaseIndexEntry((mode, istream.binsha, 0, path)))
+			staged[path] = stage(r, data)
+
+		index.write()
+		commit = index.commit(message, author=actor, committer=actor)
+	except:
+		for tmp in staged.values():
+			os.remove(tmp)
+		raise
+
+	# Update the work tree to match the commit, deleting first so that
+	#	deleted files and emptied directories make way for new ones
+	for path in deleted:
+		fullpath = os.path.join(r.working_tree_dir, path)
+		if os.path.lexists(fullpath):
+			os.remove(fullpath)
+			try:
+				os.removedirs(os.path.dirname(fullpath))
+			except OSError:
+				pass # Not empty
+	for path in written:
+		fullpath = os.path.join(r.working_tree_dir, path)
+		if os.path.isdir(fullpath) and not os.path.islink(fullpath):
+			shutil.rmtree(fullpath) # Holds no files, see clear_path()
+		elif os.path.exists(fullpath) and not os.path.islink(fullpath):
+			shutil.copymode(fullpath, staged[path])
+		os.makedirs(os.path.dirname(fullpath), exist_ok=True)
+		os.replace(staged[path], fullpath)
+	return commit
+
+def clear_path(r, index, path, deleted, written):
+	"""
+		Drops the index entries in the way of writing the file path: the
+			files above it and everything below it
+		Raises IsADirectoryError or PathConflict if the work tree or the
+			other files to write are in the way, see commit_files()
+	"""
+	if any(x.startswith(path + '/') for x in written):
+		raise PathConflict(path)
+	parts = path.split('/')
+	for i in range(1, len(parts)):
+		parent = '/'.join(parts[:i])
+		fullpath = os.path.join(r.working_tree_dir, parent)
+		if parent not in deleted and (os.path.islink(fullpath) or
+				os.path.lexists(fullpath) and not os.path.isdir(fullpath)):
+			raise PathConflict(path)
+		index.entries.pop((parent, 0), None)
+
+	fullpath = os.path.join(r.working_tree_dir, path)
+	if os.path.isdir(fullpath) and not os.path.islink(fullpath):
+		for dirpath, dirnames, filenames in os.walk(fullpath):
+			for name in filenames:
+				rel = os.path.relpath(os.path.join(dirpath, name),
+					r.working_tree_dir)
+				if rel not in deleted:
+					raise IsADirectoryError(path)
+	for key in [x for x in index.entries if x[0].startswith(path + '/')]:
+		del index.entries[key]
+
+def stage(r, data):
+	"""
+		Writes data to a temporary file in the .git directory of r, which
+			is on the same file system as the work tree
+		Returns the path of the temporary file
+	"""
+	tmp = os.path.join(r.git_dir, 'storage-commit-' + uuid.uuid4().hex + '.tmp')
+	with open(os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666),
+			'wb') as f:
+		f.write(data)
+	return tmp
+
+def stage_changes(r, add=(), remove=(), everything=False):
+	"""
+		Stages changes in the work tree of r in a few git commands, each
+			updating the index once, rather than one path at a time.
+
+		add: paths, directories or globs (git pathspecs) whose changes
+			are staged: new, modified and deleted files. Files named
+			explicitly are added even if ignored.
+		remove: paths, directories or globs to remove from the index,
+			keeping the files
+		everything: stage every change in the work tree, like git add -A
+		Raises PathspecError if a path or pathspec matches no file
+	"""
+	files, specs = split_pathspecs(r, add)
+	removed, remove_specs = split_pathspecs(r, remove)
+
+	# Deleted files and those to remove have to be known to git, since
+	#	update-index skips paths that aren't
+	missing = [x for x in files
+		if not os.path.lexists(os.path.join(r.working_tree_dir, x))]
+	if missing or removed:
+		known = set(r.git.ls_files('-z').split('\0'))
+		for path in missing + removed:
+			if path not in known:
+				raise PathspecError(path)
+
+	if files:
+		with nul_separated(files) as f:
+			r.git.update_index('--add', '--remove', '-z', '--stdin', istream=f)
+	if removed:
+		with nul_separated(removed) as f:
+			r.git.update_index('--force-remove', '-z', '--stdin', istream=f)
+	try:
+		if everything:
+			r.git.add('-A')
+		if specs:
+			r.git.add('-A', '--', *specs)
+		if remove_specs:
+			r.git.rm('--cached', '-r', '-q', '--', *remove_specs)
+	except git.GitCommandError as e:
+		if 'did not match' in str(e.stderr):
+			raise PathspecError(e.stderr)
+		raise
+
+def split_pathspecs(r, paths):
+	"""
+		Returns (files, pathspecs): the paths that name a single file (or
+			a deleted one), and directories, globs and other pathspecs
+	"""
+	files, specs = [], []
+	for path in paths:
+		if GLOB_RE.search(path) is None and \
+				not os.path.isdir(os.path.join(r.working_tree_dir, path)):
+			files.append(os.path.normpath(path))
+		else:
+			specs.append(path)
+	return files, specs
+
+def nul_separated(paths):
+	"""
+		Returns a temporary file listing paths for git's -z --stdin
+	"""
+	f = tempfile.TemporaryFile()
+	f.write(b''.join(x.encode('utf-8') + b'\0' for x in paths))
+	f.seek(0)
+	return f
+
+def changes(r, commit):
+	"""
+		Returns the files commit changed from its first parent (or all of
+			them for a root commit) as {'A': [...], 'M': [...], 'D': [...]}
+	"""
+	result = {'A': [], 'M': [], 'D': []}
+	out = r.git.diff_tree('-r', '-z', '--name-status', '--no-renames',
+		'--no-commit-id', '--root', commit.hexsha)
+	fields = out.split('\0')
+	for status, path in zip(fields[0::2], fields[1::2]):
+		result.setdefault(status[0], []).append(path)
+	return result
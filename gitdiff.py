@@ -0,0 +1,322 @@
+import collections, os, threading
+
+# Tree with nothing in it, to diff against before the first commit
+EMPTY_TREE = '4b825dc642cb6eb9a060e54bf8d69288fbee4904'
+
+# Sha git gives files in the work tree it hasn't hashed since they changed
+NULL_SHA = '0' * 40
+
+# More paths than this are diffed by the pathspecs they were listed with
+#	rather than one by one, to stay within the command line limit
+MAX_PATHSPECS = 1000
+
+GITLINK = '160000'
+SYMLINK = '120000'
+
+class DiffCache(object):
+	"""
+		In-memory cache of the hunks of computed diffs, keyed by the blob
+			shas of both sides and the lines of context, and holding up
+			to 'size' bytes of hunks in LRU order.
+
+		A pair of blobs always has the same diff, so entries never need
+			to be invalidated, and are shared by every path, commit and
+			repository with the same contents.
+	"""
+
+	def __init__(self, size=32 * 1024 * 1024):
+		self.size = size
+		self.lock = threading.Lock()
+		self.entries = collections.OrderedDict() # key -> (binary, hunks)
+		self.used = 0 # Bytes of hunks cached
+		self.hits = 0
+		self.misses = 0
+
+	def get(self, key):
+		"""
+			Returns (binary, hunks) cached for key, or None
+		"""
+		with self.lock:
+			entry = self.entries.get(key)
+			if entry is None:
+				self.misses += 1
+				return None
+			self.entries.move_to_end(key)
+			self.hits += 1
+			return entry
+
+	def put(self, key, binary, hunks):
+		if len(hunks) > self.size / 16:
+			return
+		with self.lock:
+			old = self.entries.pop(key, None)
+			if old is not None:
+				self.used -= len(old[1])
+			self.entries[key] = (binary, hunks)
+			self.used += len(hunks)
+
+			# Evict least recently used diffs
+			while self.used > self.size:
+				self.used -= len(self.entries.popitem(last=False)[1][1])
+
+def list_changes(r, base, target=None, paths=(), hash_file=None,
+		max_size=None):
+	"""
+		Returns the files changed between commits base and target, or
+			between base and the work tree (staged or not) if target is
+			None, in git's order. Changes are dictionaries of 'path',
+			'status' (A, M or D) and the pairs (old, new) 'mode', 'sha'
+			and 'size', with None for the side that doesn't exist.
+		paths: pathspecs the files are limited to
+		hash_file(fullpath): blob sha of a work tree file (of its target
+			for symlinks), for files git hasn't hashed since they changed.
+			Those larger than max_size bytes aren't hashed and keep
+			NULL_SHA.
+	"""
+	if target is None:
+		out = r.git.diff_index('-z', '--raw', '--no-renames', base, '--',
+			*paths)
+	else:
+		out = r.git.diff_tree('-r', '-z', '--raw', '--no-renames', base,
+			target, '--', *paths)
+
+	fields = out.split('\0')
+	result = []
+	for meta, path in zip(fields[0::2], fields[1::2]):
+		mode_a, mode_b, sha_a, sha_b, status = meta.lstrip(':').split(' ')
+		status = status[:1]
+		if status not in ['A', 'D']:
+			status = 'M' # Modified, type changed or unmerged
+		change = {'path': path, 'status': status,
+			'mode': [None if status == 'A' else mode_a,
+				None if status == 'D' else mode_b],
+			'sha': [None if status == 'A' else sha_a,
+				None if status == 'D' else sha_b],
+			'size': [None, None]}
+
+		for side in [0, 1]:
+			sha = change['sha'][side]
+			if sha is None or change['mode'][side] == GITLINK:
+				continue
+			if sha != NULL_SHA:
+				change['size'][side] = r.odb.info(bytes.fromhex(sha)).size
+				continue
+
+			fullpath = os.path.join(r.working_tree_dir, path)
+			try:
+				if change['mode'][side] == SYMLINK:
+					link = os.readlink(fullpath).encode('utf-8',
+						'surrogateescape')
+					change['size'][side] = len(link)
+					change['sha'][side] = hash_file(fullpath)
+				else:
+					change['size'][side] = os.stat(fullpath).st_size
+					if max_size is None or change['size'][side] <= max_size:
+						change['sha'][side] = hash_file(fullpath)
+			except OSError:
+				pass # Changed since it was listed, left to git diff
+
+		# Touched in the work tree without changing
+		if change['sha'][0] == change['sha'][1] and \
+				change['mode'][0] == change['mode'][1]:
+			continue
+		result.append(change)
+	return result
+
+def too_large(change, max_size):
+	return max_size is not None and \
+		max(x or 0 for x in change['size']) > max_size
+
+def cache_key(change, context):
+	"""
+		Returns the key of the diff of change in DiffCache, or None if the
+			contents of a side aren't known
+	"""
+	if NULL_SHA in change['sha'] or GITLINK in change['mode']:
+		return None
+	return change['sha'][0], change['sha'][1], context
+
+def patches(r, base, target, changes, paths=(), context=3, max_size=None,
+		cache=None):
+	"""
+		Yields the unified diff of each change (see list_changes) between
+			base and target as bytes, in git's patch format with full
+			index shas.
+
+		Diffs are taken from cache where possible, and the rest are
+			computed by a single 'git diff' whose output is streamed file
+			by file as git writes it. Binary files, and files with a side
+			larger than max_size bytes, are listed without their
+			contents.
+	"""
+	cached = {}
+	missing = []
+	for change in changes:
+		if too_large(change, max_size):
+			continue
+		key = cache_key(change, context)
+		entry = cache.get(key) if cache is not None and key else None
+		if entry is not None:
+			cached[change['path']] = entry
+		else:
+			missing.append(change['path'])
+
+	proc = None
+	parts = iter(())
+	if missing:
+		if len(missing) <= MAX_PATHSPECS:
+			paths = [':(literal)' + x for x in missing]
+		args = ['-U%d' % context, '--no-renames', '--no-color', '--no-ext-diff',
+			'--no-textconv', '--full-index', '--src-prefix=a/',
+			'--dst-prefix=b/', base]
+		if target is not None:
+			args.append(target)
+		proc = r.git(c='core.quotePath=false').diff(*(args + ['--'] + paths),
+			as_process=True)
+		parts = split_patches(proc.stdout)
+
+	try:
+		found = {} # path -> (binary, hunks) read ahead from git
+		wanted = set(missing)
+		for change in changes:
+			path = change['path']
+			if too_large(change, max_size):
+				yield patch(change, kind='large')
+				continue
+
+			entry = cached.get(path)
+			while entry is None:
+				entry = found.pop(path, None)
+				if entry is not None:
+					break
+				part = next(parts, None)
+				if part is None:
+					break # Changed back since it was listed
+				if part[0] in wanted:
+					found[part[0]] = part[1:]
+			if entry is None:
+				continue
+
+			binary, hunks = entry
+			if path not in cached:
+				key = cache_key(change, context)
+				if cache is not None and key is not None:
+					cache.put(key, binary, hunks)
+			yield patch(change, hunks, 'binary' if binary else None)
+	finally:
+		if proc is not None:
+			proc.proc.stdout.close()
+			proc.proc.kill()
+			proc.proc.wait()
+
+def patch(change, hunks=b'', kind=None):
+	"""
+		Returns the patch of change as bytes
+		kind: 'binary' or 'large' for files listed without their hunks
+	"""
+	path = change['path']
+	mode_a, mode_b = change['mode']
+	sha_a, sha_b = change['sha']
+	a = '/dev/null' if mode_a is None else quote('a/' + path)
+	b = '/dev/null' if mode_b is None else quote('b/' + path)
+
+	lines = ['diff --git %s %s' % (quote('a/' + path), quote('b/' + path))]
+	if mode_a is None:
+		lines.append('new file mode ' + mode_b)
+	elif mode_b is None:
+		lines.append('deleted file mode ' + mode_a)
+	elif mode_a != mode_b:
+		lines.append('old mode ' + mode_a)
+		lines.append('new mode ' + mode_b)
+	if sha_a != sha_b and kind != 'large':
+		index = 'index %s..%s' % (sha_a or NULL_SHA, sha_b or NULL_SHA)
+		if mode_a == mode_b:
+			index += ' ' + mode_a
+		lines.append(index)
+
+	if kind == 'large':
+		lines.append('File %s and %s are too large to diff (%d bytes)' %
+			(a, b, max(x or 0 for x in change['size'])))
+	elif kind == 'binary':
+		lines.append('Binary files %s and %s differ' % (a, b))
+	elif hunks:
+		lines.append('--- ' + a)
+		lines.append('+++ ' + b)
+	text = '\n'.join(lines) + '\n'
+	return text.encode('utf-8', 'surrogateescape') + \
+		(hunks if kind is None else b'')
+
+def split_patches(lines):
+	"""
+		Splits the output of git diff into (path, binary, hunks) per file
+	"""
+	path = None
+	for line in lines:
+		if line.startswith(b'diff --git '):
+			if path is not None:
+				yield path, binary, b''.join(hunks)
+			path, binary, hunks, header = diff_path(line), False, [], True
+		elif path is None:
+			continue
+		elif header:
+			if line.startswith(b'@@'):
+				header = False
+				hunks.append(line)
+			elif line.startswith(b'Binary files '):
+				binary = True
+		else:
+			hunks.append(line)
+	if path is not None:
+		yield path, binary, b''.join(hunks)
+
+def diff_path(line):
+	"""
+		Returns the path of a 'diff --git a/<path> b/<path>' line
+	"""
+	names = line[len(b'diff --git '):].rstrip(b'\n')
+	if names.startswith(b'"'):
+		name = unquote(names)
+	else:
+		# Both names are the same without renames
+		name = names[:(len(names) - 1) // 2]
+	return name[2:].decode('utf-8', 'surrogateescape')
+
+ESCAPES = {'\a': 'a', '\b': 'b', '\t': 't', '\n': 'n', '\v': 'v', '\f': 'f',
+	'\r': 'r', '"': '"', '\\': '\\'}
+UNESCAPES = {v.encode('ascii'): k.encode('ascii') for k, v in ESCAPES.items()}
+
+def quote(name):
+	"""
+		Quotes name like git does with core.quotePath off, if it has
+			quotes, backslashes or control characters
+	"""
+	if not any(c in ESCAPES or ord(c) < 0x20 or c == '\x7f' for c in name):
+		return name
+	out = []
+	for c in name:
+		if c in ESCAPES:
+			out.append('\\' + ESCAPES[c])
+		elif ord(c) < 0x20 or c == '\x7f':
+			out.append('\\%03o' % ord(c))
+		else:
+			out.append(c)
+	return '"' + ''.join(out) + '"'
+
+def unquote(data):
+	"""
+		Returns the first of git's C-style quoted names in data as bytes
+	"""
+	out = bytearray()
+	i = 1
+	while i < len(data) and data[i:i + 1] != b'"':
+		c = data[i:i + 1]
+		if c != b'\\':
+			out += c
+			i += 1
+		elif data[i + 1:i + 2].isdigit():
+			out.append(int(data[i + 1:i + 4], 8))
+			i += 4
+		else:
+			out += UNESCAPES.get(data[i + 1:i + 2], data[i + 1:i + 2])
+			i += 2
+	return bytes(out)
@@ -0,0 +1,97 @@
+# Change types reported by the status endpoint
+CHANGE_TYPES = ['A', 'D', 'R', 'M']
+
+def status(r):
+	"""
+		Gets the changes between HEAD and the working directory of r,
+			together with untracked files, from a single
+			'git status --porcelain=v2 -z' run
+		Returns a dictionary of change type (A, D, R, M) to a list of
+			{'A': path in HEAD, 'B': path in the working directory},
+			plus 'U' with a list of untracked paths
+	"""
+	output = r.git.status('--porcelain=v2', '-z', '--untracked-files=all',
+		'--find-renames')
+	return parse(output)
+
+def parse(output):
+	"""
+		Parses 'git status --porcelain=v2 -z' output, see status()
+	"""
+	changes = {x: [] for x in CHANGE_TYPES}
+	changes['U'] = []
+
+	fields = output.split('\0')
+	i = 0
+	while i < len(fields):
+		line = fields[i]
+		i += 1
+
+		if line.startswith('1 '):
+			# Ordinary change: 1 XY sub mH mI mW hH hI path
+			parts = line.split(' ', 8)
+			ct = combine(parts[1])
+			if ct == 'A':
+				changes['A'].append({'B': parts[8]})
+			elif ct == 'D':
+				changes['D'].append({'A': parts[8]})
+			elif ct == 'M':
+				changes['M'].append({'A': parts[8], 'B': parts[8]})
+
+		elif line.startswith('2 '):
+			# Rename or copy: 2 XY sub mH mI mW hH hI Xscore path\0orig
+			parts = line.split(' ', 9)
+			orig = fields[i]
+			i += 1
+			if parts[1][1] == 'D':
+				changes['D'].append({'A': orig})
+			elif parts[1][0] == 'C':
+				changes['A'].append({'B': parts[9]})
+			else:
+				changes['R'].append({'A': orig, 'B': parts[9]})
+
+		elif line.startswith('u '):
+			# Unmerged: u XY sub m1 m2 m3 mW h1 h2 h3 path
+			path = line.split(' ', 10)[10]
+			changes['M'].append({'A': path, 'B': path})
+
+		elif line.startswith('? '):
+			changes['U'].append(line[2:])
+
+	return changes
+
+def combine(xy):
+	"""
+		Combines the index (X) and working tree (Y) status letters of a
+			porcelain entry into the change between HEAD and the working
+			tree, or None if there is none (e.g. added, then deleted)
+	"""
+	x, y = xy[0], xy[1]
+	if y == 'D' or x == 'D':
+		return None if x == 'A' else 'D'
+	if x == 'A' or y == 'A':
+		return 'A'
+	return 'M'
+
+def tune(r, fsmonitor=False):
+	"""
+		Enables the untracked cache for r, and optionally git's built-in
+			filesystem monitor, so that repeated status calls don't
+			rescan everything.
+
+		The split index is turned off again if an earlier version enabled
+			it, as GitPython can't read split indexes (e.g. to commit).
+	"""
+	writer = r.config_writer()
+	try:
+		split = writer.get_value('core', 'splitIndex', False)
+		writer.set_value('core', 'untrackedCache', 'true')
+		if split:
+			writer.set_value('core', 'splitIndex', 'false')
+		if fsmonitor:
+			writer.set_value('core', 'fsmonitor', 'true')
+	finally:
+		writer.release()
+
+	if split:
+		r.git.update_index('--no-split-index')
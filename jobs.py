@@ -0,0 +1,178 @@
+import collections, concurrent.futures, json, os, re, threading, time, uuid, git
+
+JOB_ID_RE = re.compile(r'^[0-9a-f]{32}$')
+
+class Job(object):
+	"""
+		A queued operation with its state, progress and result
+	"""
+
+	def __init__(self, kind, key):
+		self.id = uuid.uuid4().hex
+		self.kind = kind
+		self.key = key
+		self.state = 'queued' # queued, running, done or failed
+		self.progress = None
+		self.result = None
+		self.created = time.time()
+		self.finished = None
+		self.saved = 0 # When progress was last written out
+		self.on_change = None
+
+	def to_dict(self):
+		return {
+			'id': self.id,
+			'type': self.kind,
+			'state': self.state,
+			'progress': self.progress,
+			'result': self.result
+		}
+
+	def changed(self, progress=False):
+		# Progress is reported very often, so only pass it on now and then
+		if self.on_change is None:
+			return
+		if progress and time.time() - self.saved < 0.5:
+			return
+		self.saved = time.time()
+		self.on_change(self)
+
+class JobQueue(object):
+	"""
+		Runs jobs on a bounded thread pool. Jobs with the same key (e.g.
+			repository path) run one at a time in the order they were
+			submitted, jobs with different keys run in parallel.
+			Finished jobs are kept for 'ttl' seconds.
+
+		If path is set, jobs are also written to JSON files in that
+			directory so they can be looked up from other worker
+			processes of the same server.
+	"""
+
+	def __init__(self, workers=4, ttl=3600, path=None):
+		self.ttl = ttl
+		self.path = path
+		self.pool = concurrent.futures.ThreadPoolExecutor(workers)
+		self.lock = threading.Lock()
+		self.jobs = {} # id -> Job
+		self.queues = {} # key -> deque of (Job, function) waiting to run
+
+		if path is not None:
+			os.makedirs(path, exist_ok=True)
+
+	def submit(self, kind, key, fn):
+		"""
+			Queues fn(job) to run after earlier jobs with the same key.
+				Its return value becomes the result of the job.
+			Returns the Job
+		"""
+		job = Job(kind, key)
+		if self.path is not None:
+			job.on_change = self._save
+			self._save(job)
+
+		with self.lock:
+			self._prune()
+			self.jobs[job.id] = job
+
+			# Start a runner unless one is already working on this key
+			if key in self.queues:
+				self.queues[key].append((job, fn))
+				return job
+			self.queues[key] = collections.deque([(job, fn)])
+
+		self.pool.submit(self._run, key)
+		return job
+
+	def get(self, job_id):
+		"""
+			Returns the Job with job_id, or None if it is unknown
+		"""
+		job = self.jobs.get(job_id)
+		if job is not None or self.path is None or not JOB_ID_RE.match(job_id):
+			return job
+
+		# Queued by another process
+		try:
+			with open(self.path + '/' + job_id + '.json', 'r') as f:
+				data = json.load(f)
+		except (OSError, ValueError):
+			return None
+		job = Job(data['type'], data['key'])
+		job.id = data['id']
+		job.state = data['state']
+		job.progress = data['progress']
+		job.result = data['result']
+		return job
+
+	def _run(self, key):
+		while True:
+			with self.lock:
+				if not self.queues[key]:
+					del self.queues[key]
+					return
+				job, fn = self.queues[key].popleft()
+
+			job.state = 'running'
+			job.changed()
+			try:
+				job.result = fn(job)
+				job.state = 'done'
+			except Exception as e:
+				job.result = {'error': str(e)}
+				job.state = 'failed'
+			job.finished = time.time()
+			job.changed()
+
+	def _save(self, job):
+		data = job.to_dict()
+		data['key'] = job.key
+		tmp = self.path + '/.' + job.id + '.' + uuid.uuid4().hex
+		try:
+			with open(tmp, 'w') as f:
+				json.dump(data, f)
+			os.replace(tmp, self.path + '/' + job.id + '.json')
+		except OSError:
+			pass
+
+	def _prune(self):
+		cutoff = time.time() - self.ttl
+		for x in [x for x in self.jobs.values()
+				if x.finished is not None and x.finished < cutoff]:
+			del self.jobs[x.id]
+
+		if self.path is not None:
+			try:
+				for name in os.listdir(self.path):
+					if os.stat(self.path + '/' + name).st_mtime < cutoff:
+						os.remove(self.path + '/' + name)
+			except OSError:
+				pass # Removed by another process
+
+class JobProgress(git.RemoteProgress):
+	"""
+		Records the progress reported by git on a Job
+	"""
+
+	STAGES = {
+		git.RemoteProgress.COUNTING: 'counting',
+		git.RemoteProgress.COMPRESSING: 'compressing',
+		git.RemoteProgress.WRITING: 'writing',
+		git.RemoteProgress.RECEIVING: 'receiving',
+		git.RemoteProgress.RESOLVING: 'resolving',
+		git.RemoteProgress.FINDING_SOURCES: 'finding sources',
+		git.RemoteProgress.CHECKING_OUT: 'checking out'
+	}
+
+	def __init__(self, job):
+		git.RemoteProgress.__init__(self)
+		self.job = job
+
+	def update(self, op_code, cur_count, max_count=None, message=''):
+		self.job.progress = {
+			'stage': self.STAGES.get(op_code & self.OP_MASK),
+			'current': cur_count,
+			'total': max_count,
+			'message': message
+		}
+		self.job.changed(True)
@@ -0,0 +1,150 @@
+import collections, fcntl, hashlib, os, threading, time
+
+class LockTimeout(Exception):
+	pass
+
+class RWLock(object):
+	"""
+		Fair reader/writer lock. Waiters are served in arrival order:
+			consecutive readers share the lock, a writer waits for the
+			readers ahead of it and readers arriving after a waiting
+			writer queue behind it, so neither side can starve.
+	"""
+
+	def __init__(self):
+		self.cond = threading.Condition(threading.Lock())
+		self.readers = 0
+		self.writer = False
+		self.queue = collections.deque()
+		self.users = 0 # Holders and waiters, managed by LockManager
+
+	def acquire(self, exclusive=False, timeout=None):
+		"""
+			Waits until the lock is granted, raises LockTimeout if that
+				takes longer than timeout seconds
+		"""
+		deadline = None if timeout is None else time.time() + timeout
+		me = object()
+		with self.cond:
+			self.queue.append(me)
+			while self.queue[0] is not me or self.writer or \
+					(exclusive and self.readers > 0):
+				remaining = None if deadline is None else deadline - time.time()
+				if remaining is not None and remaining <= 0:
+					self.queue.remove(me)
+					self.cond.notify_all()
+					raise LockTimeout()
+				self.cond.wait(remaining)
+
+			self.queue.popleft()
+			if exclusive:
+				self.writer = True
+			else:
+				self.readers += 1
+			self.cond.notify_all() # The next reader may go too
+
+	def release(self, exclusive=False):
+		with self.cond:
+			if exclusive:
+				self.writer = False
+			else:
+				self.readers -= 1
+			self.cond.notify_all()
+
+class LockManager(object):
+	"""
+		Hands out a RWLock per key (e.g. repository path), dropping it
+			once nobody holds or waits for it, and records how long
+			acquiring took for each mode.
+
+		The RWLocks only order threads of one process. If lockdir is set
+			an flock() on a file in it is taken as well, so that worker
+			processes of the same server exclude each other too.
+
+		on_wait(mode, seconds, timed out) is called after every
+			acquisition, mode being 'shared' or 'exclusive'.
+	"""
+
+	def __init__(self, timeout=None, lockdir=None, on_wait=None):
+		self.timeout = timeout
+		self.lockdir = lockdir
+		self.on_wait = on_wait
+		self.lock = threading.Lock()
+		self.locks = {}
+		self.stats = {
+			x: {'count': 0, 'timeouts': 0, 'wait': 0.0, 'max_wait': 0.0}
+			for x in ['shared', 'exclusive']
+		}
+
+	def acquire(self, key, exclusive=False):
+		"""
+			Locks key, shared or exclusive
+			Returns a token to pass to release()
+			Raises LockTimeout if not granted within the timeout
+		"""
+		with self.lock:
+			l = self.locks.get(key)
+			if l is None:
+				l = self.locks[key] = RWLock()
+			l.users += 1
+
+		start = time.time()
+		fd = None
+		try:
+			l.acquire(exclusive, self.timeout)
+			if self.lockdir is not None:
+				try:
+					fd = self._flock(key, exclusive, start)
+				except:
+					l.release(exclusive)
+					raise
+		except LockTimeout:
+			self._record(exclusive, time.time() - start, True)
+			self._drop(key, l)
+			raise
+
+		self._record(exclusive, time.time() - start, False)
+		return (key, l, exclusive, fd)
+
+	def release(self, token):
+		key, l, exclusive, fd = token
+		if fd is not None:
+			os.close(fd) # Drops the flock
+		l.release(exclusive)
+		self._drop(key, l)
+
+	def _flock(self, key, exclusive, start):
+		# Polls for the file lock of key until the timeout runs out
+		os.makedirs(self.lockdir, exist_ok=True)
+		name = hashlib.sha1(key.encode('utf-8')).hexdigest()
+		fd = os.open(self.lockdir + '/' + name, os.O_RDWR | os.O_CREAT, 0o666)
+		mode = (fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH) | fcntl.LOCK_NB
+		while True:
+			try:
+				fcntl.flock(fd, mode)
+				return fd
+			except BlockingIOError:
+				if self.timeout is not None and \
+						time.time() - start >= self.timeout:
+					os.close(fd)
+					raise LockTimeout()
+				time.sleep(0.01)
+
+	def _drop(self, key, l):
+		with self.lock:
+			l.users -= 1
+			if l.users == 0:
+				del self.locks[key]
+
+	def _record(self, exclusive, wait, timed_out):
+		mode = 'exclusive' if exclusive else 'shared'
+		with self.lock:
+			s = self.stats[mode]
+			if timed_out:
+				s['timeouts'] += 1
+			else:
+				s['count'] += 1
+			s['wait'] += wait
+			s['max_wait'] = max(s['max_wait'], wait)
+		if self.on_wait is not None:
+			self.on_wait(mode, wait, timed_out)
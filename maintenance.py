@@ -0,0 +1,163 @@
+import collections, os, threading, time
+from threads import start_once_per_process
+
+# git maintenance tasks run on repositories that have been written to, in
+#	this order: pack loose objects (and delete those already packed),
+#	gather small packs into bigger ones under a multi-pack-index, then
+#	update the commit-graph and pack refs
+TASKS = ['loose-objects', 'incremental-repack', 'commit-graph', 'pack-refs']
+
+class Maintainer(object):
+	"""
+		Keeps repositories fast by running git maintenance on them in the
+			background as they are written to.
+
+		wrote(path) is called after every change that adds objects or
+			refs. After 'writes' of them the repository is queued, and
+			each task is run with 'git maintenance run --auto', which
+			only does the work once git's own thresholds for the task
+			are met (maintenance.<task>.auto), e.g. 100 loose objects.
+			queue(path) runs tasks regardless.
+
+		A single thread works through the queue at the lowest CPU
+			priority, which on Linux also gives it the lowest best-effort
+			IO priority, and rests after each task so that maintenance
+			is running at most 'budget' of the time. run(path, task,
+			auto) does the work.
+	"""
+
+	def __init__(self, run, writes=50, budget=0.25):
+		self.run = run
+		self.writes = writes
+		self.budget = budget
+		self.lock = threading.Condition()
+		self.repos = {} # path -> state, see status()
+		self.pending = collections.OrderedDict() # path -> (tasks, auto)
+		self.threads = {} # Background threads, see start_once_per_process
+
+	def wrote(self, path, count=1):
+		if self.writes < 1:
+			return
+		path = os.path.normpath(path)
+		with self.lock:
+			state = self._state(path)
+			state['writes'] += count
+			if state['writes'] >= self.writes:
+				self._queue(path, TASKS, True)
+
+	def queue(self, path, tasks=None, auto=False):
+		"""
+			Queues tasks (all of TASKS by default) to run on the repository
+				at path, once git's thresholds are met if auto is set
+			Returns the state of the repository, see status()
+		"""
+		path = os.path.normpath(path)
+		with self.lock:
+			self._queue(path, tasks or TASKS, auto)
+			return dict(self.repos[path])
+
+	def forget(self, path):
+		path = os.path.normpath(path)
+		with self.lock:
+			self.repos.pop(path, None)
+			self.pending.pop(path, None)
+
+	def status(self, path=None):
+		"""
+			Returns the state of the repository at path, or None if it
+				hasn't been written to, or {path: state} of all of them.
+				A state is a dictionary of
+				'state': 'idle', 'queued' or 'running',
+				'writes': writes since it was last maintained,
+				'last': the last run, {'started': time, 'auto': whether
+					tasks only ran when needed, 'tasks': {task: seconds
+					it took, or the error it failed with}}, or None
+		"""
+		with self.lock:
+			if path is not None:
+				state = self.repos.get(os.path.normpath(path))
+				return None if state is None else dict(state)
+			return {k: dict(v) for k, v in self.repos.items()}
+
+	def _state(self, path):
+		state = self.repos.get(path)
+		if state is None:
+			state = self.repos[path] = {'state': 'idle', 'writes': 0,
+				'last': None}
+		return state
+
+	def _queue(self, path, tasks, auto):
+		state = self._state(path)
+		if path in self.pending:
+			old, old_auto = self.pending[path]
+			tasks = [x for x in TASKS if x in old or x in tasks]
+			auto = auto and old_auto
+		if state['state'] != 'running':
+			state['state'] = 'queued'
+		self.pending[path] = (tasks, auto)
+
+		start_once_per_process(self, self._work)
+		self.lock.notify()
+
+	def _work(self):
+		while True:
+			with self.lock:
+				while not self.pending:
+					self.lock.wait()
+				path, (tasks, auto) = self.pending.popitem(False)
+				state = self._state(path)
+				state['state'] = 'running'
+				state['writes'] = 0
+
+			last = {'started': time.time(), 'auto': auto, 'tasks': {}}
+			for task in tasks:
+				if not os.path.isdir(os.path.join(path, '.git')):
+					break # Deleted
+				start = time.time()
+				try:
+					self.run(path, task, auto)
+					last['tasks'][task] = time.time() - start
+				except Exception as e:
+					last['tasks'][task] = str(e).strip().split('\n')[-1]
+				took = time.time() - start
+				time.sleep(max(0, took / self.budget - took))
+
+			with self.lock:
+				state = self.repos.get(path)
+				if state is not None:
+					state['last'] = last
+					if state['state'] == 'running':
+						state['state'] = 'queued' if path in self.pending \
+							else 'idle'
+
+def maintain(r, task, auto=True):
+	"""
+		Runs git maintenance task on r at the lowest CPU priority, through
+			nice rather than in the child before exec, which isn't safe
+			in a process running threads
+		auto: only do the work when git's threshold for the task is met
+	"""
+	command = ['nice', '-n', '19', 'git', 'maintenance', 'run', '--quiet',
+		'--task=' + task]
+	if auto:
+		command.append('--auto')
+	r.git.execute(command)
+
+def objects(r):
+	"""
+		Returns statistics of the object store of r: the 'git
+			count-objects -v' numbers (count and size of loose objects,
+			packs, in-pack, size-pack, prune-packable, ...), and whether
+			it has a 'commit-graph' and a 'multi-pack-index'
+	"""
+	stats = {}
+	for line in r.git.count_objects('-v').split('\n'):
+		name, sep, value = line.partition(':')
+		if sep and value.strip().isdigit():
+			stats[name.strip()] = int(value)
+	info = os.path.join(r.git_dir, 'objects', 'info')
+	pack = os.path.join(r.git_dir, 'objects', 'pack')
+	stats['commit-graph'] = os.path.exists(info + '/commit-graph') or \
+		os.path.isdir(info + '/commit-graphs')
+	stats['multi-pack-index'] = os.path.exists(pack + '/multi-pack-index')
+	return stats
@@ -0,0 +1,288 @@
+import collections, contextlib, json, os, re, threading, time, uuid, git
+
+# Upper bounds of the latency histogram buckets, in seconds
+BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]
+
+# Name -> (type, help) of every metric, in the order they are rendered
+METRICS = collections.OrderedDict([
+	('http_requests_total', ('counter',
+		'Requests handled, by route, method and status code')),
+	('http_request_duration_seconds', ('histogram',
+		'Time until the response was handed to the server, by route')),
+	('http_requests_in_flight', ('gauge',
+		'Requests being handled, by route')),
+	('git_commands_total', ('counter',
+		'git subprocesses run, by command and result')),
+	('git_command_duration_seconds', ('histogram',
+		'Time git subprocesses took, by command')),
+	('git_transfer_bytes_total', ('counter',
+		'Bytes sent by push and received by pull as reported by git, or '
+		'for pulls too small for git to report, the size on disk of the '
+		'objects fetched')),
+	('repo_lock_wait_seconds', ('histogram',
+		'Time spent waiting for repository locks granted, by mode')),
+	('repo_lock_timeouts_total', ('counter',
+		'Repository locks not granted within LOCK_TIMEOUT, by mode')),
+	('file_cache_hits_total', ('counter',
+		'File reads answered from the file cache')),
+	('file_cache_misses_total', ('counter',
+		'File reads that had to read the file')),
+	('file_cache_evictions_total', ('counter',
+		'Files dropped from the file cache to make room'))
+])
+
+class Metrics(object):
+	"""
+		Request and git metrics of the server, rendered in the Prometheus
+			text format.
+
+		Values are kept per process. If path is set, each process also
+			writes its values to a file in that directory at most every
+			'interval' seconds, and render() adds up the files of all
+			processes so that any worker can be scraped. Gauges of
+			processes that have exited are left out.
+
+		Repo is a git.Repo subclass whose git subprocesses are recorded.
+			Commands started as a process (push, fetch, pull) finish after
+			execute() returns, so those are recorded by the caller with
+			timed(). on_git(command, seconds) is called for each of them.
+	"""
+
+	def __init__(self, path=None, interval=1, on_git=None):
+		self.path = path
+		self.interval = interval
+		self.on_git = on_git
+		self.lock = threading.Lock()
+		self.values = {x: {} for x in METRICS} # name -> labels -> value
+		self.saved = 0
+
+		if path is not None:
+			os.makedirs(path, exist_ok=True)
+
+		metrics = self
+
+		class Git(git.Git):
+			def execute(self, command, *args, **kwargs):
+				if kwargs.get('as_process'):
+					return git.Git.execute(self, command, *args, **kwargs)
+				with metrics.timed(command_name(command)):
+					return git.Git.execute(self, command, *args, **kwargs)
+
+		class Repo(git.Repo):
+			GitCommandWrapperType = Git
+
+		self.Repo = Repo
+
+	def inc(self, name, labels, value=1):
+		key = format_labels(labels)
+		with self.lock:
+			values = self.values[name]
+			values[key] = values.get(key, 0) + value
+
+	def observe(self, name, labels, value):
+		"""
+			Adds value to a histogram
+		"""
+		key = format_labels(labels)
+		with self.lock:
+			h = self.values[name].get(key)
+			if h is None:
+				# Count per bucket, then sum and count
+				h = self.values[name][key] = [0] * (len(BUCKETS) + 2)
+			for i, x in enumerate(BUCKETS):
+				if value <= x:
+					h[i] += 1
+					break
+			h[-2] += value
+			h[-1] += 1
+
+	def request_started(self, route):
+		self.inc('http_requests_in_flight', [('route', route)])
+
+	def request_finished(self, route, method, status, seconds):
+		self.inc('http_requests_in_flight', [('route', route)], -1)
+		self.inc('http_requests_total',
+			[('route', route), ('method', method), ('status', status)])
+		self.observe('http_request_duration_seconds', [('route', route)],
+			seconds)
+		self.save()
+
+	def git_command(self, command, seconds, ok=True):
+		self.inc('git_commands_total',
+			[('command', command), ('result', 'ok' if ok else 'error')])
+		self.observe('git_command_duration_seconds', [('command', command)],
+			seconds)
+		if self.on_git is not None:
+			self.on_git(command, seconds)
+
+	@contextlib.contextmanager
+	def timed(self, command):
+		"""
+			Records the enclosed block as a run of git command
+		"""
+		start = time.time()
+		ok = False
+		try:
+			yield
+			ok = True
+		finally:
+			self.git_command(command, time.time() - start, ok)
+
+	def transferred(self, operation, size):
+		self.inc('git_transfer_bytes_total', [('operation', operation)], size)
+
+	def lock_waited(self, mode, seconds, timed_out):
+		if timed_out:
+			self.inc('repo_lock_timeouts_total', [('mode', mode)])
+		else:
+			self.observe('repo_lock_wait_seconds', [('mode', mode)], seconds)
+
+	def file_cache(self, event):
+		# event: 'hit', 'miss' or 'eviction'
+		self.inc('file_cache_%s_total' % ('misses' if event == 'miss' else
+			event + 's'), [])
+
+	def render(self):
+		"""
+			Returns all metrics in the Prometheus text format
+		"""
+		if self.path is not None:
+			self.save(True)
+			values = self._merge()
+		else:
+			with self.lock:
+				values = json.loads(json.dumps(self.values)) # Copy
+
+		lines = []
+		for name, (kind, text) in METRICS.items():
+			lines.append('# HELP %s %s' % (name, text))
+			lines.append('# TYPE %s %s' % (name, kind))
+			for key in sorted(values[name]):
+				value = values[name][key]
+				labels = '{' + key + '}' if key else ''
+				if kind != 'histogram':
+					lines.append('%s%s %s' % (name, labels, number(value)))
+					continue
+
+				total = 0
+				sep = ',' if key else ''
+				for i, x in enumerate(BUCKETS + ['+Inf']):
+					if i < len(BUCKETS):
+						total += value[i]
+					else:
+						total = value[-1]
+					lines.append('%s_bucket{%s%sle="%s"} %d' %
+						(name, key, sep, x, total))
+				lines.append('%s_sum%s %s' % (name, labels, number(value[-2])))
+				lines.append('%s_count%s %d' % (name, labels, value[-1]))
+		return '\n'.join(lines) + '\n'
+
+	def save(self, force=False):
+		"""
+			Writes the values of this process to path, if set
+		"""
+		if self.path is None or \
+				(not force and time.time() - self.saved < self.interval):
+			return
+		self.saved = time.time()
+		with self.lock:
+			data = json.dumps({'pid': os.getpid(), 'values': self.values})
+
+		tmp = self.path + '/.' + uuid.uuid4().hex
+		try:
+			with open(tmp, 'w') as f:
+				f.write(data)
+			os.replace(tmp, self.path + '/' + str(os.getpid()) + '.json')
+		except OSError:
+			pass
+
+	def _merge(self):
+		# Adds up the values saved by all processes
+		values = {x: {} for x in METRICS}
+		cutoff = time.time() - 24 * 3600
+		for name in os.listdir(self.path):
+			if not name.endswith('.json'):
+				continue
+			try:
+				if os.stat(self.path + '/' + name).st_mtime < cutoff:
+					os.remove(self.path + '/' + name) # Long gone
+					continue
+				with open(self.path + '/' + name, 'r') as f:
+					data = json.load(f)
+			except (OSError, ValueError):
+				continue
+
+			alive = running(data['pid'])
+			for metric, (kind, text) in METRICS.items():
+				if kind == 'gauge' and not alive:
+					continue
+				for key, value in data['values'].get(metric, {}).items():
+					if kind == 'histogram':
+						old = values[metric].get(key, [0] * len(value))
+						value = [a + b for a, b in zip(old, value)]
+					else:
+						value += values[metric].get(key, 0)
+					values[metric][key] = value
+		return values
+
+class TransferMeter(git.RemoteProgress):
+	"""
+		Progress handler that keeps the number of bytes git reports as
+			sent or received, passing progress on to another
+			RemoteProgress if given
+	"""
+
+	SIZE_RE = re.compile(r'([0-9.]+) (bytes|KiB|MiB|GiB)')
+	UNITS = {'bytes': 1, 'KiB': 1 << 10, 'MiB': 1 << 20, 'GiB': 1 << 30}
+
+	def __init__(self, progress=None):
+		git.RemoteProgress.__init__(self)
+		self.progress = progress
+		self.size = 0
+
+	def update(self, op_code, cur_count, max_count=None, message=''):
+		if op_code & self.OP_MASK in [self.WRITING, self.RECEIVING]:
+			self._measure(message)
+		if self.progress is not None:
+			self.progress.update(op_code, cur_count, max_count, message)
+
+	def _measure(self, text):
+		# The size is a running total, so the last one counts. git only
+		#	reports it for packs, not for fetches it unpacks.
+		m = self.SIZE_RE.search(text or '')
+		if m is not None:
+			self.size = int(float(m.group(1)) * self.UNITS[m.group(2)])
+
+def command_name(command):
+	"""
+		Returns the git subcommand run by command, e.g. 'status' for
+			['git', '-c', 'x=y', 'status', '-z']
+	"""
+	if isinstance(command, str):
+		command = command.split()
+	# Run through another command, e.g. ['nice', '-n', '19', 'git', ...]
+	if command and command[0] != 'git' and 'git' in command:
+		command = command[command.index('git'):]
+	args = iter(command[1:])
+	for x in args:
+		if x in ['-c', '-C']:
+			next(args, None)
+		elif not x.startswith('-'):
+			return x
+	return 'git'
+
+def format_labels(labels):
+	return ','.join('%s="%s"' % (k, str(v).replace('\\', '\\\\')
+		.replace('"', '\\"').replace('\n', '\\n')) for k, v in labels)
+
+def number(value):
+	return repr(float(value)) if isinstance(value, float) else str(value)
+
+def running(pid):
+	try:
+		os.kill(pid, 0)
+	except ProcessLookupError:
+		return False
+	except PermissionError:
+		pass
+	return True
@@ -0,0 +1,150 @@
+import heapq, os, threading, time, concurrent.futures
+from threads import start_once_per_process
+
+# Where prefetched branches of a remote are kept, like git maintenance's
+#	prefetch task, so that fetched objects are there for the next pull
+#	without changing branches or remote-tracking refs
+PREFETCH_REFS = 'refs/prefetch/remotes/'
+
+# File in .git touched after each prefetch, so that worker processes
+#	don't prefetch the same repository one after another
+STAMP = 'storage-prefetch'
+
+class Prefetcher(object):
+	"""
+		Fetches the remotes of recently used repositories in the
+			background, so that pulls find the objects already there and
+			behind counts are up to date without going to the network.
+
+		touch(path) is called whenever a repository is used. It is
+			prefetched 'interval' seconds later, and then again after as
+			long as it has been idle, between interval and max_interval
+			seconds, doubling for every failure in a row. Repositories
+			idle for longer than 'idle' seconds are forgotten until used
+			again. At most 'workers' prefetches run at a time, with
+			fetch(path) doing the work.
+	"""
+
+	def __init__(self, fetch, workers=2, interval=60, max_interval=3600,
+			idle=86400):
+		self.fetch = fetch
+		self.workers = workers
+		self.interval = interval
+		self.max_interval = max_interval
+		self.idle = idle
+		self.lock = threading.Condition()
+		self.repos = {} # path -> [last used, next due, failures in a row]
+		self.queue = [] # heap of (due, path), may hold stale entries
+		self.running = set()
+		self.threads = {} # Background threads, see start_once_per_process
+
+	def touch(self, path):
+		if self.workers < 1:
+			return
+		path = os.path.normpath(path)
+		now = time.time()
+		with self.lock:
+			start_once_per_process(self, self._schedule)
+
+			entry = self.repos.get(path)
+			if entry is not None:
+				entry[0] = now
+				return
+			self.repos[path] = [now, now + self.interval, 0]
+			heapq.heappush(self.queue, (now + self.interval, path))
+			self.lock.notify()
+
+	def forget(self, path):
+		with self.lock:
+			self.repos.pop(os.path.normpath(path), None)
+
+	def next_interval(self, entry, now):
+		"""
+			Returns the seconds until the next prefetch of a repository
+		"""
+		wait = min(self.max_interval, max(self.interval, now - entry[0]))
+		return min(self.max_interval, wait * 2 ** entry[2])
+
+	def _schedule(self):
+		pool = concurrent.futures.ThreadPoolExecutor(self.workers)
+		while True:
+			with self.lock:
+				now = time.time()
+				while not self.queue or self.queue[0][0] > now or \
+						len(self.running) >= self.workers:
+					timeout = self.queue[0][0] - now if self.queue else None
+					if len(self.running) >= self.workers:
+						timeout = None
+					self.lock.wait(timeout)
+					now = time.time()
+				due, path = heapq.heappop(self.queue)
+				entry = self.repos.get(path)
+				if entry is None or entry[1] != due or path in self.running:
+					continue # Forgotten or rescheduled
+				if now - entry[0] > self.idle:
+					del self.repos[path]
+					continue
+				self.running.add(path)
+			pool.submit(self._run, path)
+
+	def _run(self, path):
+		ok = False
+		try:
+			ok = self._prefetch(path)
+		finally:
+			now = time.time()
+			with self.lock:
+				self.running.discard(path)
+				entry = self.repos.get(path)
+				if entry is not None:
+					entry[2] = 0 if ok else entry[2] + 1
+					entry[1] = now + self.next_interval(entry, now)
+					heapq.heappush(self.queue, (entry[1], path))
+				self.lock.notify()
+
+	def _prefetch(self, path):
+		# Returns whether the repository was prefetched (recently enough)
+		stamp = os.path.join(path, '.git', STAMP)
+		try:
+			if time.time() - os.stat(stamp).st_mtime < self.interval:
+				return True # By another process
+		except OSError:
+			pass
+		if not os.path.isdir(os.path.join(path, '.git')):
+			self.forget(path)
+			return False
+
+		try:
+			self.fetch(path)
+		except Exception:
+			return False
+		try:
+			with open(stamp, 'w'):
+				pass
+		except OSError:
+			pass
+		return True
+
+def prefetch(r):
+	"""
+		Fetches the branches of every remote of r into PREFETCH_REFS,
+			leaving the refs the user sees alone. Repositories without a
+			commit are left to their first pull, which fetches only as
+			much history as they were provisioned with.
+	"""
+	if not r.head.is_valid():
+		return
+	for rem in r.remotes:
+		r.git.fetch(rem.name, '--prune', '--no-tags', '--no-write-fetch-head',
+			'--recurse-submodules=no', '--refmap=',
+			'+refs/heads/*:' + PREFETCH_REFS + rem.name + '/*')
+
+def clear(r, remote):
+	"""
+		Removes the prefetched branches of remote, e.g. once they are no
+			newer than its remote-tracking refs
+	"""
+	refs = r.git.for_each_ref('--format=%(refname)',
+		PREFETCH_REFS + remote + '/').split()
+	for ref in refs:
+		r.git.update_ref('-d', ref)
@@ -0,0 +1,137 @@
+import collections, contextlib, os, sys, threading, time
+
+# Kinds of work timed for each request, in the order they are logged
+KINDS = ['git', 'fs', 'lock', 'serialize', 'compress']
+
+class Breakdown(object):
+	"""
+		Time a request spent on each kind of work, with git time also
+			broken down by command
+	"""
+
+	def __init__(self, route, repo):
+		self.route = route
+		self.repo = repo
+		self.lock = threading.Lock()
+		self.seconds = {x: 0.0 for x in KINDS}
+		self.commands = {} # git command -> [seconds, count]
+
+	def add(self, kind, seconds, command=None):
+		with self.lock:
+			self.seconds[kind] = self.seconds.get(kind, 0.0) + seconds
+			if command is not None:
+				c = self.commands.setdefault(command, [0.0, 0])
+				c[0] += seconds
+				c[1] += 1
+
+	def format(self, elapsed):
+		"""
+			Returns a summary such as 'git 7.800s (status 7.700s x1,
+				rev-list 0.100s x2), fs 0.010s, ..., other 0.090s'
+		"""
+		with self.lock:
+			parts = []
+			for kind in KINDS:
+				text = '%s %.3fs' % (kind, self.seconds[kind])
+				if kind == 'git' and self.commands:
+					text += ' (%s)' % ', '.join('%s %.3fs x%d' % (x, c[0], c[1])
+						for x, c in sorted(self.commands.items(),
+							key=lambda x: -x[1][0]))
+				parts.append(text)
+			# Work done by other threads can add up to more than elapsed
+			other = max(0.0, elapsed - sum(self.seconds.values()))
+			parts.append('other %.3fs' % other)
+			return ', '.join(parts)
+
+class Profiler(object):
+	"""
+		Keeps a Breakdown for the request each thread is handling, and
+			samples the stacks of those threads on demand.
+
+		Work done for a request on other threads is added to its
+			Breakdown if the function is wrapped with bind().
+	"""
+
+	def __init__(self):
+		self.local = threading.local()
+		self.active = {} # thread id -> Breakdown
+
+	def start(self, route, repo=None):
+		b = Breakdown(route, repo)
+		self.local.breakdown = b
+		self.active[threading.current_thread().ident] = b
+
+	def finish(self):
+		"""
+			Returns the Breakdown of the current thread's request, or None
+		"""
+		b = getattr(self.local, 'breakdown', None)
+		self.local.breakdown = None
+		self.active.pop(threading.current_thread().ident, None)
+		return b
+
+	def add(self, kind, seconds, command=None):
+		b = getattr(self.local, 'breakdown', None)
+		if b is not None:
+			b.add(kind, seconds, command)
+
+	def git_command(self, command, seconds):
+		self.add('git', seconds, command)
+
+	@contextlib.contextmanager
+	def timed(self, kind):
+		"""
+			Adds the time the enclosed block takes to kind
+		"""
+		start = time.time()
+		try:
+			yield
+		finally:
+			self.add(kind, time.time() - start)
+
+	def bind(self, fn):
+		"""
+			Returns fn wrapped to run as part of the current request
+		"""
+		b = getattr(self.local, 'breakdown', None)
+		if b is None:
+			return fn
+
+		def run(*args, **kwargs):
+			ident = threading.current_thread().ident
+			self.local.breakdown = b
+			self.active[ident] = b
+			try:
+				return fn(*args, **kwargs)
+			finally:
+				self.local.breakdown = None
+				self.active.pop(ident, None)
+		return run
+
+	def sample(self, seconds, interval=0.01, route=None, repo=None):
+		"""
+			Samples the stacks of threads working on requests (to route
+				and repo, if given) every interval for the given seconds.
+			Returns a Counter of stacks in the collapsed format of
+				flamegraph.pl: 'route;file:function;...', leaf last
+		"""
+		stacks = collections.Counter()
+		me = threading.current_thread().ident
+		deadline = time.time() + seconds
+		while time.time() < deadline:
+			for ident, frame in sys._current_frames().items():
+				b = self.active.get(ident)
+				if ident == me or b is None or \
+						(route is not None and b.route != route) or \
+						(repo is not None and b.repo != repo):
+					continue
+				frames = []
+				while frame is not None:
+					code = frame.f_code
+					frames.append('%s:%s' % (os.path.basename(code.co_filename),
+						code.co_name))
+					frame = frame.f_back
+				frames.append(str(b.route))
+				stacks[';'.join(reversed(frames))] += 1
+			time.sleep(interval)
+		return stacks
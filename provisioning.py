@@ -0,0 +1,68 @@
+import re
+
+# Partial clone filters accepted when creating a repository
+FILTER_RE = re.compile(r'^(blob:none|blob:limit=[0-9]+[kmg]?|tree:[0-9]+)$')
+
+def configure(r, depth=None, filter=None, sparse=None):
+	"""
+		Sets up a new repository r to be provisioned by its first pull.
+		depth: number of commits of history the first fetch gets. Later
+			fetches get every new commit on top of those, as after
+			'git clone --depth'.
+		filter: partial clone filter (e.g. 'blob:none') for fetches from
+			every remote, which become promisor remotes that the objects
+			left out are fetched from when needed
+		sparse: directories to check out in cone mode, with every file
+			at the top level. Everything else is left out of the work
+			tree by pulls and merges.
+		depth and filter are kept in r's config as storage.depth and
+			storage.filter.
+	"""
+	writer = r.config_writer()
+	try:
+		if depth is not None:
+			writer.set_value('storage', 'depth', depth)
+		if filter is not None:
+			# extensions.* only take effect in format version 1
+			writer.set_value('core', 'repositoryformatversion', 1)
+			writer.set_value('storage', 'filter', filter)
+	finally:
+		writer.release()
+
+	if sparse is not None:
+		r.git.sparse_checkout('set', '--cone', '--', *sparse)
+
+def add_remotes(r, remotes):
+	"""
+		Creates remotes ({name: url}) in r, as promisor remotes if r is a
+			partial clone
+	"""
+	reader = r.config_reader()
+	filter = reader.get_value('storage', 'filter', '')
+	for name in sorted(remotes):
+		r.create_remote(name, remotes[name])
+
+	if not filter or len(remotes) == 0:
+		return
+	writer = r.config_writer()
+	try:
+		# Older git only fetches missing objects from this remote
+		if writer.get_value('extensions', 'partialClone', '') not in \
+				[x.name for x in r.remotes]:
+			writer.set_value('extensions', 'partialClone', sorted(remotes)[0])
+		for name in remotes:
+			section = 'remote "%s"' % name
+			writer.set_value(section, 'promisor', 'true')
+			writer.set_value(section, 'partialclonefilter', filter)
+	finally:
+		writer.release()
+
+def fetch_options(r):
+	"""
+		Returns the keyword arguments for fetching into r: the depth of
+			the first fetch, before r has any commits
+	"""
+	depth = r.config_reader().get_value('storage', 'depth', 0)
+	if not depth or r.head.is_valid():
+		return {}
+	return {'depth': depth}
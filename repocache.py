@@ -0,0 +1,145 @@
+import collections, os, threading, time, git
+from threads import start_once_per_process
+
+class RepoCache(object):
+	"""
+		Process-wide pool of git.Repo handles keyed by repository path.
+
+		A handle is checked out with acquire() and handed back with
+		release(), so a handle (and its persistent cat-file processes)
+		is only ever used by one thread at a time. Idle handles are kept
+		in LRU order; the least recently used are closed once more than
+		'size' are idle, and any handle idle for longer than 'timeout'
+		seconds is closed by a janitor thread. New handles are created
+		with repo_class(path).
+	"""
+
+	def __init__(self, size=256, timeout=300, repo_class=git.Repo):
+		self.size = size
+		self.timeout = timeout
+		self.repo_class = repo_class
+		self.lock = threading.Lock()
+		self.idle = collections.OrderedDict() # path -> [(repo, last used)]
+		self.count = 0 # Number of idle handles
+		self.generation = {} # path -> invalidation counter
+		self.hits = 0
+		self.misses = 0
+		self.threads = {} # Background threads, see start_once_per_process
+
+	def acquire(self, path):
+		"""
+			Returns a git.Repo for path, reusing an idle handle if possible.
+			Raises git.NoSuchPathError or git.InvalidGitRepositoryError
+				exactly like git.Repo(path)
+		"""
+		path = os.path.normpath(path)
+		r = None
+		with self.lock:
+			if self.timeout:
+				start_once_per_process(self, self._janitor)
+
+			handles = self.idle.get(path)
+			if handles:
+				r, used = handles.pop()
+				self.count -= 1
+				if not handles:
+					del self.idle[path]
+			gen = self.generation.get(path, 0)
+
+		# The repo may have been removed behind our back
+		if r is not None and not os.path.isdir(r.git_dir):
+			_close(r)
+			r = None
+
+		if r is None:
+			self.misses += 1
+			r = self.repo_class(path)
+		else:
+			self.hits += 1
+
+		r._cache_key = (path, gen)
+		return r
+
+	def release(self, r):
+		"""
+			Returns a handle obtained from acquire() to the pool
+		"""
+		path, gen = getattr(r, '_cache_key', (None, None))
+		evicted = []
+		with self.lock:
+			if path is None or self.generation.get(path, 0) != gen:
+				evicted.append(r) # Invalidated while checked out
+			else:
+				self.idle.setdefault(path, []).append((r, time.time()))
+				self.idle.move_to_end(path)
+				self.count += 1
+
+				# Evict least recently used handles
+				while self.count > self.size:
+					key, handles = next(iter(self.idle.items()))
+					evicted.append(handles.pop(0)[0])
+					self.count -= 1
+					if not handles:
+						del self.idle[key]
+
+		for x in evicted:
+			_close(x)
+
+	def invalidate(self, path):
+		"""
+			Closes all idle handles for path and prevents handles that are
+				currently checked out from being returned to the pool.
+				Must be called whenever a repo is deleted or re-initialized.
+		"""
+		path = os.path.normpath(path)
+		with self.lock:
+			self.generation[path] = self.generation.get(path, 0) + 1
+			handles = self.idle.pop(path, [])
+			self.count -= len(handles)
+
+		for r, used in handles:
+			_close(r)
+
+	def expire(self):
+		"""
+			Closes handles that have been idle for longer than the timeout
+		"""
+		cutoff = time.time() - self.timeout
+		expired = []
+		with self.lock:
+			for path in [x for x in self.idle]:
+				handles = self.idle[path]
+				keep = [x for x in handles if x[1] >= cutoff]
+				expired.extend(x[0] for x in handles if x[1] < cutoff)
+				self.count -= len(handles) - len(keep)
+				if keep:
+					self.idle[path] = keep
+				else:
+					del self.idle[path]
+
+		for r in expired:
+			_close(r)
+
+	def clear(self):
+		"""
+			Closes every idle handle
+		"""
+		with self.lock:
+			handles = [x[0] for y in self.idle.values() for x in y]
+			self.idle.clear()
+			self.count = 0
+
+		for r in handles:
+			_close(r)
+
+	def _janitor(self):
+		while True:
+			time.sleep(max(1, self.timeout / 2))
+			self.expire()
+
+def _close(r):
+	# Terminates the persistent cat-file processes held by the handle
+	try:
+		r.git.clear_cache()
+	except Exception:
+		pass
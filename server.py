@@ -0,0 +1,87 @@
+from gunicorn.app.base import BaseApplication
+import multiprocessing
+
+# Settings of config.cfg besides SERVER_* that SIGHUP applies, being read
+#	on each request rather than when the app is loaded
+RELOADABLE = ['ADMIN_TOKEN', 'DIFF_MAX_FILE_SIZE', 'DIFF_MAX_SIZE',
+	'LIST_TIMEOUT', 'MAX_CONTENT_LENGTH', 'SLOW_REQUEST_THRESHOLD',
+	'STATUS_FSMONITOR']
+
+class StorageServer(BaseApplication):
+	"""
+		Production server for the app: gunicorn with preforked worker
+			processes, each running a pool of threads, configured from
+			the SERVER_* settings in config.cfg.
+
+		The app is loaded once in the master before forking. Workers are
+			replaced after SERVER_MAX_REQUESTS requests, and SIGHUP
+			starts a new set of workers before gracefully stopping the
+			old ones. The new workers pick up the SERVER_* settings and
+			those the app reads on each request (RELOADABLE) from the
+			current config.cfg. The caches, queues, locks and backend the
+			app builds when it is loaded keep their settings until the
+			server is restarted, so changes to the other settings are
+			left out of app.config with a warning.
+	"""
+
+	def __init__(self, app):
+		self.application = app
+		BaseApplication.__init__(self)
+
+	def load_config(self):
+		c = self.application.config
+		options = {
+			'bind': c.get('SERVER_BIND', '0.0.0.0:' + str(c.get('PORT', 8080))),
+			'workers': c.get('SERVER_WORKERS', multiprocessing.cpu_count()),
+			'worker_class': 'gthread',
+			'threads': c.get('SERVER_THREADS', 8),
+			'preload_app': True,
+			'keepalive': c.get('SERVER_KEEPALIVE', 5),
+			'timeout': c.get('SERVER_TIMEOUT', 120),
+			'graceful_timeout': c.get('SERVER_GRACEFUL_TIMEOUT', 30),
+			'max_requests': c.get('SERVER_MAX_REQUESTS', 10000),
+			'max_requests_jitter': c.get('SERVER_MAX_REQUESTS_JITTER', 1000),
+			'limit_request_line': c.get('SERVER_LIMIT_REQUEST_LINE', 8190),
+			'limit_request_fields': c.get('SERVER_LIMIT_REQUEST_FIELDS', 100),
+			'limit_request_field_size':
+				c.get('SERVER_LIMIT_REQUEST_FIELD_SIZE', 8190)
+		}
+		for key in options:
+			self.cfg.set(key, options[key])
+
+	def load(self):
+		return self.application
+
+	def reload(self):
+		# Pick up changes to config.cfg on SIGHUP, warning about those
+		#	that need a restart
+		config = self.application.config
+		old = dict(config)
+		config.from_pyfile('config.cfg')
+		changed = [x for x in config if x.isupper() and
+			config[x] != old.get(x) and not x.startswith('SERVER_') and
+			x not in RELOADABLE]
+		if changed:
+			for x in changed:
+				if x in old:
+					config[x] = old[x]
+				else:
+					del config[x]
+			self.application.logger.warning('Restart the server to apply '
+				'changes to %s' % ', '.join(sorted(changed)))
+		BaseApplication.reload(self)
+
+def run(app):
+	"""
+		Serves app with StorageServer until it is stopped
+	"""
+	if app.config.get('SERVER_WORKERS', multiprocessing.cpu_count()) > 1:
+		# Per-process state that has to be shared through files: without
+		#	them locks don't exclude other workers and jobs can't be polled
+		missing = [x for x in ['LOCK_DIR', 'JOB_DIR', 'METRICS_DIR']
+			if x in app.config and app.config[x] is None]
+		if missing:
+			app.logger.error('%s set to None, which only works with '
+				'SERVER_WORKERS = 1' % ', '.join(missing))
+			raise SystemExit(1)
+	StorageServer(app).run()
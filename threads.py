@@ -0,0 +1,20 @@
+import os, threading
+
+def start_once_per_process(owner, target):
+	"""
+		Starts target in a daemon thread unless owner already started it
+			in this process. Threads don't survive fork, so background
+			threads are started on first use in the serving process
+			rather than when the owner is created.
+		owner.threads: dictionary of target name -> process it was started
+			in, guarded by the caller
+		Returns True if the thread was started
+	"""
+	name = target.__name__
+	if owner.threads.get(name) == os.getpid():
+		return False
+	owner.threads[name] = os.getpid()
+	thread = threading.Thread(target=target)
+	thread.daemon = True
+	thread.start()
+	return True
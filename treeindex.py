@@ -0,0 +1,151 @@
+import collections, os, threading, time
+
+try:
+	from os import scandir
+except ImportError: # Python < 3.5
+	from scandir import scandir
+
+# Files and directories modified this close to being read may change again
+#	within the same mtime tick, so their contents are not trusted until
+#	older
+RACY_NS = 50 * 1000 * 1000
+
+class TreeIndex(object):
+	"""
+		In-memory index of repository working trees for the tree endpoint.
+
+		Each directory is listed once and stored with its mtime. Later
+		lookups only stat directories and re-list those whose mtime has
+		changed, since adding, removing or renaming an entry updates the
+		mtime of its parent. '.git' directories are never entered.
+		Indexes for the 'size' most recently used repos are kept.
+	"""
+
+	def __init__(self, size=64):
+		self.size = size
+		self.lock = threading.Lock()
+		self.repos = collections.OrderedDict() # basedir -> {reldir: entry}
+
+	def tree(self, basedir, subdir='', depth=None):
+		"""
+			Returns the tree below subdir of the repo at basedir as nested
+				dictionaries, with files as True. Directories at the given
+				depth are returned empty.
+		"""
+		return self._build(self._dirs(basedir), basedir, subdir.strip('/'),
+			depth)
+
+	def walk(self, basedir, subdir='', depth=None, after=None):
+		"""
+			Yields (path, is directory) for the entries below subdir in
+				sorted depth-first order, with paths relative to subdir.
+				Entries more than depth levels down are skipped. If after
+				is given only the entries following that path are yielded,
+				so the last path returned can be used as a cursor.
+		"""
+		after = tuple(after.strip('/').split('/')) if after else None
+		return self._walk(self._dirs(basedir), basedir, subdir.strip('/'),
+			(), depth, after)
+
+	def invalidate(self, basedir, path=None):
+		"""
+			Forgets the listing of every directory containing path, or the
+				whole repo if path is None
+		"""
+		with self.lock:
+			if path is None:
+				self.repos.pop(basedir, None)
+				return
+			dirs = self.repos.get(basedir)
+
+		if dirs is not None:
+			path = os.path.normpath(path).strip('/')
+			while path:
+				path = os.path.dirname(path)
+				dirs.pop(path, None)
+
+	def _dirs(self, basedir):
+		# Gets the directory listings of a repo, marking it recently used
+		with self.lock:
+			dirs = self.repos.get(basedir)
+			if dirs is None:
+				dirs = self.repos[basedir] = {}
+			self.repos.move_to_end(basedir)
+			while len(self.repos) > self.size:
+				self.repos.popitem(last=False)
+		return dirs
+
+	def _build(self, dirs, basedir, reldir, depth):
+		entry = self._entry(dirs, basedir, reldir)
+		if entry is None:
+			return {}
+
+		files, subdirs = entry[1], entry[2]
+		node = dict.fromkeys(files, True)
+		for d in subdirs:
+			if depth is None or depth > 1:
+				node[d] = self._build(dirs, basedir,
+					reldir + '/' + d if reldir else d,
+					None if depth is None else depth - 1)
+			else:
+				node[d] = {}
+		return node
+
+	def _walk(self, dirs, basedir, reldir, prefix, depth, after):
+		entry = self._entry(dirs, basedir, reldir)
+		if entry is None:
+			return
+
+		names = sorted([(x, False) for x in entry[1]] +
+			[(x, True) for x in entry[2]])
+		for name, isdir in names:
+			key = prefix + (name,)
+
+			# Skip entries before the cursor, including their subtrees
+			#	unless the cursor lies inside them
+			if after is not None and key <= after:
+				if after[:len(key)] != key:
+					continue
+			else:
+				yield '/'.join(key), isdir
+
+			if isdir and (depth is None or len(key) < depth):
+				for x in self._walk(dirs, basedir,
+						reldir + '/' + name if reldir else name,
+						key, depth, after):
+					yield x
+
+	def _entry(self, dirs, basedir, reldir):
+		# Returns (mtime_ns, files, subdirs) of a directory, listing it
+		#	again if it changed since it was last listed
+		fullpath = basedir + '/' + reldir if reldir else basedir
+		try:
+			mtime = os.stat(fullpath).st_mtime_ns
+		except OSError:
+			dirs.pop(reldir, None)
+			return None
+
+		entry = dirs.get(reldir)
+		if entry is not None and entry[0] == mtime:
+			return entry
+
+		scanned = int(time.time() * 1e9)
+		files, subdirs = [], []
+		try:
+			for e in scandir(fullpath):
+				if e.is_dir(follow_symlinks=False):
+					if e.name != '.git':
+						subdirs.append(e.name)
+				elif not e.is_dir():
+					# Symlinks to directories are left out, like os.walk
+					files.append(e.name)
+		except OSError:
+			dirs.pop(reldir, None)
+			return None
+
+		entry = (mtime, files, subdirs)
+		if scanned - mtime > RACY_NS:
+			dirs[reldir] = entry
+		else:
+			dirs.pop(reldir, None)
+		return entry